@@ -1,64 +1,24 @@
+import sys
 import random
+import functools
+import argparse
 import numpy as np
-import pandas as pd
 
 from tqdm import tqdm
-from glob import glob
-
-
-def readRun(file):
-    """
-    read run and convert into dataframe
-    :param file: input run
-    :return: run as pandas dataframe
-    """
-
-    fformat = file.split('.')[-1]
-    if fformat != 'run':
-        print('Format allowed is: run')
-        raise Exception
-
-    df = pd.read_csv(file, sep='\t', names=['query', 'entity', 'factID', 'rank', 'score', 'model'])
-    return df
-
-
-def fact2estimate(strataFile, annotPath):
-    """
-    associate each fact to the (estimated) partition accuracy
-    :param strataFile: stored strata IDs
-    :param annotPath: path to estimate stats
-    :return: dict associating each fact ID with the corresponding partition estimate
-    """
-
-    # read strata file and store fact IDs within strata
-    with open(strataFile, 'r') as f:
-        strata = f.readlines()
-    strata = [stratum.strip().split(',') for stratum in strata]
-    strata = [[int(_id) for _id in stratum] for stratum in strata]
-
-    # set vars
-    strata2stats = {}
-    fact2est = {}
-
-    # read stats files
-    statsPaths = glob(annotPath+'/partition*')
-    # iterate over files and store stats info:
-    for statPath in statsPaths:
-        # get partition id
-        _id = int(statPath.split('.tsv')[0][-1])
-        df = pd.read_csv(statPath, sep='\t')
-        strata2stats[_id] = df.values.tolist()
-
-    # iterate over strata and associate to each fact ID the corresponding accuracy estimate (point estimate + CI)
-    for i, facts in enumerate(strata):
-        for fact in facts:
-            if fact in fact2est:
-                print('oh oh, this should not happen!')
-                raise Exception
-            fact2est[fact] = strata2stats[i]
-
-    # return dict
-    return fact2est
+from budgetSimulation import CorrectionSimulator, workerPool, simulate, popularityAllocation, optimizeAllocation
+
+sys.path.append('../utils')
+from factIndex import FactIndex
+from runReader import readRun
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--workers', default=0, type=int, help='Number of worker processes -- 0 runs trials sequentially w/ the global seeded random state.')
+parser.add_argument('--exact', action='store_true', help='Compute the exact (hypergeometric) mean and std of entity cards instead of simulating trials.')
+parser.add_argument('--optimize', action='store_true', help='Whether to also evaluate the allocation maximizing the expected number of entity cards of the target size.')
+parser.add_argument('--target', default=10, type=int, choices=[5, 10], help='Size of the entity cards maximized by the optimized allocation.')
+parser.add_argument('--steps', default=20, type=int, help='Number of budget increments allocated by the optimizer (greedy marginal gain).')
+args = parser.parse_args()
 
 
 def main():
@@ -69,26 +29,30 @@ def main():
     # read run
     run = readRun('../data/runs/dynes_utility.run')
     # read fact accuracy estimates
-    f2e = fact2estimate('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
+    f2e = FactIndex('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
     # create new column for run
-    run['accEstimate'] = run['factID'].map(lambda x: f2e.get(x, [None])[0][0])
+    run['stratum'] = f2e.lookup(run['factID'], 'stratum')
 
     # specify cutoffs to compute entity cards
     cutoffs = [5, 10]
+    # set up the simulator (and worker processes) -- the run is grouped by query once for all trials
+    simulator = CorrectionSimulator(run, cutoffs=cutoffs)
+    pool = workerPool(simulator, args.workers) if args.workers else None
     # count total number of queries
-    totQueries = run.groupby('query').size().reset_index(name='row_count')
+    totQueries = run.groupby('query', observed=True).size().reset_index(name='row_count')
     totQueries = {cutoff: totQueries[totQueries['row_count'] >= cutoff].shape[0] for cutoff in cutoffs}
     # set percentages to compute budget
     percentage = [0.0, 0.01, 0.05, 0.1]
-    # specify the different set of partitions to be filtered out
-    accScoresList = [[0.6923076923076923], [0.6923076923076923, 0.7260726072607261, 0.7044025157232704], [0.6923076923076923, 0.7260726072607261, 0.7723880597014925, 0.7044025157232704]]
+    # specify the different set of partitions (i.e., strata IDs) to be filtered out -- in popularity order
+    strataList = [[4], [4, 2, 0], [4, 2, 1, 0]]
 
-    for accScores in accScoresList:
+    for strata in strataList:
+        accScores = f2e.strata().loc[strata, 'estimate'].tolist()
         print(f'Accuracy score of filtered out partitions: {accScores}')
-
-        # compute weights for popularity-based allocation strategy
-        weights = [1 / ((pr+1) ** 2) for pr in range(len(accScores))]
-        weights = [weight / sum(weights) for weight in weights]
+        # get run positions of facts within partitions to be filtered out
+        partitions = [np.flatnonzero(run['stratum'] == stratum) for stratum in strata]
+        # set the objective of the optimized allocation -- i.e., the expected number of entity cards of the target size
+        objective = functools.partial(simulator.expectedCards, partitions, cutoff=args.target)
 
         for perc in percentage:
             print('Budget allocated for error correction: {}%'.format(perc*100))
@@ -97,33 +61,23 @@ def main():
             budget = round(run.shape[0] * perc)
 
             # set up the budget allocation strategy
-            popBudget = [round(budget * weight) for weight in weights]
-
-            # allocate remaining budget across partitions
-            for budgetStrat in [popBudget]:
-                leftBudget = budget - sum(budgetStrat)
-                k = 0
-                while leftBudget != 0:
-                    if leftBudget < 0:
-                        budgetStrat[k] -= 1
-                        leftBudget += 1
-                    else:
-                        budgetStrat[k] += 1
-                        leftBudget -= 1
-
-                    if k+1 == len(budgetStrat):
-                        k = 0
-                    else:
-                        k += 1
+            popBudget = popularityAllocation(budget, len(strata))
             print(f'Amount of partition(s) covered by error correction when filtering is applied: {popBudget}')
 
             # prepare budget strategies
             budgetStrategies = [popBudget]
             strategyNames = ['Popularity-based allocation']
+            if args.optimize:  # search the allocation maximizing the target measure
+                optBudget, optValue = optimizeAllocation(objective, [p.shape[0] for p in partitions], budget, numSteps=args.steps)
+                print(f'Amount of partition(s) covered by optimized error correction: {optBudget} (expected entity cards of size {args.target}: {round(optValue, 1)} vs {round(objective(popBudget), 1)} w/ popularity-based allocation)')
+                budgetStrategies.append(optBudget)
+                strategyNames.append('Optimized allocation')
 
             for budgetXpartition, stratName in zip(budgetStrategies, strategyNames):  # iterate over budget allocation strategies
                 assert budget == sum(budgetXpartition)  # sanity check
                 print('Perform error correction with {}'.format(stratName))
+                if pool and not args.exact:  # spread trials across workers w/ independent random streams spawned from the seed -- once for all cutoffs
+                    cardCounts = simulate(simulator, partitions, budgetXpartition, 1000, measure='cards', seed=42, pool=pool)
 
                 for cutoff in cutoffs:  # iterate over cutoff values
                     print('Entity card generated w/ {} facts'.format(cutoff))
@@ -132,24 +86,25 @@ def main():
                     qCounts = []
 
                     print('Removed {} partitions with veracity scores {}'.format(len(accScores), accScores))
-                    for _ in tqdm(range(1000)):
-                        cRun = run.copy(deep=True)
-                        # iterate over partitions and sample triples w/ SRS to be annotated with 1
-                        for j, acc in enumerate(accScores):
-                            k = np.random.choice(run[run['accEstimate'] == acc].index, size=budgetXpartition[j], replace=False)
-                            cRun.loc[k, 'accEstimate'] = 1.0
-                        # remove rows with specific values in 'accEstimate'
-                        fRun = cRun[~cRun['accEstimate'].isin(accScores)]
-
-                        # group by 'query' and count the number of rows
-                        queryCounts = fRun.groupby('query').size().reset_index(name='row_count')
-                        queryCounts = queryCounts[queryCounts['row_count'] >= cutoff]
-                        qCounts.append(queryCounts.shape[0])
+                    if args.exact:  # compute mean and std in closed form -- no simulation required
+                        mean, std = simulator.expectedCardCounts(partitions, budgetXpartition, cutoff)
+                        print(f'{round(mean, 1)} +\- {round(std, 1)} entity cards generated out of {totQueries[cutoff]}')
+                        print()
+                        continue
+                    if pool:  # take the counts of the current cutoff
+                        qCounts = cardCounts[cutoff]
+                    else:  # iterate over blocks of trials and sample triples w/ SRS to be annotated with 1 within each partition
+                        for keep in tqdm(simulator.sampleMasks(partitions, budgetXpartition, 1000, run.shape[0])):
+                            # count queries w/ at least cutoff facts after removing partitions in accScores
+                            qCounts += simulator.cardCounts(keep, cutoff).tolist()
                     print(f'{round(np.mean(qCounts), 1)} +\- {round(np.std(qCounts), 1)} entity cards generated out of {totQueries[cutoff]}')
                     print()
                 print()
         print('\n')
 
+    if pool:  # shut down worker processes
+        pool.shutdown()
+
 
 if __name__ == "__main__":
     main()
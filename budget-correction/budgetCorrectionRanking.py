@@ -1,35 +1,27 @@
+import sys
 import random
+import functools
 import argparse
 import numpy as np
 import pandas as pd
-import ir_measures as ireval
 
-from glob import glob
 from tqdm import tqdm
-from ir_measures import *
+from budgetSimulation import CorrectionSimulator, workerPool, simulate, popularityAllocation, optimizeAllocation
+
+sys.path.append('../utils')
+from factIndex import FactIndex
+from runReader import readRun
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--method', default='dynes_utility', choices=['dynes_utility', 'relin'], help='Target method.')
+parser.add_argument('--workers', default=0, type=int, help='Number of worker processes -- 0 runs trials sequentially w/ the global seeded random state.')
+parser.add_argument('--optimize', action='store_true', help='Whether to also evaluate the allocation maximizing the expected nDCG at the target cutoff.')
+parser.add_argument('--target', default=10, type=int, choices=[5, 10], help='Cutoff of the nDCG maximized by the optimized allocation.')
+parser.add_argument('--steps', default=20, type=int, help='Number of budget increments allocated by the optimizer (greedy marginal gain).')
 args = parser.parse_args()
 
 
-def readRun(file):
-    """
-    read run and convert into dataframe
-    :param file: input run
-    :return: run as pandas dataframe
-    """
-
-    fformat = file.split('.')[-1]
-    if fformat != 'run':
-        print('Format allowed is: run')
-        raise Exception
-
-    df = pd.read_csv(file, sep='\t', names=['query', 'entity', 'factID', 'rank', 'score', 'model'])
-    return df
-
-
 def readQrels(file):
     """
     read qrels and convert into dataframe
@@ -41,43 +33,17 @@ def readQrels(file):
     return df
 
 
-def fact2estimate(strataFile, annotPath):
+def expectedNDCG(simulator, partitions, cutoff, budgetXpartition):
     """
-    associate each fact to the (estimated) partition accuracy
-    :param strataFile: stored strata IDs
-    :param annotPath: path to estimate stats
-    :return: dict associating each fact ID with the corresponding partition estimate
+    compute the expected nDCG at the given cutoff when correcting the specified number of facts within each filtered partition
+    :param simulator: correction simulator over the target run
+    :param partitions: list of arrays storing the run positions of the facts within each filtered partition
+    :param cutoff: nDCG cutoff
+    :param budgetXpartition: number of facts corrected within each filtered partition
+    :return: the expected nDCG at the given cutoff
     """
 
-    # read strata file and store fact IDs within strata
-    with open(strataFile, 'r') as f:
-        strata = f.readlines()
-    strata = [stratum.strip().split(',') for stratum in strata]
-    strata = [[int(_id) for _id in stratum] for stratum in strata]
-
-    # set vars
-    strata2stats = {}
-    fact2est = {}
-
-    # read stats files
-    statsPaths = glob(annotPath+'/partition*')
-    # iterate over files and store stats info:
-    for statPath in statsPaths:
-        # get partition id
-        _id = int(statPath.split('.tsv')[0][-1])
-        df = pd.read_csv(statPath, sep='\t')
-        strata2stats[_id] = df.values.tolist()
-
-    # iterate over strata and associate to each fact ID the corresponding accuracy estimate (point estimate + CI)
-    for i, facts in enumerate(strata):
-        for fact in facts:
-            if fact in fact2est:
-                print('oh oh, this should not happen!')
-                raise Exception
-            fact2est[fact] = strata2stats[i]
-
-    # return dict
-    return fact2est
+    return simulator.expectedNDCG(partitions, budgetXpartition)[cutoff]
 
 
 def main():
@@ -86,7 +52,7 @@ def main():
     random.seed(42)
 
     # read run
-    run = readRun('../data/runs/'+args.method+'.run')
+    run = readRun('../data/runs/'+args.method+'.run', scoreDtype=np.float64)
     # read and prepare qrels
     qrels = readQrels('../data/corpus/qrels-utility.txt')
     qrels = qrels[['query', 'factID', 'judgment']]
@@ -94,22 +60,28 @@ def main():
     qrels['doc_id'] = qrels['doc_id'].astype(str)
 
     # read fact accuracy estimates
-    f2e = fact2estimate('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
+    f2e = FactIndex('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
     # create new column for runs
-    run['accEstimate'] = run['factID'].map(lambda x: f2e.get(x, [None])[0][0])
+    run['stratum'] = f2e.lookup(run['factID'], 'stratum')
+
+    # set up the simulator -- run sorting and qrels indexing are performed once for all trials
+    simulator = CorrectionSimulator(run, qrels, cutoffs=[5, 10])
+    # set up worker processes -- the simulator is shared once w/ each worker
+    pool = workerPool(simulator, args.workers) if args.workers else None
 
     # set percentages to compute budget
     percentage = [0.0, 0.01, 0.05, 0.1]
 
-    # specify the different set of partitions to be filtered out
-    accScoresList = [[0.6923076923076923], [0.6923076923076923, 0.7260726072607261, 0.7044025157232704], [0.6923076923076923, 0.7260726072607261, 0.7723880597014925, 0.7044025157232704]]
+    # specify the different set of partitions (i.e., strata IDs) to be filtered out -- in popularity order
+    strataList = [[4], [4, 2, 0], [4, 2, 1, 0]]
 
-    for accScores in accScoresList:
+    for strata in strataList:
+        accScores = f2e.strata().loc[strata, 'estimate'].tolist()
         print(f'Accuracy score of filtered out partitions: {accScores}')
-
-        # compute weights for popularity-based allocation strategy
-        weights = [1 / ((pr+1) ** 2) for pr in range(len(accScores))]
-        weights = [weight / sum(weights) for weight in weights]
+        # get run positions of facts within partitions to be filtered out
+        partitions = [np.flatnonzero(run['stratum'] == stratum) for stratum in strata]
+        # set the objective of the optimized allocation -- i.e., the expected nDCG at the target cutoff
+        objective = functools.partial(expectedNDCG, simulator, partitions, args.target)
 
         for perc in percentage:
             print('Budget allocated for error correction: {}%'.format(perc * 100))
@@ -118,29 +90,17 @@ def main():
             budget = round(run.shape[0] * perc)
 
             # set up the budget allocation strategy
-            popBudget = [round(budget * weight) for weight in weights]
-
-            # allocate remaining budget across partitions
-            for budgetStrat in [popBudget]:
-                leftBudget = budget - sum(budgetStrat)
-                k = 0
-                while leftBudget != 0:
-                    if leftBudget < 0:
-                        budgetStrat[k] -= 1
-                        leftBudget += 1
-                    else:
-                        budgetStrat[k] += 1
-                        leftBudget -= 1
-
-                    if k + 1 == len(budgetStrat):
-                        k = 0
-                    else:
-                        k += 1
+            popBudget = popularityAllocation(budget, len(strata))
             print(f'Amount of partition(s) covered by error correction when filtering is applied: {popBudget}')
 
             # prepare budget strategies
             budgetStrategies = [popBudget]
             strategyNames = ['Popularity-based allocation']
+            if args.optimize:  # search the allocation maximizing the target measure
+                optBudget, optValue = optimizeAllocation(objective, [p.shape[0] for p in partitions], budget, numSteps=args.steps)
+                print(f'Amount of partition(s) covered by optimized error correction: {optBudget} (expected nDCG@{args.target}: {round(optValue, 4)} vs {round(objective(popBudget), 4)} w/ popularity-based allocation)')
+                budgetStrategies.append(optBudget)
+                strategyNames.append('Optimized allocation')
 
             for budgetXpartition, stratName in zip(budgetStrategies, strategyNames):  # iterate over budget allocation strategies
                 assert budget == sum(budgetXpartition)  # sanity check
@@ -151,24 +111,21 @@ def main():
                 nDCG10 = []
 
                 print('Removed {} partitions with veracity scores {}'.format(len(accScores), accScores))
-                for _ in tqdm(range(1000)):
-                    cRun = run.copy(deep=True)
-                    # iterate over partitions and sample triples w/ SRS to be annotated with 1
-                    for j, acc in enumerate(accScores):
-                        k = np.random.choice(run[run['accEstimate'] == acc].index, size=budgetXpartition[j], replace=False)
-                        cRun.loc[k, 'accEstimate'] = 1.0
-                    # remove rows with specific values in 'accEstimate' in the run
-                    fRun = cRun[~cRun['accEstimate'].isin(accScores)]
-                    fRun = fRun[['query', 'factID', 'score']]
-                    fRun = fRun.rename(columns={'query': 'query_id', 'factID': 'doc_id'})
-                    fRun['doc_id'] = fRun['doc_id'].astype(str)
-
-                    # compute considered measures
-                    scores = ireval.calc_aggregate([nDCG @ 5, nDCG @ 10], qrels, fRun)
-                    nDCG5.append(round(scores[nDCG @ 5], 4))
-                    nDCG10.append(round(scores[nDCG @ 10], 4))
+                if pool:  # spread trials across workers w/ independent random streams spawned from the seed
+                    scores = simulate(simulator, partitions, budgetXpartition, 1000, measure='nDCG', seed=42, pool=pool)
+                    nDCG5 += [round(score, 4) for score in scores[5]]
+                    nDCG10 += [round(score, 4) for score in scores[10]]
+                else:  # iterate over blocks of trials and sample triples w/ SRS to be annotated with 1 within each partition
+                    for keep in tqdm(simulator.sampleMasks(partitions, budgetXpartition, 1000, run.shape[0])):
+                        # compute considered measures over trials, w/ rows of partitions in accScores removed
+                        scores = simulator.nDCG(keep)
+                        nDCG5 += [round(score, 4) for score in scores[5]]
+                        nDCG10 += [round(score, 4) for score in scores[10]]
                 print(args.method+'\tnDCG@5={}+/-{}\tnDCG@10={}+/-{}'.format(round(np.mean(nDCG5), 2), round(np.std(nDCG5), 2), round(np.mean(nDCG10), 2), round(np.std(nDCG10), 2)))
 
+    if pool:  # shut down worker processes
+        pool.shutdown()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,474 @@
+import numpy as np
+import pandas as pd
+
+from scipy.signal import fftconvolve
+from scipy.special import gammaln
+from concurrent.futures import ProcessPoolExecutor
+
+# simulator shared w/ (the trials run by) each worker process
+_simulator = None
+
+
+class CorrectionSimulator(object):
+    """
+    This class represents the batched Monte Carlo engine used to simulate budget-constrained error correction.
+    Each trial is encoded as a row of a (trials x facts) keep/drop mask over the run, so that filtering,
+    error correction and evaluation are performed for all trials (and queries) at once w/ NumPy.
+    """
+
+    def __init__(self, run, qrels=None, cutoffs=(5, 10)):
+        """
+        Initialize the simulator by sorting the run once (as done by trec_eval) and indexing relevance gains
+
+        :param run: run as pandas dataframe w/ (at least) columns query, factID, and score
+        :param qrels: qrels as pandas dataframe w/ columns query_id, doc_id, and relevance (None to only count cards)
+        :param cutoffs: nDCG cutoffs to compute
+        """
+
+        self.numFacts = run.shape[0]
+        self.cutoffs = list(cutoffs)
+
+        # encode queries and (string) fact IDs -- trec_eval breaks score ties by decreasing doc ID (string) order
+        qCodes, self.queries = pd.factorize(run['query'], sort=True)
+        docs = run['factID'].astype(str).to_numpy()
+        _, dCodes = np.unique(docs, return_inverse=True)
+        scores = run['score'].to_numpy(dtype=np.float64) if 'score' in run else np.zeros(self.numFacts)
+
+        # sort run rows by (query, score desc, doc ID desc) -- the order is preserved by any keep/drop mask
+        self.order = np.lexsort((-dCodes, -scores, qCodes))
+        sortedQ = qCodes[self.order]
+        self.starts = np.flatnonzero(np.r_[True, sortedQ[1:] != sortedQ[:-1]])
+        self.segments = np.repeat(np.arange(self.starts.shape[0]), np.diff(np.r_[self.starts, self.numFacts]))
+        # associate each (original) run row to its query segment
+        self.rowSegments = np.empty_like(self.segments)
+        self.rowSegments[self.order] = self.segments
+
+        if qrels is None:  # card counting only -- no need for relevance gains
+            self.gains = None
+            return
+
+        # associate each (sorted) run row to its relevance gain -- unjudged facts have null gain
+        judged = qrels.assign(doc_id=qrels['doc_id'].astype(str))
+        judged = judged.set_index(['query_id', 'doc_id'])['relevance']
+        judged = judged[~judged.index.duplicated(keep='last')]
+        keys = pd.MultiIndex.from_arrays([run['query'].to_numpy()[self.order], docs[self.order]])
+        self.gains = np.maximum(judged.reindex(keys).fillna(0).to_numpy(dtype=np.float64), 0)
+
+        # compute ideal DCG per query at each cutoff -- queries within qrels but w/o retrieved facts score 0
+        self.numJudged = judged.index.get_level_values(0).nunique()
+        self.idcg = {}
+        for cutoff in self.cutoffs:
+            ideal = judged.groupby(level=0).apply(lambda x: self._dcg(np.sort(np.maximum(x.to_numpy(dtype=np.float64), 0))[::-1][:cutoff]))
+            self.idcg[cutoff] = ideal.reindex(self.queries).fillna(0).to_numpy()
+
+    @staticmethod
+    def _dcg(gains):
+        """
+        Compute the Discounted Cumulative Gain (DCG) of a ranked list of gains
+
+        :param gains: ranked relevance gains
+        :return: the DCG value
+        """
+
+        return np.sum(gains / np.log2(np.arange(gains.shape[0]) + 2))
+
+    @staticmethod
+    def sampleMasks(partitions, budgetXpartition, numTrials, numFacts, rng=np.random, blockSize=100):
+        """
+        Sample, for each trial, the facts corrected (i.e., annotated w/ 1) within each filtered partition w/ SRS
+        Draws are performed in the same order as a per-trial loop, so a seeded rng returns the same trials
+
+        :param partitions: list of arrays storing the run positions of the facts within each filtered partition
+        :param budgetXpartition: number of facts corrected within each filtered partition
+        :param numTrials: number of trials
+        :param numFacts: number of facts within the run
+        :param rng: random number generator (either np.random, a RandomState, or a Generator)
+        :param blockSize: number of trials returned per block
+        :return: generator of boolean (trials x facts) masks marking facts kept after filtering and correction
+        """
+
+        filtered = np.concatenate(partitions) if partitions else np.array([], dtype=np.int64)
+        for begin in range(0, numTrials, blockSize):
+            keep = np.ones((min(blockSize, numTrials - begin), numFacts), dtype=bool)
+            keep[:, filtered] = False
+            for t in range(keep.shape[0]):
+                for j, facts in enumerate(partitions):
+                    keep[t, rng.choice(facts, size=budgetXpartition[j], replace=False)] = True
+            yield keep
+
+    def cardCounts(self, keep, cutoff):
+        """
+        Count, for each trial, the number of queries that still have enough facts to generate an entity card
+
+        :param keep: boolean (trials x facts) mask over the (original) run rows
+        :param cutoff: number of facts required to generate an entity card
+        :return: number of entity cards generated per trial
+        """
+
+        counts = np.add.reduceat(keep[:, self.order], self.starts, axis=1, dtype=np.int64)
+        return (counts >= cutoff).sum(axis=1)
+
+    @staticmethod
+    def _logComb(n, k):
+        """
+        Compute the log of the binomial coefficient (n choose k)
+
+        :param n: number of elements (array)
+        :param k: number of chosen elements (array)
+        :return: log binomial coefficient
+        """
+
+        return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+    def _cappedHypergeom(self, population, successes, draws, cap):
+        """
+        Compute, for each entry of successes, the pmf of the successes drawn w/o replacement (hypergeometric)
+        Values greater than or equal to cap are lumped into the last bin
+
+        :param population: population size
+        :param successes: array storing the number of successes within the population
+        :param draws: number of draws
+        :param cap: value from which successes are lumped together
+        :return: array (len(successes) x cap+1) storing the capped pmfs
+        """
+
+        k = np.arange(cap)[None, :]
+        m = successes[:, None]
+        valid = (k <= m) & (k <= draws) & (draws - k <= population - m)
+        logPmf = self._logComb(m, np.minimum(k, m)) + self._logComb(population - m, np.clip(draws - k, 0, population - m)) - self._logComb(population, draws)
+        pmf = np.where(valid, np.exp(logPmf), 0.0)
+        return np.concatenate([pmf, np.maximum(1 - pmf.sum(axis=1, keepdims=True), 0)], axis=1)
+
+    def _cappedJointHypergeom(self, population, successesQ, successesR, draws, cap):
+        """
+        Compute, for each pair of success categories, the joint pmf of the successes drawn w/o replacement
+        (multivariate hypergeometric) -- values greater than or equal to cap are lumped into the last bin
+
+        :param population: population size
+        :param successesQ: array storing the number of successes within the first category
+        :param successesR: array storing the number of successes within the second category
+        :param draws: number of draws
+        :param cap: value from which successes are lumped together
+        :return: array (num pairs x cap+1 x cap+1) storing the capped joint pmfs
+        """
+
+        a = np.arange(cap)[None, :, None]
+        b = np.arange(cap)[None, None, :]
+        mQ = successesQ[:, None, None]
+        mR = successesR[:, None, None]
+        others = population - mQ - mR
+        valid = (a <= mQ) & (b <= mR) & (a + b <= draws) & (draws - a - b <= others)
+        logPmf = self._logComb(mQ, np.minimum(a, mQ)) + self._logComb(mR, np.minimum(b, mR))
+        logPmf = logPmf + self._logComb(others, np.clip(draws - a - b, 0, others)) - self._logComb(population, draws)
+
+        joint = np.zeros((successesQ.shape[0], cap + 1, cap + 1))
+        joint[:, :cap, :cap] = np.where(valid, np.exp(logPmf), 0.0)
+        # fill lumped bins from marginals
+        joint[:, :cap, cap] = self._cappedHypergeom(population, successesQ, draws, cap)[:, :cap] - joint[:, :cap, :cap].sum(axis=2)
+        joint[:, cap, :cap] = self._cappedHypergeom(population, successesR, draws, cap)[:, :cap] - joint[:, :cap, :cap].sum(axis=1)
+        joint[:, cap, cap] = 1 - joint.sum(axis=(1, 2))
+        return np.maximum(joint, 0)
+
+    @staticmethod
+    def _cappedConvolve(x, y, cap):
+        """
+        Convolve (batches of) capped pmfs along their last axis or last two axes -- sums beyond cap are lumped into the last bin
+
+        :param x: capped pmfs
+        :param y: capped pmfs
+        :param cap: value from which sums are lumped together
+        :return: capped pmf of the sum
+        """
+
+        # convolve over the pmf axes (batched) and lump sums beyond cap
+        axes = tuple(range(1, x.ndim))
+        out = np.maximum(fftconvolve(x, y, axes=axes), 0)
+        for axis in axes:
+            out = np.concatenate([out.take(np.arange(cap), axis=axis), out.take(np.arange(cap, out.shape[axis]), axis=axis).sum(axis=axis, keepdims=True)], axis=axis)
+        return out
+
+    def _cardProbabilities(self, partitions, budgetXpartition, cutoff):
+        """
+        Compute, for each query, the exact probability of generating an entity card after filtering and correction
+        The facts corrected per query within each partition follow a hypergeometric distribution, whose pmfs are convolved across partitions
+
+        :param partitions: list of arrays storing the run positions of the facts within each filtered partition
+        :param budgetXpartition: number of facts corrected within each filtered partition
+        :param cutoff: number of facts required to generate an entity card
+        :return: per-query probabilities, per-query counts of filtered facts (w/ a trailing column of zeros), and per-query
+        number of corrected facts needed to generate an entity card
+        """
+
+        numQueries = self.starts.shape[0]
+        # count facts per query -- in total and within each filtered partition
+        facts = np.bincount(self.rowSegments, minlength=numQueries)
+        filtered = np.stack([np.bincount(self.rowSegments[p], minlength=numQueries) for p in partitions] + [np.zeros(numQueries, dtype=np.int64)], axis=1)
+        # compute the number of corrected facts each query needs to generate an entity card
+        need = np.clip(cutoff - (facts - filtered.sum(axis=1)), 0, cutoff)
+
+        # compute the probability of generating an entity card per query -- corrected facts are capped at cutoff
+        pmf = np.zeros((numQueries, cutoff + 1))
+        pmf[:, 0] = 1
+        for j, p in enumerate(partitions):
+            pmf = self._cappedConvolve(pmf, self._cappedHypergeom(p.shape[0], filtered[:, j], budgetXpartition[j], cutoff), cutoff)
+        tail = np.cumsum(pmf[:, ::-1], axis=1)[:, ::-1]
+        return np.minimum(tail[np.arange(numQueries), need], 1), filtered, need
+
+    def expectedCards(self, partitions, budgetXpartition, cutoff):
+        """
+        Compute the exact mean number of entity cards generated after filtering and correction
+
+        :param partitions: list of arrays storing the run positions of the facts within each filtered partition
+        :param budgetXpartition: number of facts corrected within each filtered partition
+        :param cutoff: number of facts required to generate an entity card
+        :return: mean number of entity cards generated
+        """
+
+        return self._cardProbabilities(partitions, budgetXpartition, cutoff)[0].sum()
+
+    @staticmethod
+    def _signaturePairs(numSignatures, pairBlock):
+        """
+        Generate the (unordered) pairs of signatures -- a signature paired w/ itself included -- in blocks, w/o materializing all pairs
+
+        :param numSignatures: number of signatures
+        :param pairBlock: (approximate) number of pairs per block
+        :return: generator of (first signatures, second signatures) arrays
+        """
+
+        begin = 0
+        while begin < numSignatures:
+            # take the rows of the upper triangle (diagonal included) that fit the block
+            sizes = numSignatures - np.arange(begin, numSignatures)
+            end = begin + max(1, np.searchsorted(np.cumsum(sizes), pairBlock, side='right'))
+            q = np.repeat(np.arange(begin, end), sizes[:end - begin])
+            r = np.arange(q.shape[0]) - np.repeat(np.cumsum(sizes[:end - begin]) - sizes[:end - begin], sizes[:end - begin]) + q
+            yield q, r
+            begin = end
+
+    def expectedCardCounts(self, partitions, budgetXpartition, cutoff, pairBlock=10000):
+        """
+        Compute the exact mean and std of the number of entity cards generated after filtering and correction
+        The facts corrected per query within each partition follow a (multivariate) hypergeometric distribution,
+        whose pmfs are convolved across partitions -- the std accounts for the dependence between queries
+
+        :param partitions: list of arrays storing the run positions of the facts within each filtered partition
+        :param budgetXpartition: number of facts corrected within each filtered partition
+        :param cutoff: number of facts required to generate an entity card
+        :param pairBlock: number of signature pairs processed at once
+        :return: mean and std of the number of entity cards generated
+        """
+
+        prob, filtered, need = self._cardProbabilities(partitions, budgetXpartition, cutoff)
+
+        # compute the variance -- indicators of queries sharing a partition are (negatively) correlated
+        var = np.sum(prob * (1 - prob))
+        # the joint pmf of a query pair only depends on the (filtered counts, need) signatures of the queries -- it is computed
+        # once per pair of signatures and weighted by the number of query pairs sharing them
+        uncertain = np.flatnonzero((prob > 0) & (prob < 1))
+        signatures, first, counts = np.unique(np.column_stack([filtered[uncertain, :-1], need[uncertain]]), axis=0, return_index=True, return_counts=True)
+        sigFiltered, sigNeed, sigProb = signatures[:, :-1], signatures[:, -1], prob[uncertain[first]]
+        for q, r in self._signaturePairs(signatures.shape[0], pairBlock):
+            # keep the pairs sharing (at least) a filtered partition
+            weights = np.where(q == r, counts[q] * (counts[q] - 1) / 2, counts[q] * counts[r])
+            shared = ((sigFiltered[q] > 0) & (sigFiltered[r] > 0)).any(axis=1) & (weights > 0)
+            q, r, weights = q[shared], r[shared], weights[shared]
+            joint = np.zeros((q.shape[0], cutoff + 1, cutoff + 1))
+            joint[:, 0, 0] = 1
+            for j, p in enumerate(partitions):
+                joint = self._cappedConvolve(joint, self._cappedJointHypergeom(p.shape[0], sigFiltered[q, j], sigFiltered[r, j], budgetXpartition[j], cutoff), cutoff)
+            # compute P(both queries generate an entity card) through the 2-D tail sum
+            jointTail = np.cumsum(np.cumsum(joint[:, ::-1, ::-1], axis=1), axis=2)[:, ::-1, ::-1]
+            var += 2 * np.sum(weights * (jointTail[np.arange(q.shape[0]), sigNeed[q], sigNeed[r]] - sigProb[q] * sigProb[r]))
+        return prob.sum(), max(var, 0) ** 0.5
+
+    def nDCG(self, keep):
+        """
+        Compute, for each trial, the nDCG@k after filtering and correction (as done by ir_measures)
+
+        :param keep: boolean (trials x facts) mask over the (original) run rows
+        :return: dict associating each cutoff with the array of per-trial mean nDCG@k (over queries within qrels)
+        """
+
+        kept = keep[:, self.order]
+        # compute rank positions within each query after removing the dropped facts
+        positions = np.cumsum(kept, axis=1, dtype=np.int64)
+        offsets = np.concatenate([np.zeros((kept.shape[0], 1), dtype=np.int64), positions[:, self.starts[1:] - 1]], axis=1)
+        ranks = positions - offsets[:, self.segments]
+        discounted = np.zeros(kept.shape)
+        discounted[kept] = np.broadcast_to(self.gains, kept.shape)[kept] / np.log2(ranks[kept] + 1)
+
+        scores = {}
+        for cutoff in self.cutoffs:
+            dcg = np.add.reduceat(np.where(ranks <= cutoff, discounted, 0.0), self.starts, axis=1)
+            ndcg = np.divide(dcg, self.idcg[cutoff], out=np.zeros_like(dcg), where=self.idcg[cutoff] > 0)
+            scores[cutoff] = ndcg.sum(axis=1) / self.numJudged
+        return scores
+
+    def expectedNDCG(self, partitions, budgetXpartition):
+        """
+        Compute the expected nDCG@k after filtering and correction -- corrected facts are approximated as kept independently
+        w/ their SRS inclusion probability (i.e., budget over partition size), so that the distribution of the number of kept facts
+        ranked above each fact (capped at the largest cutoff) is updated position by position for all queries at once
+
+        :param partitions: list of arrays storing the run positions of the facts within each filtered partition
+        :param budgetXpartition: number of facts corrected within each filtered partition
+        :return: dict associating each cutoff with the expected mean nDCG@k (over queries within qrels)
+        """
+
+        # compute the probability of keeping each fact
+        probs = np.ones(self.numFacts)
+        for facts, budget in zip(partitions, budgetXpartition):
+            probs[facts] = budget / facts.shape[0] if facts.shape[0] else 0
+
+        # lay out (sorted) run rows as padded (query x position) matrices -- padding is never kept
+        numQueries = self.starts.shape[0]
+        lengths = np.diff(np.r_[self.starts, self.numFacts])
+        positions = np.arange(self.numFacts) - np.repeat(self.starts, lengths)
+        keepProbs = np.zeros((numQueries, lengths.max() if numQueries else 0))
+        keepProbs[self.segments, positions] = probs[self.order]
+        gains = np.zeros(keepProbs.shape)
+        gains[self.segments, positions] = self.gains
+
+        # track the distribution of kept facts above the current position -- counts beyond the largest cutoff are lumped together
+        cap = max(self.cutoffs)
+        discounts = 1 / np.log2(np.arange(cap) + 2)
+        above = np.zeros((numQueries, cap + 1))
+        above[:, 0] = 1
+        dcg = {cutoff: np.zeros(numQueries) for cutoff in self.cutoffs}
+        for i in range(keepProbs.shape[1]):
+            p = keepProbs[:, i]
+            for cutoff in self.cutoffs:  # the fact is ranked r+1 when r kept facts are above it
+                dcg[cutoff] += gains[:, i] * p * (above[:, :cutoff] @ discounts[:cutoff])
+            kept = above * p[:, None]
+            above = above * (1 - p)[:, None]
+            above[:, 1:] += kept[:, :-1]
+            above[:, cap] += kept[:, cap]
+
+        scores = {}
+        for cutoff in self.cutoffs:
+            ndcg = np.divide(dcg[cutoff], self.idcg[cutoff], out=np.zeros_like(dcg[cutoff]), where=self.idcg[cutoff] > 0)
+            scores[cutoff] = ndcg.sum() / self.numJudged
+        return scores
+
+
+def popularityAllocation(budget, numPartitions):
+    """
+    allocate the budget across partitions w/ weights 1/(pr+1)^2, where pr is the (popularity) position of the partition --
+    rounding leftovers are assigned round-robin starting from the first partition
+    :param budget: number of facts to correct
+    :param numPartitions: number of filtered partitions
+    :return: number of facts corrected within each filtered partition
+    """
+
+    weights = [1 / ((pr+1) ** 2) for pr in range(numPartitions)]
+    weights = [weight / sum(weights) for weight in weights]
+    budgetXpartition = [round(budget * weight) for weight in weights]
+
+    # allocate remaining budget across partitions
+    leftBudget = budget - sum(budgetXpartition)
+    k = 0
+    while leftBudget != 0:
+        if leftBudget < 0:
+            budgetXpartition[k] -= 1
+            leftBudget += 1
+        else:
+            budgetXpartition[k] += 1
+            leftBudget -= 1
+        k = 0 if k + 1 == numPartitions else k + 1
+    return budgetXpartition
+
+
+def optimizeAllocation(objective, sizes, budget, numSteps=20):
+    """
+    allocate the budget across partitions by greedy marginal gain -- the budget is split into (nearly) equal increments
+    and each increment goes to the partition whose allocation maximizes the objective, w/ partitions capped at their size
+    :param objective: function mapping the number of facts corrected within each filtered partition to the (expected) target measure
+    :param sizes: number of facts within each filtered partition
+    :param budget: number of facts to correct
+    :param numSteps: number of budget increments
+    :return: number of facts corrected within each filtered partition and the objective value
+    """
+
+    if budget > sum(sizes):
+        print('Budget ({}) exceeds the number of filtered facts ({})'.format(budget, sum(sizes)))
+        raise Exception
+
+    budgetXpartition = [0] * len(sizes)
+    value = objective(budgetXpartition)
+    for increment in np.diff(np.round(np.linspace(0, budget, numSteps + 1))).astype(int).tolist():
+        while increment > 0:  # leftovers of capped partitions go to the next best partition
+            candidates = []
+            for j, size in enumerate(sizes):
+                if budgetXpartition[j] < size:
+                    allocation = list(budgetXpartition)
+                    allocation[j] += min(increment, size - budgetXpartition[j])
+                    candidates.append((objective(allocation), -j, allocation))
+            value, _, allocation = max(candidates)
+            increment -= sum(allocation) - sum(budgetXpartition)
+            budgetXpartition = allocation
+    return budgetXpartition, value
+
+
+def _initWorker(simulator):
+    """
+    store the simulator within the worker process -- it is received once at start up rather than once per task
+    :param simulator: the target simulator
+    """
+
+    global _simulator
+    _simulator = simulator
+
+
+def _runBlock(task):
+    """
+    run a block of trials w/ its own random stream
+    :param task: tuple (seed sequence, num trials, partitions, budget per partition, measure)
+    :return: dict associating each cutoff with the per-trial scores of the block
+    """
+
+    seedSeq, numTrials, partitions, budgetXpartition, measure = task
+    rng = np.random.default_rng(seedSeq)
+    keep = next(_simulator.sampleMasks(partitions, budgetXpartition, numTrials, _simulator.numFacts, rng=rng, blockSize=numTrials))
+    if measure == 'nDCG':
+        return _simulator.nDCG(keep)
+    return {cutoff: _simulator.cardCounts(keep, cutoff) for cutoff in _simulator.cutoffs}
+
+
+def workerPool(simulator, workers):
+    """
+    set up a pool of worker processes sharing the simulator
+    :param simulator: the target simulator
+    :param workers: number of worker processes
+    :return: the process pool
+    """
+
+    return ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(simulator,))
+
+
+def simulate(simulator, partitions, budgetXpartition, numTrials, measure='nDCG', seed=42, pool=None, blockSize=100):
+    """
+    run trials in blocks, each w/ an independent random stream spawned from seed
+    Streams are bound to blocks rather than workers, so results are the same regardless of the number of workers
+
+    :param simulator: the target simulator
+    :param partitions: list of arrays storing the run positions of the facts within each filtered partition
+    :param budgetXpartition: number of facts corrected within each filtered partition
+    :param numTrials: number of trials
+    :param measure: measure computed for each trial -- 'nDCG' or 'cards'
+    :param seed: seed used to spawn the random streams
+    :param pool: process pool returned by workerPool (None to run trials within the current process)
+    :param blockSize: number of trials per block (i.e., per task)
+    :return: dict associating each cutoff with the array of per-trial scores
+    """
+
+    sizes = [min(blockSize, numTrials - begin) for begin in range(0, numTrials, blockSize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(seedSeq, size, partitions, budgetXpartition, measure) for seedSeq, size in zip(seeds, sizes)]
+
+    if pool is None:  # run blocks sequentially within the current process
+        _initWorker(simulator)
+        blocks = list(map(_runBlock, tasks))
+    else:  # spread blocks across workers -- map preserves the order of blocks
+        blocks = list(pool.map(_runBlock, tasks))
+    return {cutoff: np.concatenate([block[cutoff] for block in blocks]) for cutoff in simulator.cutoffs}
@@ -0,0 +1,458 @@
+import os
+import sys
+import json
+import shutil
+import fnmatch
+import hashlib
+import argparse
+import threading
+import subprocess
+
+from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('stages', default=None, nargs='*', help='Target stages (along w/ their upstream stages) -- all stages by default.')
+parser.add_argument('--jobs', default=os.cpu_count(), type=int, help='Max number of stages run in parallel.')
+parser.add_argument('--force', action='store_true', help='Re-execute target stages even when their cached artifacts are up to date.')
+parser.add_argument('--dry', action='store_true', help='Only report the stages that would be (re)executed.')
+parser.add_argument('--list', action='store_true', help='List stages w/ their dependencies and exit.')
+
+# repository root -- stage paths are relative to it
+root = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage(object):
+    """
+    This class represents a stage of the pipeline: a script run from its own folder (as done by hand) that reads its inputs and writes its outputs.
+    Inputs and outputs are paths relative to the repository root -- inputs can also be glob patterns.
+    """
+
+    def __init__(self, name, folder, script, args=(), inputs=(), outputs=(), code=()):
+        """
+        Initialize the stage
+
+        :param name: stage name
+        :param folder: folder the script is run from
+        :param script: script file name
+        :param args: script command line arguments
+        :param inputs: files (or glob patterns) read by the script
+        :param outputs: files written by the script
+        :param code: additional (local) modules used by the script
+        """
+
+        self.name = name
+        self.folder = folder
+        self.script = script
+        self.args = list(args)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = [os.path.join(folder, script)] + list(code)
+
+
+# veracity workflow -- fact annotations are collected interactively (estimateStrataAccuracy.ipynb), hence veracity estimates
+# stored in data/stats/facts/ are pipeline sources, as the corpus, the search counts, the qrels, and the baseline runs
+stats = 'data/stats/facts/partition*.tsv'
+corpus = 'data/corpus/fact_ranking_coll/*'
+stages = [
+    Stage('corpus', 'utils', 'corpusStore.py',
+          inputs=['data/corpus/fact_ranking_coll.tsv'],
+          outputs=['data/corpus/fact_ranking_coll/'+file for file in ['meta.json', 'en_id.npy', 'id.npy', 'pred.npy', 'obj.npy']] +
+                  ['data/corpus/fact_ranking_coll/'+table+ext for table in ['terms', 'predicates'] for ext in ['.bytes.npy', '.offsets.npy']],
+          code=['utils/fileHash.py']),
+    # the (gitignored) popularity store is refreshed from searchCounts.txt whenever the file changes, hence the TSV is the stage input
+    Stage('utility', 'veracity-estimation', 'computeUtility.py',
+          inputs=['data/corpus/fact_ranking_coll.tsv', corpus, 'data/utility/searchCounts.txt'],
+          outputs=['data/utility/factUtility.tsv'],
+          code=['veracity-estimation/popularityStore.py', 'utils/fileHash.py', 'utils/corpusStore.py']),
+    Stage('strata', 'veracity-estimation', 'stratifyFacts.py',
+          inputs=['data/utility/factUtility.tsv'],
+          outputs=['data/utility/stratifiedFacts.csv']),
+    Stage('entityVeracity', 'veracity-estimation', 'computeEntityVeracity.py',
+          inputs=['data/corpus/fact_ranking_coll.tsv', corpus, 'data/utility/stratifiedFacts.csv', stats],
+          outputs=['data/stats/entities/entityVeracity.tsv'],
+          code=['utils/factIndex.py', 'utils/fileHash.py', 'utils/corpusStore.py']),
+    Stage('reRankDynes', 'veracity-ranking', 'reRank.py', args=['--method', 'dynes_utility'],
+          inputs=['data/runs/dynes_utility.run', 'data/utility/stratifiedFacts.csv', stats],
+          outputs=['data/runs/vRankDynes.run'],
+          code=['utils/factIndex.py', 'utils/fileHash.py', 'utils/runReader.py', 'utils/runEvaluator.py', 'utils/qrelsReader.py']),
+    Stage('reRankRELIN', 'veracity-ranking', 'reRank.py', args=['--method', 'relin'],
+          inputs=['data/runs/relin.run', 'data/utility/stratifiedFacts.csv', stats],
+          outputs=['data/runs/vRankRELIN.run'],
+          code=['utils/factIndex.py', 'utils/fileHash.py', 'utils/runReader.py', 'utils/runEvaluator.py', 'utils/qrelsReader.py']),
+    Stage('evaluateRuns', 'veracity-ranking', 'evaluateRuns.py',
+          inputs=['data/corpus/qrels-utility.txt', 'data/runs/dynes_utility.run', 'data/runs/vRankDynes.run', 'data/runs/relin.run', 'data/runs/vRankRELIN.run'],
+          code=['utils/runReader.py', 'utils/runEvaluator.py', 'utils/significanceTests.py', 'utils/qrelsReader.py']),
+    Stage('robustnessDynes', 'veracity-ranking', 'robustnessAnalysis.py', args=['--method', 'dynes_utility'],
+          inputs=['data/runs/dynes_utility.run', 'data/utility/stratifiedFacts.csv', stats],
+          outputs=['data/robustness/dynes_utility_beta.tsv'],
+          code=['veracity-ranking/reRank.py', 'utils/factIndex.py', 'utils/fileHash.py', 'utils/runReader.py', 'utils/runEvaluator.py', 'utils/qrelsReader.py']),
+    Stage('robustnessRELIN', 'veracity-ranking', 'robustnessAnalysis.py', args=['--method', 'relin'],
+          inputs=['data/runs/relin.run', 'data/utility/stratifiedFacts.csv', stats],
+          outputs=['data/robustness/relin_beta.tsv'],
+          code=['veracity-ranking/reRank.py', 'utils/factIndex.py', 'utils/fileHash.py', 'utils/runReader.py', 'utils/runEvaluator.py', 'utils/qrelsReader.py'])
+]
+for size in [5, 10]:
+    for method, baseline, vRank in [('dynes_utility', 'Dynes', 'vRankDynes'), ('relin', 'RELIN', 'vRankRELIN')]:
+        stages.append(Stage('cards'+baseline+str(size), 'veracity-ranking', 'computeCardsCorrelation.py', args=['--method', method, '--size', str(size)],
+                            inputs=['data/corpus/fact_ranking_coll.tsv', corpus, 'data/runs/'+method+'.run', 'data/runs/'+vRank+'.run'],
+                            outputs=['data/cards/size='+str(size)+'/'+method+'.json', 'data/cards/size='+str(size)+'/'+vRank+'.json'],
+                            code=['utils/runReader.py', 'utils/corpusStore.py']))
+stages += [
+    Stage('budgetCards', 'budget-correction', 'budgetCorrectionCards.py',
+          inputs=['data/runs/dynes_utility.run', 'data/utility/stratifiedFacts.csv', stats],
+          code=['budget-correction/budgetSimulation.py', 'utils/factIndex.py', 'utils/fileHash.py', 'utils/runReader.py']),
+    Stage('budgetRankingDynes', 'budget-correction', 'budgetCorrectionRanking.py', args=['--method', 'dynes_utility'],
+          inputs=['data/runs/dynes_utility.run', 'data/corpus/qrels-utility.txt', 'data/utility/stratifiedFacts.csv', stats],
+          code=['budget-correction/budgetSimulation.py', 'utils/factIndex.py', 'utils/fileHash.py', 'utils/runReader.py']),
+    Stage('budgetRankingRELIN', 'budget-correction', 'budgetCorrectionRanking.py', args=['--method', 'relin'],
+          inputs=['data/runs/relin.run', 'data/corpus/qrels-utility.txt', 'data/utility/stratifiedFacts.csv', stats],
+          code=['budget-correction/budgetSimulation.py', 'utils/factIndex.py', 'utils/fileHash.py', 'utils/runReader.py'])
+]
+
+
+class Pipeline(object):
+    """
+    This class represents the DAG of pipeline stages -- a stage depends on the stages writing (any of) its inputs.
+    Stage artifacts (outputs and logs) are cached by content hash: the key of a stage hashes its code, arguments, and inputs,
+    so that a stage is re-executed only when its key has never been run (stale), while outputs modified or overwritten since
+    a cached run are restored from the cache. Independent stages are run in parallel.
+    """
+
+    def __init__(self, stages, cacheDir='data/pipeline/'):
+        """
+        Initialize the pipeline and infer stage dependencies
+
+        :param stages: list of stages
+        :param cacheDir: folder storing the cached artifacts (objects), the stage records, the logs, and the file hashes
+        """
+
+        self.stages = OrderedDict((stage.name, stage) for stage in stages)
+        self.cacheDir = os.path.join(root, cacheDir)
+        for folder in ['objects', 'stages', 'logs']:
+            os.makedirs(os.path.join(self.cacheDir, folder), exist_ok=True)
+
+        # associate each stage w/ the upstream stages writing its inputs
+        producers = {output: stage.name for stage in stages for output in stage.outputs}
+        self.deps = {}
+        for stage in stages:
+            self.deps[stage.name] = sorted({producer for output, producer in producers.items() for pattern in stage.inputs
+                                            if producer != stage.name and fnmatch.fnmatch(output, pattern)})
+        self.order = self.topologicalOrder()
+
+        # file hashes are reused while file (mtime, size) is unchanged
+        self.hashesFile = os.path.join(self.cacheDir, 'hashes.json')
+        self.hashes = {}
+        if os.path.exists(self.hashesFile):
+            with open(self.hashesFile, 'r') as f:
+                self.hashes = json.load(f)
+        self.lock = threading.Lock()
+
+    def topologicalOrder(self):
+        """
+        Sort stages so that each stage follows its upstream stages
+
+        :return: list of stage names in topological order
+        """
+
+        order = []
+        state = {}
+
+        def visit(name):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                print('Pipeline stages must be acyclic -- check stage {}'.format(name))
+                raise Exception
+            state[name] = 'visiting'
+            for dep in self.deps[name]:
+                visit(dep)
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def select(self, targets=None):
+        """
+        Select the target stages along w/ their upstream stages
+
+        :param targets: list of target stage names (None for all stages)
+        :return: list of selected stage names in topological order
+        """
+
+        if not targets:
+            return list(self.order)
+        unknown = [name for name in targets if name not in self.stages]
+        if unknown:
+            print('Unknown stages: {} -- allowed stages are: {}'.format(unknown, list(self.stages)))
+            raise Exception
+
+        selected = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending += self.deps[name]
+        return [name for name in self.order if name in selected]
+
+    def hashFile(self, path):
+        """
+        Compute the content hash of a file -- hashes are reused while the file (mtime, size) is unchanged
+
+        :param path: file path relative to the repository root
+        :return: SHA-256 hex digest
+        """
+
+        stat = os.stat(os.path.join(root, path))
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached and cached['stat'] == [stat.st_mtime_ns, stat.st_size]:
+            return cached['sha256']
+
+        sha = hashlib.sha256()
+        with open(os.path.join(root, path), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        with self.lock:
+            self.hashes[path] = {'stat': [stat.st_mtime_ns, stat.st_size], 'sha256': sha.hexdigest()}
+        return sha.hexdigest()
+
+    def saveHashes(self):
+        """
+        Store the file hashes (atomically)
+        """
+
+        tmpFile = self.hashesFile + '.tmp'
+        with self.lock:
+            with open(tmpFile, 'w') as out:
+                json.dump(self.hashes, out)
+        os.replace(tmpFile, self.hashesFile)
+
+    def key(self, stage):
+        """
+        Compute the key of a stage -- i.e., the hash of its code, arguments, and inputs content
+
+        :param stage: target stage
+        :return: SHA-256 hex digest
+        """
+
+        sha = hashlib.sha256()
+        sha.update(json.dumps([stage.name, stage.folder, stage.script, stage.args]).encode())
+        for path in stage.code:
+            sha.update((path + '\t' + self.hashFile(path) + '\n').encode())
+        for pattern in stage.inputs:
+            paths = sorted(os.path.relpath(path, root) for path in glob(os.path.join(root, pattern)))
+            if not paths:
+                print('Missing input {} for stage {}'.format(pattern, stage.name))
+                raise Exception
+            for path in paths:
+                sha.update((path + '\t' + self.hashFile(path) + '\n').encode())
+        return sha.hexdigest()
+
+    def logFile(self, stage):
+        """
+        Get the log file of a stage
+
+        :param stage: target stage
+        :return: log file path relative to the repository root
+        """
+
+        return os.path.relpath(os.path.join(self.cacheDir, 'logs', stage.name + '.log'), root)
+
+    def objectFile(self, sha):
+        """
+        Get the cache file storing the artifact w/ the given content hash
+
+        :param sha: artifact content hash
+        :return: cache file path
+        """
+
+        return os.path.join(self.cacheDir, 'objects', sha[:2], sha)
+
+    def status(self, stage, key):
+        """
+        Check the cached artifacts of a stage
+
+        :param stage: target stage
+        :param key: stage key
+        :return: 'cached' if outputs match the cached run, 'restorable' if they can be restored from the cache, 'stale' otherwise
+        """
+
+        recordFile = os.path.join(self.cacheDir, 'stages', key + '.json')
+        if not os.path.exists(recordFile):
+            return 'stale'
+        with open(recordFile, 'r') as f:
+            record = json.load(f)
+        artifacts = record['artifacts']
+        if all(os.path.exists(os.path.join(root, path)) and self.hashFile(path) == sha for path, sha in artifacts.items()):
+            return 'cached'
+        if all(os.path.exists(self.objectFile(sha)) for sha in artifacts.values()):
+            return 'restorable'
+        return 'stale'
+
+    def restore(self, key):
+        """
+        Restore the cached artifacts of a stage
+
+        :param key: stage key
+        """
+
+        with open(os.path.join(self.cacheDir, 'stages', key + '.json'), 'r') as f:
+            record = json.load(f)
+        for path, sha in record['artifacts'].items():
+            if os.path.exists(os.path.join(root, path)) and self.hashFile(path) == sha:
+                continue
+            os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+            tmpFile = os.path.join(root, path) + '.tmp'
+            shutil.copyfile(self.objectFile(sha), tmpFile)
+            os.replace(tmpFile, os.path.join(root, path))
+
+    def store(self, stage, key):
+        """
+        Cache the artifacts (outputs and log) of a stage and record them under the stage key
+
+        :param stage: target stage
+        :param key: stage key
+        """
+
+        artifacts = {}
+        for path in stage.outputs + [self.logFile(stage)]:
+            if not os.path.exists(os.path.join(root, path)):
+                print('Missing output {} for stage {}'.format(path, stage.name))
+                raise Exception
+            sha = self.hashFile(path)
+            if not os.path.exists(self.objectFile(sha)):
+                os.makedirs(os.path.dirname(self.objectFile(sha)), exist_ok=True)
+                tmpFile = self.objectFile(sha) + '.' + str(threading.get_ident()) + '.tmp'
+                shutil.copyfile(os.path.join(root, path), tmpFile)
+                os.replace(tmpFile, self.objectFile(sha))
+            artifacts[path] = sha
+
+        recordFile = os.path.join(self.cacheDir, 'stages', key + '.json')
+        with open(recordFile + '.tmp', 'w') as out:
+            json.dump({'stage': stage.name, 'artifacts': artifacts}, out, indent=1)
+        os.replace(recordFile + '.tmp', recordFile)
+
+    def execute(self, stage, force=False):
+        """
+        Execute a stage unless its cached artifacts are up to date
+
+        :param stage: target stage
+        :param force: whether to execute the stage regardless of its cached artifacts
+        :return: 'cached', 'restored', or 'executed'
+        """
+
+        key = self.key(stage)
+        status = 'stale' if force else self.status(stage, key)
+        if status == 'cached':
+            return 'cached'
+        if status == 'restorable':
+            self.restore(key)
+            return 'restored'
+
+        # run the script from its own folder -- stdout and stderr are logged
+        with open(os.path.join(root, self.logFile(stage)), 'w') as log:
+            result = subprocess.run([sys.executable, stage.script] + stage.args, cwd=os.path.join(root, stage.folder), stdout=log, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            print('Stage {} failed w/ exit code {} -- check {}'.format(stage.name, result.returncode, self.logFile(stage)))
+            raise Exception
+        self.store(stage, key)
+        return 'executed'
+
+    def dryRun(self, targets=None, force=False):
+        """
+        Report the stages that would be (re)executed -- stages downstream of (re)executed stages are considered stale
+
+        :param targets: list of target stage names (None for all stages)
+        :param force: whether target stages are executed regardless of their cached artifacts
+        :return: dict associating each selected stage w/ its status
+        """
+
+        selected = self.select(targets)
+        forced = set(targets if targets else selected) if force else set()
+        statuses = OrderedDict()
+        for name in selected:
+            stage = self.stages[name]
+            if name in forced or any(statuses[dep] in ['stale', 'missing'] for dep in self.deps[name]):
+                statuses[name] = 'stale'
+                continue
+            try:
+                statuses[name] = self.status(stage, self.key(stage))
+            except Exception:  # source inputs missing
+                statuses[name] = 'missing'
+        self.saveHashes()
+        return statuses
+
+    def run(self, targets=None, jobs=1, force=False):
+        """
+        Run the selected stages -- each stage is submitted as soon as its upstream stages complete, up to jobs stages at once
+
+        :param targets: list of target stage names (None for all stages)
+        :param jobs: max number of stages run in parallel
+        :param force: whether to execute target stages regardless of their cached artifacts -- upstream stages are not forced
+        :return: dict associating each selected stage w/ its outcome ('cached', 'restored', 'executed', 'failed', or 'skipped')
+        """
+
+        selected = self.select(targets)
+        forced = set(targets if targets else selected) if force else set()
+        outcomes = OrderedDict((name, None) for name in selected)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            while True:
+                # skip stages w/ failed upstream stages and submit stages w/ completed upstream stages
+                for name in selected:
+                    if outcomes[name] is not None or name in running.values():
+                        continue
+                    depOutcomes = [outcomes[dep] for dep in self.deps[name] if dep in outcomes]
+                    if any(outcome in ['failed', 'skipped'] for outcome in depOutcomes):
+                        outcomes[name] = 'skipped'
+                        print('[{}] skipped -- upstream stage failed'.format(name))
+                    elif all(outcome is not None for outcome in depOutcomes):
+                        running[executor.submit(self.execute, self.stages[name], name in forced)] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        outcomes[name] = future.result()
+                    except Exception:
+                        outcomes[name] = 'failed'
+                    print('[{}] {}'.format(name, outcomes[name]))
+                    if outcomes[name] == 'executed':
+                        with open(os.path.join(root, self.logFile(self.stages[name])), 'r') as f:
+                            print(f.read(), end='')
+
+        self.saveHashes()
+        return outcomes
+
+
+def main():
+    pipeline = Pipeline(stages)
+
+    if args.list:
+        for name in pipeline.order:
+            print('{}: {} {} (after: {})'.format(name, os.path.join(pipeline.stages[name].folder, pipeline.stages[name].script), ' '.join(pipeline.stages[name].args), ', '.join(pipeline.deps[name]) or '-'))
+        return
+
+    if args.dry:
+        for name, status in pipeline.dryRun(args.stages, args.force).items():
+            print('[{}] {}'.format(name, status))
+        return
+
+    outcomes = pipeline.run(args.stages, args.jobs, args.force)
+    failed = [name for name, outcome in outcomes.items() if outcome in ['failed', 'skipped']]
+    if failed:
+        print('Pipeline stages not completed: {}'.format(failed))
+        raise Exception
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
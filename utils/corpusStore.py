@@ -0,0 +1,291 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+
+from collections import OrderedDict
+from fileHash import hashFile
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--corpus', default='../data/corpus/fact_ranking_coll.tsv', help='Corpus file to convert.')
+parser.add_argument('--chunksize', default=1000000, type=int, help='Number of facts parsed at once.')
+
+formats = {'csv': ',', 'tsv': '\t'}
+
+# corpus columns (used downstream) and the string tables encoding them -- subjects and objects share the same table (None for plain int32 columns)
+columns = OrderedDict([('en_id', 'terms'), ('id', None), ('pred', 'predicates'), ('obj', 'terms')])
+
+
+class StringTable(object):
+    """
+    This class represents a (sorted) table of strings stored as a memory-mapped UTF-8 blob plus the offsets of each string,
+    so that codes follow the lexicographic order of strings and only the decoded strings are materialized as Python objects.
+    """
+
+    def __init__(self, prefix):
+        """
+        Initialize the table
+
+        :param prefix: table files prefix (w/o the .bytes.npy and .offsets.npy extensions)
+        """
+
+        self.blob = np.load(prefix + '.bytes.npy', mmap_mode='r')
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+
+    @staticmethod
+    def write(strings, prefix):
+        """
+        Store the strings as table files
+
+        :param strings: list of strings (in code order)
+        :param prefix: table files prefix
+        """
+
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        np.save(prefix + '.bytes.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(prefix + '.offsets.npy', offsets)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, code):
+        return self.blob[self.offsets[code]:self.offsets[code + 1]].tobytes().decode('utf-8')
+
+    def decode(self, codes):
+        """
+        Decode codes into strings -- each distinct code is decoded once
+
+        :param codes: array-like of codes (-1 for missing values)
+        :return: object array of strings aligned w/ codes (NaN for missing values)
+        """
+
+        codes = np.asarray(codes)
+        uniques, inverse = np.unique(codes, return_inverse=True)
+        values = np.empty(uniques.shape[0], dtype=object)
+        values[:] = [self[code] if code >= 0 else np.nan for code in uniques.tolist()]
+        return values[inverse.reshape(codes.shape)]
+
+    def toList(self):
+        """
+        Decode the whole table
+
+        :return: list of strings in code order
+        """
+
+        return [self[code] for code in range(len(self))]
+
+
+class CorpusStore(object):
+    """
+    This class represents the corpus stored in binary columnar format: one memory-mapped int32 array per column, where fact IDs
+    are stored as they are and strings (predicates and subject/object terms) are dictionary-encoded w/ sorted string tables.
+    Columns are loaded lazily by the OS, hence opening the store is (nearly) instant and only the accessed pages are kept in memory.
+    """
+
+    def __init__(self, storeDir):
+        """
+        Open the store
+
+        :param storeDir: folder containing the store files
+        """
+
+        self.storeDir = storeDir
+        with open(os.path.join(storeDir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.columns = OrderedDict(self.meta['columns'])
+        self.arrays = {column: np.load(os.path.join(storeDir, column + '.npy'), mmap_mode='r') for column in self.columns}
+        self.tables = {table: StringTable(os.path.join(storeDir, table)) for table in set(self.columns.values()) if table}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def codes(self, column):
+        """
+        Get the (memory-mapped) codes of a column -- i.e., the values for plain int32 columns
+
+        :param column: target column
+        :return: int32 array w/ one code per fact (-1 for missing values)
+        """
+
+        return self.arrays[column]
+
+    def table(self, column):
+        """
+        Get the string table encoding a column
+
+        :param column: target column
+        :return: string table (None for plain int32 columns)
+        """
+
+        return self.tables.get(self.columns[column])
+
+    def column(self, column, rows=None):
+        """
+        Get the decoded values of a column
+
+        :param column: target column
+        :param rows: array-like of row positions (None for all rows)
+        :return: array of values aligned w/ rows
+        """
+
+        codes = self.arrays[column] if rows is None else self.arrays[column][np.asarray(rows, dtype=np.int64)]
+        if self.columns[column] is None:
+            return np.array(codes)
+        return self.tables[self.columns[column]].decode(codes)
+
+    def toFrame(self, columns=None, rows=None):
+        """
+        Get the corpus (or part of it) as dataframe -- as if read from the original file
+
+        :param columns: list of target columns (None for all columns)
+        :param rows: array-like of row positions, used as index (None for all rows)
+        :return: corpus as pandas dataframe
+        """
+
+        columns = columns if columns else list(self.columns)
+        index = None if rows is None else pd.Index(np.asarray(rows, dtype=np.int64))
+        return pd.DataFrame({column: self.column(column, rows) for column in columns}, index=index)
+
+
+def _isFresh(file, storeDir):
+    """
+    check whether the store is up to date w/ the corpus file -- files w/ unchanged (mtime, size) are trusted,
+    otherwise their content hash is compared
+    :param file: corpus file
+    :param storeDir: folder containing the store files
+    :return: True if the store can be used, False otherwise
+    """
+
+    metaFile = os.path.join(storeDir, 'meta.json')
+    if not os.path.exists(metaFile):
+        return False
+    with open(metaFile, 'r') as f:
+        meta = json.load(f)
+
+    stat = os.stat(file)
+    if [stat.st_mtime_ns, stat.st_size] == meta['source']['stat']:
+        return True
+    if hashFile(file) != meta['source']['sha1']:  # content changed
+        return False
+    # content unchanged -- refresh stat info only
+    meta['source']['stat'] = [stat.st_mtime_ns, stat.st_size]
+    tmpFile = metaFile + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpFile, 'w') as out:
+        json.dump(meta, out)
+    os.replace(tmpFile, metaFile)
+    return True
+
+
+def convertCorpus(file, storeDir=None, chunksize=1000000):
+    """
+    convert the corpus into binary columnar format -- the corpus is parsed in chunks, strings are dictionary-encoded as they appear,
+    and codes are remapped to sorted string tables once the whole corpus has been parsed
+    :param file: input file containing collection
+    :param storeDir: output folder (defaults to file w/o extension)
+    :param chunksize: number of facts parsed at once
+    :return: the store folder
+    """
+
+    fformat = file.split('.')[-1]
+    if fformat not in formats:
+        print('Formats allowed are: {}'.format(formats.keys()))
+        raise Exception
+    storeDir = storeDir if storeDir else os.path.splitext(file)[0]
+
+    # files are written to a temporary folder (per process) and moved in place once complete
+    tmpDir = storeDir + '.' + str(os.getpid()) + '.tmp'
+    os.makedirs(tmpDir, exist_ok=True)
+
+    # first pass: parse corpus and store (unsorted) codes as raw int32 arrays
+    encoders = {table: {} for table in set(columns.values()) if table}
+    raws = {column: open(os.path.join(tmpDir, column + '.raw'), 'wb') for column in columns}
+    rows = 0
+    dtypes = {column: str for column, table in columns.items() if table}
+    for chunk in pd.read_csv(file, sep=formats[fformat], usecols=list(columns), dtype=dtypes, chunksize=chunksize):
+        for column, table in columns.items():
+            if table is None:
+                values = chunk[column].to_numpy(dtype=np.int64)
+                if values.shape[0] and (values.min() < 0 or values.max() > np.iinfo(np.int32).max):
+                    print('Values of column {} must fit int32'.format(column))
+                    raise Exception
+                codes = values.astype(np.int32)
+            else:
+                localCodes, uniques = pd.factorize(chunk[column])
+                encoder = encoders[table]
+                # missing values (local code -1) pick the trailing -1
+                mapping = np.array([encoder.setdefault(value, len(encoder)) for value in uniques.tolist()] + [-1], dtype=np.int32)
+                codes = mapping[localCodes]
+            raws[column].write(codes.tobytes())
+        rows += chunk.shape[0]
+    for raw in raws.values():
+        raw.close()
+
+    # store sorted string tables and the remapping from (unsorted) codes to sorted ones
+    remaps = {}
+    for table, encoder in encoders.items():
+        strings = list(encoder)
+        order = sorted(range(len(strings)), key=strings.__getitem__)
+        StringTable.write([strings[code] for code in order], os.path.join(tmpDir, table))
+        remap = np.full(len(strings) + 1, -1, dtype=np.int32)  # missing values pick the trailing -1
+        remap[order] = np.arange(len(strings), dtype=np.int32)
+        remaps[table] = remap
+
+    # second pass: remap codes and store columns as .npy arrays
+    for column, table in columns.items():
+        rawFile = os.path.join(tmpDir, column + '.raw')
+        array = np.lib.format.open_memmap(os.path.join(tmpDir, column + '.npy'), mode='w+', dtype=np.int32, shape=(rows,))
+        if rows:
+            raw = np.memmap(rawFile, dtype=np.int32, mode='r', shape=(rows,))
+            for start in range(0, rows, chunksize):
+                codes = raw[start:start+chunksize]
+                array[start:start+chunksize] = codes if table is None else remaps[table][codes]
+            del raw
+        array.flush()
+        del array
+        os.remove(rawFile)
+
+    # store metadata (w/ source file fingerprint)
+    stat = os.stat(file)
+    meta = {'rows': rows, 'columns': list(columns.items()), 'source': {'stat': [stat.st_mtime_ns, stat.st_size], 'sha1': hashFile(file)}}
+    with open(os.path.join(tmpDir, 'meta.json'), 'w') as out:
+        json.dump(meta, out)
+
+    # replace the previous store (if any)
+    if os.path.exists(storeDir):
+        oldDir = storeDir + '.' + str(os.getpid()) + '.old'
+        os.rename(storeDir, oldDir)
+        os.rename(tmpDir, storeDir)
+        shutil.rmtree(oldDir)
+    else:
+        os.rename(tmpDir, storeDir)
+    return storeDir
+
+
+def loadCorpus(file='../data/corpus/fact_ranking_coll.tsv', storeDir=None, chunksize=1000000):
+    """
+    load the corpus stored in binary columnar format -- the corpus is (re)converted if the store is missing or out of date
+    :param file: input file containing collection
+    :param storeDir: folder containing the store files (defaults to file w/o extension)
+    :param chunksize: number of facts parsed at once when converting
+    :return: corpus store
+    """
+
+    storeDir = storeDir if storeDir else os.path.splitext(file)[0]
+    if not _isFresh(file, storeDir):
+        convertCorpus(file, storeDir, chunksize)
+    return CorpusStore(storeDir)
+
+
+def main():
+    storeDir = convertCorpus(args.corpus, chunksize=args.chunksize)
+    print('stored {} facts in {}'.format(len(CorpusStore(storeDir)), storeDir))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,158 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from glob import glob
+from fileHash import hashFile
+
+
+class FactIndex(object):
+    """
+    This class represents the index associating each fact ID with its stratum and the (estimated) stratum accuracy.
+    Strata and stats are compiled into a dense array indexed by fact ID, persisted as a memory-mapped file
+    that is rebuilt only when the source files change.
+    """
+
+    dtype = np.dtype([('stratum', np.int32), ('estimate', np.float64), ('lowerBound', np.float64), ('upperBound', np.float64)])
+
+    def __init__(self, strataFile='../data/utility/stratifiedFacts.csv', statsPath='../data/stats/facts/', indexFile=None):
+        """
+        Initialize the index and (re)build it if the source files changed since the last build
+
+        :param strataFile: stored strata IDs
+        :param statsPath: path to estimate stats
+        :param indexFile: file storing the compiled index (defaults to strataFile w/ .index.npy extension)
+        """
+
+        self.strataFile = strataFile
+        self.statsPaths = sorted(glob(os.path.join(statsPath, 'partition*.tsv')))
+        self.indexFile = indexFile if indexFile else os.path.splitext(strataFile)[0] + '.index.npy'
+        self.metaFile = self.indexFile + '.json'
+
+        if not self._isFresh():
+            self.build()
+        self.index = np.load(self.indexFile, mmap_mode='r')
+
+    def _isFresh(self):
+        """
+        Check whether the stored index is up to date w/ the source files
+        Sources w/ unchanged (mtime, size) are trusted, otherwise their content hash is compared
+
+        :return: True if the stored index can be used, False otherwise
+        """
+
+        if not (os.path.exists(self.indexFile) and os.path.exists(self.metaFile)):
+            return False
+        with open(self.metaFile, 'r') as f:
+            meta = json.load(f)
+
+        sources = [self.strataFile] + self.statsPaths
+        if sorted(meta) != sorted(sources):  # stats files added or removed
+            return False
+
+        touched = False
+        for source in sources:
+            stat = os.stat(source)
+            if [stat.st_mtime_ns, stat.st_size] == meta[source]['stat']:
+                continue
+            if hashFile(source) != meta[source]['sha1']:  # content changed
+                return False
+            # content unchanged -- refresh stat info only
+            meta[source]['stat'] = [stat.st_mtime_ns, stat.st_size]
+            touched = True
+
+        if touched:
+            self._writeMeta(meta)
+        return True
+
+    def _writeMeta(self, meta):
+        """
+        Store the source files fingerprints
+
+        :param meta: dict associating each source file with its (mtime, size) and content hash
+        """
+
+        tmpFile = self.metaFile + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpFile, 'w') as out:
+            json.dump(meta, out)
+        os.replace(tmpFile, self.metaFile)
+
+    def build(self):
+        """
+        Compile strata and stats into the dense index and store it along w/ the source files fingerprints
+        """
+
+        # read strata file and store fact IDs within strata
+        with open(self.strataFile, 'r') as f:
+            strata = [np.array(stratum.strip().split(','), dtype=np.int64) for stratum in f if stratum.strip()]
+
+        # read stats files and store stats per stratum
+        strata2stats = {}
+        for statPath in self.statsPaths:
+            _id = int(re.search(r'partition(\d+)\.tsv$', statPath).group(1))
+            strata2stats[_id] = pd.read_csv(statPath, sep='\t').iloc[0]
+
+        # iterate over strata and associate to each fact ID the corresponding stratum and accuracy estimate (point estimate + CI)
+        size = max([stratum.max() + 1 for stratum in strata if stratum.shape[0]], default=0)
+        index = np.empty(size, dtype=self.dtype)
+        index['stratum'] = -1
+        for field in ['estimate', 'lowerBound', 'upperBound']:
+            index[field] = np.nan
+        for i, facts in enumerate(strata):
+            if (index['stratum'][facts] != -1).any() or np.unique(facts).shape[0] != facts.shape[0]:
+                print('Fact IDs must belong to exactly one stratum -- check stratum {}'.format(i))
+                raise Exception
+            index['stratum'][facts] = i
+            if i in strata2stats:
+                for field in ['estimate', 'lowerBound', 'upperBound']:
+                    index[field][facts] = strata2stats[i][field]
+
+        # store index (atomically) and source files fingerprints -- temporary files are per process, as concurrent scripts may build the index
+        tmpFile = self.indexFile + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(tmpFile, index)
+        os.replace(tmpFile, self.indexFile)
+        meta = {}
+        for source in [self.strataFile] + self.statsPaths:
+            stat = os.stat(source)
+            meta[source] = {'stat': [stat.st_mtime_ns, stat.st_size], 'sha1': hashFile(source)}
+        self._writeMeta(meta)
+
+    def fingerprint(self):
+        """
+        Get the fingerprint of the indexed source files -- i.e., the hash of their content hashes
+
+        :return: SHA-1 hex digest
+        """
+
+        with open(self.metaFile, 'r') as f:
+            meta = json.load(f)
+        return hashlib.sha1(json.dumps([[source, meta[source]['sha1']] for source in sorted(meta)]).encode('utf-8')).hexdigest()
+
+    def lookup(self, factIDs, field='estimate'):
+        """
+        Get the indexed values of the given facts -- facts not belonging to any stratum get NaN (or -1 for stratum)
+
+        :param factIDs: array-like of fact IDs
+        :param field: the field to return -- stratum, estimate, lowerBound, or upperBound
+        :return: array of values aligned w/ factIDs
+        """
+
+        factIDs = np.asarray(factIDs, dtype=np.int64)
+        known = (factIDs >= 0) & (factIDs < self.index.shape[0])
+        values = np.full(factIDs.shape, -1 if field == 'stratum' else np.nan, dtype=self.dtype[field])
+        values[known] = self.index[field][factIDs[known]]
+        return values
+
+    def strata(self):
+        """
+        Get the stats of each stratum
+
+        :return: dataframe w/ columns estimate, lowerBound, and upperBound indexed by stratum ID
+        """
+
+        stratified = np.asarray(self.index[self.index['stratum'] != -1])
+        stats = pd.DataFrame(stratified).drop_duplicates('stratum').set_index('stratum').sort_index()
+        return stats
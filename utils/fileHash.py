@@ -0,0 +1,15 @@
+import hashlib
+
+
+def hashFile(file):
+    """
+    compute the content hash of a file (read in blocks)
+    :param file: input file
+    :return: SHA-1 hex digest
+    """
+
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
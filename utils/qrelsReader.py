@@ -0,0 +1,33 @@
+import pandas as pd
+
+
+def readQrels(file):
+    """
+    read qrels and convert into dataframe
+    :param file: input qrels
+    :return: qrels as pandas dataframe
+    """
+
+    df = pd.read_csv(file, sep='\t', names=['query_id', 'entity', 'doc_id', 'relevance'])
+    return df
+
+
+# list of queries w/ all facts associated w/ the same veracity partition
+query2remove = [
+    'INEX_LD-2009111',
+    'INEX_LD-2010057',
+    'INEX_LD-20120122',
+    'INEX_LD-20120222',
+    'INEX_LD-2012319',
+    'INEX_XER-129',
+    'INEX_XER-130',
+    'INEX_XER-81',
+    'QALD2_te-48',
+    'QALD2_te-82',
+    'QALD2_te-98',
+    'SemSearch_ES-123',
+    'SemSearch_ES-66',
+    'SemSearch_ES-86',
+    'SemSearch_LS-31',
+    'SemSearch_LS-43'
+]
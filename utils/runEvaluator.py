@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from runReader import readRun
+
+# evaluator shared w/ (the runs evaluated by) each worker process
+_evaluator = None
+
+
+class RunEvaluator(object):
+    """
+    This class represents the evaluator of (many) runs against the same qrels, which are indexed once at set up.
+    Runs are evaluated at once w/ NumPy: the rows of all runs are sorted together (as done by trec_eval), each (run, query) pair
+    is a segment of the sorted rows, and every measure is a segment reduction -- so all queries are evaluated in one pass.
+    Supported measures (w/ ir_measures syntax) are nDCG (w/ or w/o cutoff), P@k, AP (i.e., MAP once aggregated), and RR.
+    """
+
+    supported = {'nDCG': ['cutoff'], 'P': ['cutoff', 'rel'], 'AP': ['cutoff', 'rel'], 'RR': ['cutoff', 'rel']}
+
+    def __init__(self, qrels):
+        """
+        Initialize the evaluator by indexing qrels
+
+        :param qrels: qrels as pandas dataframe w/ columns query_id, doc_id, and relevance
+        """
+
+        # encode judged queries and docs (sorted) -- doc IDs are compared as strings, as done by trec_eval
+        queries = qrels['query_id'].astype(str).to_numpy(dtype=object)
+        docs = qrels['doc_id'].astype(str).to_numpy(dtype=object)
+        self.queries, qCodes = np.unique(queries, return_inverse=True)
+        self.docs, dCodes = np.unique(docs, return_inverse=True)
+
+        # index relevance judgments by (query, doc) key -- queries within qrels are evaluated even when runs do not retrieve any fact for them
+        keys = qCodes.reshape(-1).astype(np.int64) * self.docs.shape[0] + dCodes.reshape(-1)
+        keys, last = np.unique(keys[::-1], return_index=True)  # keep the last judgment of duplicated (query, doc) pairs
+        self.keys = keys
+        self.relevance = qrels['relevance'].to_numpy(dtype=np.float64)[::-1][last]
+        self.qCodes = keys // max(1, self.docs.shape[0])
+
+        # store the ideal ranking of (non-negative) gains per query as segments of a single array
+        order = np.lexsort((-self.relevance, self.qCodes))
+        self.idealGains = np.maximum(self.relevance[order], 0)
+        self.idealStarts = np.searchsorted(self.qCodes[order], np.arange(self.queries.shape[0]))
+        self.idealSizes = np.bincount(self.qCodes, minlength=self.queries.shape[0])
+
+    @staticmethod
+    def _lookup(table, values):
+        """
+        Find values within a sorted table
+
+        :param table: sorted array
+        :param values: array of values to find
+        :return: array of positions within table (-1 for values not found)
+        """
+
+        positions = np.searchsorted(table, values)
+        found = positions < table.shape[0]
+        found[found] = table[positions[found]] == values[found]
+        return np.where(found, positions, -1)
+
+    def _idcg(self, cutoff):
+        """
+        Compute the ideal DCG of each judged query
+
+        :param cutoff: rank cutoff (None for no cutoff)
+        :return: array of ideal DCG indexed by query code
+        """
+
+        ranks = np.arange(self.idealGains.shape[0]) - np.repeat(self.idealStarts, self.idealSizes) + 1
+        valid = ranks <= cutoff if cutoff else np.ones(ranks.shape, dtype=bool)
+        return np.bincount(np.repeat(np.arange(self.queries.shape[0]), self.idealSizes), weights=np.where(valid, self.idealGains / np.log2(ranks + 1), 0.0), minlength=self.queries.shape[0])
+
+    def _numRel(self, rel):
+        """
+        Count the relevant facts of each judged query
+
+        :param rel: min relevance for a fact to be considered relevant
+        :return: array of counts indexed by query code
+        """
+
+        return np.bincount(self.qCodes[self.relevance >= rel], minlength=self.queries.shape[0])
+
+    def _checkMeasures(self, measures):
+        """
+        check that measures are supported
+        :param measures: list of (ir_measures) measures
+        """
+
+        for measure in measures:
+            if measure.NAME not in self.supported or any(param not in self.supported[measure.NAME] for param in measure.params):
+                print('Measure {} not supported -- supported measures are: {}'.format(measure, self.supported))
+                raise Exception
+
+    def _encode(self, run):
+        """
+        Encode the queries and docs of a run -- distinct values are converted to strings once
+
+        :param run: run as pandas dataframe w/ (at least) columns query and factID
+        :return: query codes within qrels (-1 for queries not judged), local doc codes, and distinct (string) docs
+        """
+
+        codes, uniques = pd.factorize(run['query'])
+        qCodes = np.append(self._lookup(self.queries, uniques.astype(str).to_numpy(dtype=object)), -1)[codes]
+        codes, uniques = pd.factorize(run['factID'])
+        return qCodes, codes, uniques.astype(str).to_numpy(dtype=object)
+
+    def evaluate(self, runs, measures):
+        """
+        Evaluate runs query by query
+
+        :param runs: dict associating each run name w/ its run as pandas dataframe w/ (at least) columns query, factID, and score
+        :param measures: list of (ir_measures) measures -- e.g., [nDCG@5, nDCG@10, P@5, AP, RR]
+        :return: per-query results as pandas dataframe w/ columns run, query, and one column per measure -- judged queries
+        w/o retrieved facts get the measure default value, while queries not judged are excluded
+        """
+
+        self._checkMeasures(measures)
+        names = list(runs)
+
+        # stack runs and encode their queries and docs
+        runCodes, qCodes, docInverse, docValues, scores = [], [], [], [], []
+        numDocs = 0
+        for i, name in enumerate(names):
+            run = runs[name]
+            runCodes.append(np.full(run.shape[0], i, dtype=np.int64))
+            codes, inverse, values = self._encode(run)
+            qCodes.append(codes)
+            docInverse.append(inverse + numDocs)
+            docValues.append(values)
+            numDocs += values.shape[0]
+            # scores are compared in single precision, as done by trec_eval
+            scores.append(run['score'].to_numpy(dtype=np.float32))
+        return self._evaluateRows(names, np.concatenate(runCodes), np.concatenate(qCodes), np.concatenate(docInverse), np.concatenate(docValues), np.concatenate(scores), measures)
+
+    def evaluateVariants(self, run, variants, measures):
+        """
+        Evaluate many variants of the same run -- i.e., the same (query, fact) rows scored in different ways -- query by query
+        Queries and docs are encoded once and shared by all variants, which are then ranked and evaluated in one pass
+
+        :param run: run as pandas dataframe w/ (at least) columns query and factID
+        :param variants: dict associating each variant name w/ its array of scores (aligned w/ run rows)
+        :param measures: list of (ir_measures) measures
+        :return: per-query results as pandas dataframe w/ columns run (i.e., variant), query, and one column per measure
+        """
+
+        self._checkMeasures(measures)
+        names = list(variants)
+
+        # encode queries and docs once and replicate them for each variant
+        qCodes, docInverse, docValues = self._encode(run)
+        runCodes = np.repeat(np.arange(len(names), dtype=np.int64), run.shape[0])
+        scores = np.concatenate([np.asarray(variants[name], dtype=np.float32) for name in names]) if names else np.zeros(0, dtype=np.float32)
+        return self._evaluateRows(names, runCodes, np.tile(qCodes, len(names)), np.tile(docInverse, len(names)), docValues, scores, measures)
+
+    def _evaluateRows(self, names, runCodes, qCodes, docInverse, docValues, scores, measures):
+        """
+        Evaluate the (stacked) rows of many runs query by query
+
+        :param names: list of run names, indexed by run code
+        :param runCodes: array of run codes
+        :param qCodes: array of query codes within qrels (-1 for queries not judged)
+        :param docInverse: array of doc positions within docValues
+        :param docValues: array of (string) docs -- possibly repeated
+        :param scores: array of (single precision) scores
+        :param measures: list of (ir_measures) measures
+        :return: per-query results as pandas dataframe w/ columns run, query, and one column per measure
+        """
+
+        # encode docs w/ their (string) order and their code within qrels
+        docValues, docOrder = np.unique(docValues, return_inverse=True)
+        dCodes = docOrder.reshape(-1)[docInverse]
+        jCodes = self._lookup(self.docs, docValues)[dCodes]
+
+        # keep judged queries only
+        isJudged = qCodes != -1
+        runCodes, qCodes, dCodes, jCodes, scores = runCodes[isJudged], qCodes[isJudged], dCodes[isJudged], jCodes[isJudged], scores[isJudged]
+
+        # sort rows by (run, query, score desc, doc ID desc) -- trec_eval breaks score ties by decreasing doc ID (string) order
+        order = np.lexsort((-dCodes, -scores, qCodes, runCodes))
+        runCodes, qCodes, jCodes = runCodes[order], qCodes[order], jCodes[order]
+
+        # find (run, query) segments and rank facts within them
+        numRows = order.shape[0]
+        starts = np.flatnonzero(np.r_[True, (runCodes[1:] != runCodes[:-1]) | (qCodes[1:] != qCodes[:-1])]) if numRows else np.zeros(0, dtype=np.int64)
+        sizes = np.diff(np.r_[starts, numRows])
+        segments = np.repeat(np.arange(starts.shape[0]), sizes)
+        ranks = np.arange(numRows) - np.repeat(starts, sizes) + 1
+        segQueries = qCodes[starts]
+
+        # associate each row w/ its relevance -- unjudged facts are not relevant
+        keys = np.where(jCodes != -1, qCodes * self.docs.shape[0] + jCodes, -1)
+        positions = self._lookup(self.keys, keys)
+        relevance = np.where(positions != -1, self.relevance[positions], np.nan)
+        gains = np.maximum(np.nan_to_num(relevance, nan=0), 0)
+
+        results = pd.DataFrame({'run': np.array(names, dtype=object)[runCodes[starts]], 'query': self.queries[segQueries]})
+        for measure in measures:
+            cutoff = measure.params.get('cutoff')
+            inCutoff = ranks <= cutoff if cutoff else np.ones(numRows, dtype=bool)
+            if measure.NAME == 'nDCG':
+                dcg = np.bincount(segments, weights=np.where(inCutoff, gains / np.log2(ranks + 1), 0.0), minlength=starts.shape[0])
+                idcg = self._idcg(cutoff)[segQueries]
+                values = np.divide(dcg, idcg, out=np.zeros_like(dcg), where=idcg > 0)
+            else:
+                hits = inCutoff & (np.nan_to_num(relevance, nan=-np.inf) >= measure.params.get('rel', 1))
+                if measure.NAME == 'P':
+                    values = np.bincount(segments, weights=hits, minlength=starts.shape[0]) / (cutoff if cutoff else sizes)
+                elif measure.NAME == 'AP':
+                    # precision at the rank of each relevant fact -- averaged over the relevant facts within qrels
+                    cumHits = np.cumsum(hits) - np.repeat(np.cumsum(hits)[starts] - hits[starts], sizes)
+                    precisions = np.bincount(segments, weights=np.where(hits, cumHits / ranks, 0.0), minlength=starts.shape[0])
+                    numRel = self._numRel(measure.params.get('rel', 1))[segQueries]
+                    values = np.divide(precisions, numRel, out=np.zeros_like(precisions), where=numRel > 0)
+                else:  # RR
+                    firstHits = np.minimum.reduceat(np.where(hits, ranks, np.inf), starts) if numRows else np.zeros(0)
+                    values = np.where(np.isfinite(firstHits), 1 / firstHits, 0.0)
+            results[str(measure)] = values
+
+        # add judged queries w/o retrieved facts (w/ default values) and sort results by (run, query)
+        allPairs = pd.MultiIndex.from_product([names, self.queries], names=['run', 'query'])
+        results = results.set_index(['run', 'query']).reindex(allPairs)
+        for measure in measures:
+            results[str(measure)] = results[str(measure)].fillna(measure.DEFAULT)
+        return results.reset_index()
+
+    @staticmethod
+    def aggregate(results):
+        """
+        Aggregate per-query results into per-run results -- i.e., the mean over judged queries
+
+        :param results: per-query results returned by evaluate
+        :return: per-run results as pandas dataframe indexed by run (in evaluation order) w/ one column per measure
+        """
+
+        return results.drop(columns='query').groupby('run', sort=False).mean()
+
+
+def _initWorker(evaluator):
+    """
+    store the evaluator within the worker process -- it is received once at start up rather than once per run
+    :param evaluator: the target evaluator
+    """
+
+    global _evaluator
+    _evaluator = evaluator
+
+
+def _evaluateFile(task):
+    """
+    read and evaluate a run file
+    :param task: tuple (run name, run file, measures)
+    :return: per-query results of the run
+    """
+
+    name, file, measures = task
+    return _evaluator.evaluate({name: readRun(file, scoreDtype=np.float64)}, measures)
+
+
+def evaluateFiles(evaluator, files, measures, workers=0):
+    """
+    read and evaluate many run files -- runs are spread across worker processes, each one receiving the (indexed) evaluator once
+    :param evaluator: the target evaluator
+    :param files: dict associating each run name w/ its run file
+    :param measures: list of (ir_measures) measures
+    :param workers: number of worker processes -- 0 evaluates all runs at once within the current process
+    :return: per-query results as pandas dataframe w/ columns run, query, and one column per measure
+    """
+
+    if not workers:
+        return evaluator.evaluate({name: readRun(file, scoreDtype=np.float64) for name, file in files.items()}, measures)
+    tasks = [(name, file, measures) for name, file in files.items()]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(evaluator,)) as pool:
+        return pd.concat(list(pool.map(_evaluateFile, tasks)), ignore_index=True)
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+# TREC-style run columns and their (compact) dtypes
+columns = ['query', 'entity', 'factID', 'rank', 'score', 'model']
+dtypes = {'query': 'category', 'entity': 'category', 'factID': np.int32, 'rank': np.int32, 'score': np.float32, 'model': 'category'}
+
+
+def _checkFormat(file):
+    """
+    check that the input file is a run
+    :param file: input run
+    """
+
+    fformat = file.split('.')[-1]
+    if fformat != 'run':
+        print('Format allowed is: run')
+        raise Exception
+
+
+def _compact(df, scoreDtype):
+    """
+    convert run columns into compact dtypes
+    :param df: run (block) as pandas dataframe w/ default column names
+    :param scoreDtype: dtype used for scores
+    :return: run (block) w/ compact dtypes
+    """
+
+    return df.astype({**dtypes, 'score': scoreDtype})
+
+
+def readRun(file, names=None, scoreDtype=np.float32):
+    """
+    read run and convert into dataframe w/ compact dtypes (categorical query/entity/model, int32 factID/rank)
+    :param file: input run
+    :param names: column names to use in place of the default ones (same order)
+    :param scoreDtype: dtype used for scores -- use np.float64 when score ties must match the original run
+    :return: run as pandas dataframe
+    """
+
+    _checkFormat(file)
+
+    df = pd.read_csv(file, sep='\t', names=columns, dtype={**dtypes, 'score': scoreDtype})
+    if names:
+        df.columns = names
+    return df
+
+
+def iterRun(file, names=None, scoreDtype=np.float32, chunksize=1000000):
+    """
+    read run as a stream of per-query blocks, in file order
+    Memory is bounded by the chunk size plus the largest query, rather than by the run size
+
+    :param file: input run -- rows of the same query must be contiguous
+    :param names: column names to use in place of the default ones (same order)
+    :param scoreDtype: dtype used for scores -- use np.float64 when score ties must match the original run
+    :param chunksize: number of rows parsed at once
+    :return: generator of (query, run block as pandas dataframe) pairs
+    """
+
+    _checkFormat(file)
+
+    seen = set()
+    carry = None  # rows of the (possibly incomplete) last query of the previous chunk
+
+    def emit(block):
+        query = block['query'].iat[0]
+        if query in seen:
+            print('Rows of query {} are not contiguous within {}'.format(query, file))
+            raise Exception
+        seen.add(query)
+        block = _compact(block.reset_index(drop=True), scoreDtype)
+        if names:
+            block.columns = names
+        return query, block
+
+    reader = pd.read_csv(file, sep='\t', names=columns, dtype={'query': str, 'entity': str, 'model': str}, chunksize=chunksize)
+    for chunk in reader:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        # split chunk into per-query blocks -- the last one may continue within the next chunk
+        queries = chunk['query'].to_numpy()
+        bounds = np.flatnonzero(queries[1:] != queries[:-1]) + 1
+        starts = np.r_[0, bounds]
+        ends = np.r_[bounds, chunk.shape[0]]
+        for start, end in zip(starts[:-1], ends[:-1]):
+            yield emit(chunk.iloc[start:end])
+        carry = chunk.iloc[starts[-1]:]
+
+    if carry is not None and carry.shape[0]:
+        yield emit(carry)
@@ -0,0 +1,141 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+
+def _blocks(numSamples, blockSize):
+    """
+    split samples into blocks
+    :param numSamples: total number of samples
+    :param blockSize: max number of samples per block
+    :return: generator of block sizes
+    """
+
+    for start in range(0, numSamples, blockSize):
+        yield min(blockSize, numSamples - start)
+
+
+def randomizationTest(diffs, numSamples=100000, rng=None, blockSize=10000):
+    """
+    perform the (two-sided) paired randomization test on many comparisons at once -- per-query differences are randomly sign-flipped
+    and the same sign matrix (samples x queries) is applied to all comparisons w/ a single matrix product per block
+    :param diffs: (comparisons x queries) matrix of per-query score differences
+    :param numSamples: number of random permutations
+    :param rng: numpy random generator (defaults to a fresh unseeded one)
+    :param blockSize: max number of permutations generated at once
+    :return: array of p-values, one per comparison
+    """
+
+    rng = rng if rng is not None else np.random.default_rng()
+    diffs = np.atleast_2d(np.asarray(diffs, dtype=np.float64))
+    numQueries = diffs.shape[1]
+    observed = np.abs(diffs.mean(axis=1))
+
+    # count permuted mean differences at least as extreme as the observed ones (w/ tolerance for float ties)
+    extreme = np.zeros(diffs.shape[0], dtype=np.int64)
+    for size in _blocks(numSamples, blockSize):
+        signs = rng.integers(0, 2, size=(size, numQueries), dtype=np.int8) * 2 - 1
+        permuted = np.abs(signs @ diffs.T / numQueries)
+        extreme += (permuted >= observed[None, :] - 1e-12).sum(axis=0)
+    return (extreme + 1) / (numSamples + 1)
+
+
+def bootstrapTest(diffs, numSamples=100000, alpha=0.05, rng=None, blockSize=10000):
+    """
+    perform the (two-sided) paired bootstrap test on many comparisons at once -- queries are resampled w/ replacement and the same
+    resampling weights (samples x queries) are applied to all comparisons w/ a single matrix product per block
+    Differences are shifted to zero mean to sample the null distribution, while unshifted ones provide the percentile CIs
+    :param diffs: (comparisons x queries) matrix of per-query score differences
+    :param numSamples: number of bootstrap samples
+    :param alpha: the user defined confidence level (for CIs)
+    :param rng: numpy random generator (defaults to a fresh unseeded one)
+    :param blockSize: max number of bootstrap samples generated at once
+    :return: array of p-values and (comparisons x 2) matrix of CI bounds for the mean differences
+    """
+
+    rng = rng if rng is not None else np.random.default_rng()
+    diffs = np.atleast_2d(np.asarray(diffs, dtype=np.float64))
+    numQueries = diffs.shape[1]
+    means = diffs.mean(axis=1)
+    shifted = diffs - means[:, None]
+
+    extreme = np.zeros(diffs.shape[0], dtype=np.int64)
+    samples = []
+    for size in _blocks(numSamples, blockSize):
+        # resampling weights -- i.e., num of times each query is drawn within each bootstrap sample
+        draws = rng.integers(0, numQueries, size=(size, numQueries)) + np.arange(size)[:, None] * numQueries
+        weights = np.bincount(draws.reshape(-1), minlength=size * numQueries).reshape(size, numQueries).astype(np.float64)
+        extreme += (np.abs(weights @ shifted.T / numQueries) >= np.abs(means)[None, :] - 1e-12).sum(axis=0)
+        samples.append(weights @ diffs.T / numQueries)
+    samples = np.concatenate(samples)
+    bounds = np.percentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0).T
+    return (extreme + 1) / (numSamples + 1), bounds
+
+
+def correctPValues(pvalues, method='holm'):
+    """
+    correct p-values for multiple comparisons
+    :param pvalues: array of p-values
+    :param method: correction method -- 'bonferroni', 'holm' (step-down family-wise error rate control), or 'bh' (Benjamini-Hochberg false discovery rate control)
+    :return: array of adjusted p-values
+    """
+
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    m = pvalues.shape[0]
+    if method == 'bonferroni':
+        return np.minimum(pvalues * m, 1)
+
+    if method == 'holm':  # step-down: adjusted p-values are non-decreasing w/ ascending p-values
+        order = np.argsort(pvalues, kind='stable')
+        adjusted = np.maximum.accumulate(np.minimum(pvalues[order] * (m - np.arange(m)), 1))
+    elif method == 'bh':  # step-up: adjusted p-values are non-increasing w/ descending p-values
+        order = np.argsort(pvalues, kind='stable')[::-1]
+        adjusted = np.minimum.accumulate(np.minimum(pvalues[order] * m / (m - np.arange(m)), 1))
+    else:
+        print('Correction methods allowed are: bonferroni, holm, bh')
+        raise Exception
+
+    corrected = np.empty(m)
+    corrected[order] = adjusted
+    return corrected
+
+
+def compareRuns(results, pairs=None, measures=None, numSamples=100000, alpha=0.05, correction='holm', seed=42):
+    """
+    compare runs pairwise w/ paired randomization and bootstrap tests over per-query results -- p-values are corrected
+    for multiple comparisons across all run pairs (separately for each measure)
+    :param results: per-query results as pandas dataframe w/ columns run, query, and one column per measure (as returned by RunEvaluator.evaluate)
+    :param pairs: list of (run, run) pairs to compare (None for all pairs of runs)
+    :param measures: list of measure columns to compare (None for all measures)
+    :param numSamples: number of random permutations (randomization test) and bootstrap samples (bootstrap test)
+    :param alpha: the user defined confidence level (for CIs)
+    :param correction: multiple comparison correction -- 'bonferroni', 'holm', or 'bh'
+    :param seed: random seed -- both tests reuse the same random samples for every pair and measure
+    :return: comparisons as pandas dataframe w/ one row per (measure, pair)
+    """
+
+    runs = list(pd.unique(results['run']))
+    pairs = pairs if pairs else list(itertools.combinations(runs, 2))
+    measures = measures if measures else [column for column in results.columns if column not in ['run', 'query']]
+
+    # gather per-query score differences for all (measure, pair) comparisons -- queries are aligned across runs
+    comparisons = []
+    diffs = []
+    for measure in measures:
+        scores = results.pivot(index='query', columns='run', values=measure)
+        for runA, runB in pairs:
+            comparisons.append({'measure': measure, 'runA': runA, 'runB': runB, 'meanA': scores[runA].mean(), 'meanB': scores[runB].mean()})
+            diffs.append((scores[runB] - scores[runA]).to_numpy())
+    comparisons = pd.DataFrame(comparisons)
+    diffs = np.array(diffs)
+
+    # run both tests on all comparisons at once
+    comparisons['diff'] = diffs.mean(axis=1)
+    comparisons['pRandomization'] = randomizationTest(diffs, numSamples, rng=np.random.default_rng(seed))
+    comparisons['pBootstrap'], bounds = bootstrapTest(diffs, numSamples, alpha, rng=np.random.default_rng(seed))
+    comparisons['ciLow'], comparisons['ciHigh'] = bounds[:, 0], bounds[:, 1]
+
+    # correct p-values across run pairs
+    for test in ['pRandomization', 'pBootstrap']:
+        comparisons[test + 'Adj'] = comparisons.groupby('measure', sort=False)[test].transform(lambda p: correctPValues(p.to_numpy(), correction))
+    return comparisons
@@ -0,0 +1,180 @@
+import os
+import re
+import random
+import pandas as pd
+
+from glob import glob
+
+
+class Oracle(object):
+    """
+    This class represents the (abstract) oracle providing veracity annotations for facts.
+    Annotations are requested in batches, so that annotation round-trips can be amortized.
+    """
+
+    def annotate(self, facts):
+        """
+        Perform the annotation of a batch of facts
+
+        :param facts: list of (factID, fact) pairs
+        :return: list of veracity annotations (0/1 labels) aligned w/ facts
+        """
+
+        raise NotImplementedError
+
+
+class InteractiveOracle(Oracle):
+    """
+    This class represents the interactive oracle, where a human annotator labels facts via standard input.
+    """
+
+    def __init__(self):
+        """
+        Initialize the oracle
+        """
+
+        self.prompted = False
+
+    @staticmethod
+    def annotateFact(factID, fact):
+        """
+        Perform fact annotation
+        :param factID: id of target fact
+        :param fact: the target fact (s, p, o)
+        :return: veracity annotation (0/1 label)
+        """
+
+        userInput = input("{}\t{}:".format(factID, fact))
+        # validate user input
+        while userInput not in ['0', '1']:
+            print('Invalid input. Please, enter 0 for incorrect and 1 for correct.')
+            userInput = input("{}\t{}:".format(factID, fact))
+
+        # store annotation
+        annotation = int(userInput)
+        return annotation
+
+    def annotate(self, facts):
+        """
+        Perform the annotation of a batch of facts by prompting the annotator fact by fact -- instructions are printed once
+
+        :param facts: list of (factID, fact) pairs
+        :return: list of veracity annotations (0/1 labels) aligned w/ facts
+        """
+
+        if not self.prompted:  # print instructions once
+            print('Annotate facts w/ 0 for incorrect and 1 for correct.')
+            self.prompted = True
+        return [self.annotateFact(factID, fact) for factID, fact in facts]
+
+
+class ReplayOracle(Oracle):
+    """
+    This class represents the replay oracle, where annotations stored by previous evaluations are returned.
+    Facts w/o stored annotations are delegated to the fallback oracle (if any).
+    """
+
+    def __init__(self, annotationsPath='../data/annotations/facts/', fallback=None):
+        """
+        Initialize the oracle and load stored annotations in memory
+
+        :param annotationsPath: path to stored annotations (partition*.tsv files)
+        :param fallback: oracle used for facts w/o stored annotations (None to raise an error)
+        """
+
+        self.fallback = fallback
+        self.annotations = {}
+
+        annotationsPaths = sorted(glob(os.path.join(annotationsPath, 'partition*.tsv')), key=lambda path: int(re.search(r'partition(\d+)\.tsv$', path).group(1)))
+        for annotationPath in annotationsPaths:
+            annotations = pd.read_csv(annotationPath, sep='\t')
+            self.annotations.update(zip(annotations['id'].tolist(), annotations['veracity'].tolist()))
+
+    def annotate(self, facts):
+        """
+        Perform the annotation of a batch of facts by returning their stored annotations -- facts w/o stored annotations
+        are annotated by the fallback oracle in a single batch, and their annotations are kept for later requests
+
+        :param facts: list of (factID, fact) pairs
+        :return: list of veracity annotations (0/1 labels) aligned w/ facts
+        """
+
+        # delegate facts w/o stored annotations to fallback
+        missing = [(factID, fact) for factID, fact in facts if factID not in self.annotations]
+        if missing:
+            if self.fallback is None:
+                print('No stored annotation for facts {}'.format([factID for factID, _ in missing]))
+                raise Exception
+            self.annotations.update(zip([factID for factID, _ in missing], self.fallback.annotate(missing)))
+        return [self.annotations[factID] for factID, _ in facts]
+
+
+class SimulatedOracle(Oracle):
+    """
+    This class represents the simulated oracle, where annotations are drawn from a (known or synthetic) ground truth
+    and then flipped w/ the given error rate to simulate annotators' mistakes.
+    """
+
+    def __init__(self, truth=None, accuracy=0.5, errorRate=0.0, rng=random):
+        """
+        Initialize the oracle
+
+        :param truth: dict associating fact IDs w/ their true veracity -- facts not in truth are correct w/ probability accuracy
+        :param accuracy: probability that facts not in truth are correct
+        :param errorRate: probability that the annotator returns the wrong label
+        :param rng: random number generator exposing random (defaults to the random module)
+        """
+
+        self.truth = truth if truth is not None else {}
+        self.accuracy = accuracy
+        self.errorRate = errorRate
+        self.rng = rng
+
+    def annotate(self, facts):
+        """
+        Perform the annotation of a batch of facts by reading their ground truth and flipping it w/ the error rate --
+        the synthetic ground truth of facts not in truth is drawn once and cached, so that repeated requests are consistent
+
+        :param facts: list of (factID, fact) pairs
+        :return: list of veracity annotations (0/1 labels) aligned w/ facts
+        """
+
+        annotations = []
+        for factID, _ in facts:
+            if factID not in self.truth:  # draw synthetic ground truth (once per fact)
+                self.truth[factID] = int(self.rng.random() < self.accuracy)
+            annotation = self.truth[factID]
+            if self.rng.random() < self.errorRate:  # simulate annotation error
+                annotation = 1 - annotation
+            annotations.append(annotation)
+        return annotations
+
+
+class CallbackOracle(Oracle):
+    """
+    This class represents the callback oracle, where batches of facts are forwarded to an external labeling tool.
+    """
+
+    def __init__(self, callback):
+        """
+        Initialize the oracle
+
+        :param callback: function taking a list of (factID, fact) pairs and returning the list of their 0/1 labels
+        """
+
+        self.callback = callback
+
+    def annotate(self, facts):
+        """
+        Perform the annotation of a batch of facts by forwarding the whole batch to the callback -- the returned labels are validated
+
+        :param facts: list of (factID, fact) pairs
+        :return: list of veracity annotations (0/1 labels) aligned w/ facts
+        """
+
+        annotations = [int(annotation) for annotation in self.callback(facts)]
+        # validate returned annotations
+        if len(annotations) != len(facts) or any(annotation not in [0, 1] for annotation in annotations):
+            print('The callback must return one 0/1 label per fact.')
+            raise Exception
+        return annotations
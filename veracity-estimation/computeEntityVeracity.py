@@ -1,12 +1,13 @@
 import os
+import sys
 import numpy as np
 import pandas as pd
 
-from glob import glob
 from scipy import stats
 
-
-formats = {'csv': ',', 'tsv': '\t'}
+sys.path.append('../utils')
+from factIndex import FactIndex
+from corpusStore import loadCorpus
 
 
 class Estimator(object):
@@ -68,88 +69,73 @@ class Estimator(object):
         moe = self.z * (var ** 0.5)
         return moe
 
+    def computeSegmentStats(self, values, groups):
+        """
+        Compute mean, sample variance, and MoE for every group at once w/ sorted-segment reductions
 
-def readData(file):
-    """
-    read dataset and convert into dataframe
-    :param file: input file containing collection
-    :return: dataset as pandas dataframe
-    """
+        :param values: array of values (e.g., triple accuracy estimates)
+        :param groups: array of (non-negative integer) group codes aligned w/ values
+        :return: per-group means, sample variances, and MoEs -- indexed by group code
+        """
 
-    fformat = file.split('.')[-1]
-    if fformat not in formats:
-        print('Formats allowed are: {}'.format(formats.keys()))
-        raise Exception
+        values = np.asarray(values, dtype=np.float64)
+        groups = np.asarray(groups, dtype=np.int64)
 
-    df = pd.read_csv(file, sep=formats[fformat])
-    return df
+        # sort values by group and find group segments
+        order = np.argsort(groups, kind='stable')
+        values = values[order]
+        segments = groups[order]
+        starts = np.flatnonzero(np.r_[True, segments[1:] != segments[:-1]])
+        n = np.diff(np.r_[starts, segments.shape[0]])
 
+        # compute means
+        means = np.add.reduceat(values, starts) / n
 
-def fact2estimate(strataFile, annotPath):
-    """
-    associate each fact to the (estimated) partition accuracy
-    :param strataFile: stored strata IDs
-    :param annotPath: path to estimate stats
-    :return: dict associating each fact ID with the corresponding partition estimate
-    """
+        # compute variances -- set to inf for groups w/ a single value
+        sqDevs = np.add.reduceat((values - np.repeat(means, n)) ** 2, starts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.where(n > 1, (1 / (n * (n - 1))) * sqDevs, np.inf)
 
-    # read strata file and store fact IDs within strata
-    with open(strataFile, 'r') as f:
-        strata = f.readlines()
-    strata = [stratum.strip().split(',') for stratum in strata]
-    strata = [[int(_id) for _id in stratum] for stratum in strata]
-
-    # set vars
-    strata2stats = {}
-    fact2est = {}
-
-    # read stats files
-    statsPaths = glob(annotPath+'/partition*')
-    # iterate over files and store stats info:
-    for statPath in statsPaths:
-        # get partition id
-        _id = int(statPath.split('.tsv')[0][-1])
-        df = pd.read_csv(statPath, sep='\t')
-        strata2stats[_id] = df.values.tolist()
-
-    # iterate over strata and associate to each fact ID the corresponding accuracy estimate (point estimate + CI)
-    for i, facts in enumerate(strata):
-        for fact in facts:
-            if fact in fact2est:
-                print('oh oh, this should not happen!')
-                raise Exception
-            fact2est[fact] = strata2stats[i]
-
-    # return dict
-    return fact2est
+        # compute the margins of error (i.e., z * sqrt(var))
+        moe = self.z * (var ** 0.5)
+
+        # scatter stats back to group codes
+        numGroups = segments[-1] + 1 if segments.shape[0] else 0
+        stats = []
+        for stat in [means, var, moe]:
+            byGroup = np.full(numGroups, np.nan)
+            byGroup[segments[starts]] = stat
+            stats.append(byGroup)
+        return tuple(stats)
 
 
 def main():
     # set estimator
     estimator = Estimator()
 
-    # read data
-    df = readData('../data/corpus/fact_ranking_coll.tsv')
+    # load corpus in binary columnar format -- converted on first use
+    corpus = loadCorpus('../data/corpus/fact_ranking_coll.tsv')
     # read fact accuracy estimates
-    f2e = fact2estimate('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
+    f2e = FactIndex('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
+
+    # get fact accuracy estimates
+    accEstimates = f2e.lookup(corpus.codes('id'), 'estimate')
 
-    # create new columns for data
-    df['accEstimate'] = df['id'].map(lambda x: f2e.get(x, [None])[0][0])
+    # encode (query) entities -- term codes follow the sorted order of entities, as w/ groupby
+    subjCodes = np.asarray(corpus.codes('en_id'))
+    grouped = subjCodes != -1
+    entityCodes, codes = np.unique(subjCodes[grouped], return_inverse=True)
+    entities = corpus.table('en_id').decode(entityCodes)
 
-    # group by (query) entity
-    dfQuery = df.groupby('en_id')
+    # compute entity veracity (mean and MoE) w/ segment reductions
+    mean, _, moe = estimator.computeSegmentStats(accEstimates[grouped], codes)
 
     # create output dir
     os.makedirs('../data/stats/entities/', exist_ok=True)
 
-    with open('../data/stats/entities/entityVeracity.tsv', 'w') as out:  # store entity veracity
-        out.write('entity\tmean\tmoe\n')
-        # iterate over each query
-        for query, triples in dfQuery:
-            mean = estimator.estimate(triples['accEstimate'])
-            moe = estimator.computeMoE(triples['accEstimate'])
-            # store compute data
-            out.write('{}\t{}\t{}\n'.format(query, mean, moe))
+    # store entity veracity
+    veracity = pd.DataFrame({'entity': entities, 'mean': mean, 'moe': moe})
+    veracity.to_csv('../data/stats/entities/entityVeracity.tsv', sep='\t', index=False, na_rep='nan')
 
 
 if __name__ == "__main__":
@@ -1,61 +1,60 @@
-import requests
-import pandas as pd
+import sys
+import asyncio
+import argparse
+import numpy as np
 
-from tqdm import tqdm
-from bs4 import BeautifulSoup
+from popularityStore import openStore
+from popularityFetcher import GoogleBackend, PopularityFetcher
 
-formats = {'csv': ',', 'tsv': '\t'}
+sys.path.append('../utils')
+from corpusStore import loadCorpus
 
 
-def readData(file):
-    """
-    read dataset and convert into dataframe
-    :param file: input file containing collection
-    :return: dataset as pandas dataframe
-    """
-
-    fformat = file.split('.')[-1]
-    if fformat not in formats:
-        print('Formats allowed are: {}'.format(formats.keys()))
-        raise Exception
-
-    df = pd.read_csv(file, sep=formats[fformat])
-    return df
+parser = argparse.ArgumentParser()
+parser.add_argument('--url', default='https://www.google.com/search', help='Search endpoint used to fetch entity popularity.')
+parser.add_argument('--concurrency', default=8, type=int, help='Max number of concurrent requests.')
+parser.add_argument('--rate', default=1.0, type=float, help='Max number of requests per second.')
+parser.add_argument('--retries', default=5, type=int, help='Max number of retries per entity.')
+parser.add_argument('--retryMissed', action='store_true', help='Whether to fetch again the entities w/o counts.')
+parser.add_argument('--ttl', default=None, type=float, help='Max age (in days) of stored counts -- older counts are fetched again (never by default).')
 
 
 def main():
-    # read data
-    df = readData('../data/corpus/fact_ranking_coll.tsv')
-    # get subj and obj entities from the collection
-    subj = set(df['en_id'].tolist())
-    obj = df['obj'].tolist()
+    # load corpus in binary columnar format -- converted on first use
+    corpus = loadCorpus('../data/corpus/fact_ranking_coll.tsv')
+    # get subj and obj entities from the collection -- each term is decoded once
+    terms = corpus.table('en_id')
+    subjCodes = corpus.codes('en_id')
+    objCodes = corpus.codes('obj')
+    subj = set(terms.decode(np.unique(subjCodes[subjCodes >= 0])).tolist())
+    obj = terms.decode(np.unique(objCodes[objCodes >= 0])).tolist()
     obj = set([o for o in obj if o[:9] == '<dbpedia:'])
     # gather all entities together and remove unnecessary synthax
     ents = subj.union(obj)
     ents = [(' '.join(e[9:].split('_')), e) for e in ents]
     ents = [(e[0][:-1], e[1]) for e in ents]
-    # read entities that have been parsed already
-    with open('../data/utility/searchCounts.txt', 'r') as f:
-        searchEnts = f.readlines()
-    searchEnts = [e.split('\t') for e in searchEnts]
-    searchEnts = {e[0]: e[1] for e in searchEnts}
-    # perform (google) search based on entities
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.149 Safari/537.36"}
-    with open('../utility/searchCounts.txt', 'a') as out:
-        for e in tqdm(ents):
-            if e[1] in searchEnts:
-                continue
-            url = "https://www.google.com/search?q="+e[0]
-            result = requests.get(url, headers=headers)
-            soup = BeautifulSoup(result.content, 'html.parser')
-            result_stats_div = soup.find("div", {"id": "result-stats"})
-            if result_stats_div:  # found num of results within html page
-                countText = result_stats_div.find(text=True, recursive=False)  # give the full text
-                count = ''.join([num for num in countText if num.isdigit()])  # clean and remove all chars that are not number
-                out.write(e[1]+'\t'+count+'\n')
-            else:  # not found -- (likely due to) low num of results
-                print(e[0], e[1])  # show them and (for now) manually retrieve the total num
+    # open popularity store -- initialized w/ the search counts stored in TSV format (if any)
+    store = openStore('../data/utility/searchCounts.db', '../data/utility/searchCounts.txt')
+    # perform (google) search based on entities -- entities that have been parsed already are skipped (unless stale)
+    backend = GoogleBackend(url=args.url, poolSize=args.concurrency)
+    fetcher = PopularityFetcher(backend, store, concurrency=args.concurrency, rate=args.rate, retries=args.retries)
+    try:
+        stats = asyncio.run(fetcher.run(ents, ttl=args.ttl * 86400 if args.ttl else None, retryMissed=args.retryMissed))
+    except KeyboardInterrupt:  # progress is stored as it goes -- rerun to resume
+        print('Interrupted -- fetched counts are stored, rerun to resume.')
+        return
+    finally:
+        backend.close()
+        # export search counts in TSV format
+        store.exportTSV('../data/utility/searchCounts.txt')
+        store.close()
+    print('found={} missed={} failed={}'.format(stats['found'], stats['missed'], stats['failed']))
+    if stats['missed']:  # (likely due to) low num of results -- (for now) manually retrieve the total num
+        print('entities w/o counts are stored w/ NULL count in ../data/utility/searchCounts.db')
+    for entity, error in stats['failures']:  # fetched again on next run
+        print(entity, error)
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main()
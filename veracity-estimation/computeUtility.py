@@ -1,66 +1,169 @@
+import sys
+import argparse
+import numpy as np
 import pandas as pd
 
-formats = {'csv': ',', 'tsv': '\t'}
+from popularityStore import openStore
 
+sys.path.append('../utils')
+from corpusStore import loadCorpus
 
-def readData(file):
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--utility', default='sum', choices=['sum', 'logsum', 'max', 'degree'], help='Function combining subject and object popularity into fact utility.')
+parser.add_argument('--chunksize', default=1000000, type=int, help='Number of facts processed at once.')
+
+
+def sumUtility(subjCounts, objCounts, subjDegrees, objDegrees):
     """
-    read dataset and convert into dataframe
-    :param file: input file containing collection
-    :return: dataset as pandas dataframe
+    compute fact utility as popularity(subject)+popularity(object)
+    :param subjCounts: array of subject popularity
+    :param objCounts: array of object popularity (0 for objects w/o popularity -- e.g., literals)
+    :param subjDegrees: array of subject degree (num of facts involving the subject)
+    :param objDegrees: array of object degree (num of facts involving the object)
+    :return: array of fact utility
     """
 
-    fformat = file.split('.')[-1]
-    if fformat not in formats:
-        print('Formats allowed are: {}'.format(formats.keys()))
-        raise Exception
+    return subjCounts + objCounts
+
+
+def logSumUtility(subjCounts, objCounts, subjDegrees, objDegrees):
+    """
+    compute fact utility as log(1+popularity(subject))+log(1+popularity(object)) -- dampens extremely popular entities
+    :param subjCounts: array of subject popularity
+    :param objCounts: array of object popularity (0 for objects w/o popularity -- e.g., literals)
+    :param subjDegrees: array of subject degree (num of facts involving the subject)
+    :param objDegrees: array of object degree (num of facts involving the object)
+    :return: array of fact utility
+    """
+
+    return np.log1p(subjCounts) + np.log1p(objCounts)
+
+
+def maxUtility(subjCounts, objCounts, subjDegrees, objDegrees):
+    """
+    compute fact utility as max(popularity(subject), popularity(object))
+    :param subjCounts: array of subject popularity
+    :param objCounts: array of object popularity (0 for objects w/o popularity -- e.g., literals)
+    :param subjDegrees: array of subject degree (num of facts involving the subject)
+    :param objDegrees: array of object degree (num of facts involving the object)
+    :return: array of fact utility
+    """
+
+    return np.maximum(subjCounts, objCounts)
+
+
+def degreeUtility(subjCounts, objCounts, subjDegrees, objDegrees):
+    """
+    compute fact utility as popularity(subject)/degree(subject)+popularity(object)/degree(object) -- i.e., entity popularity
+    is spread across the facts involving the entity
+    :param subjCounts: array of subject popularity
+    :param objCounts: array of object popularity (0 for objects w/o popularity -- e.g., literals)
+    :param subjDegrees: array of subject degree (num of facts involving the subject)
+    :param objDegrees: array of object degree (num of facts involving the object)
+    :return: array of fact utility
+    """
 
-    df = pd.read_csv(file, sep=formats[fformat])
-    return df
+    return subjCounts / subjDegrees + objCounts / objDegrees
 
 
-def readSearchCounts(file):
+# utility functions -- the ones w/ degrees require an additional pass over the corpus
+utilities = {'sum': (sumUtility, False), 'logsum': (logSumUtility, False), 'max': (maxUtility, False), 'degree': (degreeUtility, True)}
+
+
+def computePopularity(corpus, store):
+    """
+    compute the popularity of the (subject/object) terms of the corpus -- entity popularity is looked up once per term
+    :param corpus: corpus store
+    :param store: popularity store
+    :return: array of term popularity indexed by term code (NaN for terms w/o popularity -- e.g., literals) -- the trailing
+    entry (NaN) is picked by missing terms (code -1)
+    """
+
+    terms = corpus.table('en_id')
+    subjCodes = corpus.codes('en_id')
+    objCodes = corpus.codes('obj')
+    # look up only the terms that occur in the corpus
+    used = np.flatnonzero(np.bincount(np.concatenate([subjCodes[subjCodes >= 0], objCodes[objCodes >= 0]]), minlength=len(terms)))
+    usedTerms = terms.decode(used).tolist()
+    counts = store.getMany(usedTerms)
+    popularity = np.full(len(terms) + 1, np.nan)
+    popularity[used] = [counts.get(term, np.nan) for term in usedTerms]
+    return popularity
+
+
+def computeDegrees(corpus):
+    """
+    compute the degree (num of facts involving the term as subject or object) of the terms of the corpus
+    :param corpus: corpus store
+    :return: array of term degrees indexed by term code -- the trailing entry (0) is picked by missing terms (code -1)
+    """
+
+    numTerms = len(corpus.table('en_id')) + 1
+    subjCodes = corpus.codes('en_id')
+    objCodes = corpus.codes('obj')
+    return np.bincount(subjCodes[subjCodes >= 0], minlength=numTerms) + np.bincount(objCodes[objCodes >= 0], minlength=numTerms)
+
+
+def computeUtility(corpus, start, end, popularity, utility=sumUtility, degrees=None):
     """
-    read search counts and convert them into dictionary
-    :param file: input file containing search counts
-    :return: search counts as dict
+    compute the (unnormalized) utility of a chunk of facts -- entity popularity is gathered by term code
+    :param corpus: corpus store
+    :param start: first fact (position) of the chunk
+    :param end: last fact (position, excluded) of the chunk
+    :param popularity: array of term popularity indexed by term code
+    :param utility: utility function
+    :param degrees: array of term degrees indexed by term code (None if not required by utility)
+    :return: array of fact utility
     """
 
-    with open(file, 'r') as f:
-        searchCounts = f.readlines()
-    searchCounts = [sC.strip().split('\t') for sC in searchCounts]
-    searchCounts = {sC[0]: int(sC[1]) for sC in searchCounts}
-    return searchCounts
+    # gather subject and object popularity
+    subjCodes = np.asarray(corpus.codes('en_id')[start:end])
+    objCodes = np.asarray(corpus.codes('obj')[start:end])
+    subjCounts = popularity[subjCodes]
+    objCounts = np.nan_to_num(popularity[objCodes], nan=0)
+
+    # sanity check -- subjects must have popularity
+    if np.isnan(subjCounts).any():
+        print('Missing search counts for subjects: {}'.format(pd.unique(corpus.table('en_id').decode(subjCodes[np.isnan(subjCounts)])).tolist()))
+        raise Exception
+
+    subjDegrees = objDegrees = None
+    if degrees is not None:
+        subjDegrees = degrees[subjCodes]
+        objDegrees = degrees[objCodes]
+    return utility(subjCounts, objCounts, subjDegrees, objDegrees)
 
 
 def main():
-    # read data
-    df = readData('../data/corpus/fact_ranking_coll.tsv')
-    # get id and (subj, pred, obj) facts from the collections
-    _ids = df['id'].tolist()
-    subj = df['en_id'].tolist()
-    pred = df['pred'].tolist()
-    obj = df['obj'].tolist()
-    # read search counts
-    search2count = readSearchCounts('../data/utility/searchCounts.txt')
-    # iterate over facts and compute utility as utility(subject)+utility(object) -- here utility == popularity
-    f2u = {}
-    for s, p, o in zip(subj, pred, obj):
-        f2u[(s, p, o)] = search2count[s]
-        if o in search2count:
-            f2u[(s, p, o)] += search2count[o]
-    # normalize fact utility using min-max normalization
-    minU = min(f2u.values())
-    maxU = max(f2u.values())
-    f2u = {f: (u-minU)/(maxU-minU) for f, u in f2u.items()}
-    # associate each fact utility w/ orig id in collection
-    f2id = {(s, p, o): _id for _id, s, p, o in zip(_ids, subj, pred, obj)}
-    # store normalized fact utilities
+    utility, needsDegrees = utilities[args.utility]
+    # load corpus in binary columnar format -- converted on first use
+    corpus = loadCorpus('../data/corpus/fact_ranking_coll.tsv', chunksize=args.chunksize)
+
+    with openStore('../data/utility/searchCounts.db', '../data/utility/searchCounts.txt') as store:
+        popularity = computePopularity(corpus, store)
+    # count term degrees (if required)
+    degrees = computeDegrees(corpus) if needsDegrees else None
+
+    # first pass: compute min and max utility for min-max normalization
+    chunks = [(start, min(start + args.chunksize, len(corpus))) for start in range(0, len(corpus), args.chunksize)]
+    minU = np.inf
+    maxU = -np.inf
+    for start, end in chunks:
+        u = computeUtility(corpus, start, end, popularity, utility, degrees)
+        minU = min(minU, u.min())
+        maxU = max(maxU, u.max())
+
+    # second pass: normalize fact utility and store it -- one row per fact, in corpus order
     with open('../data/utility/factUtility.tsv', 'w') as out:
         out.write('id\tsubj\tpred\tobj\tutility\n')
-        for f, u in f2u.items():
-            out.write(str(f2id[f])+'\t'+f[0]+'\t'+f[1]+'\t'+f[2]+'\t'+str(u)+'\n')
+        for start, end in chunks:
+            u = (computeUtility(corpus, start, end, popularity, utility, degrees) - minU) / (maxU - minU)
+            rows = np.arange(start, end)
+            columns = [map(str, corpus.column('id', rows).tolist())] + [corpus.column(column, rows).tolist() for column in ['en_id', 'pred', 'obj']] + [map(str, u.tolist())]
+            out.write(''.join([row + '\n' for row in map('\t'.join, zip(*columns))]))
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main()
@@ -0,0 +1,223 @@
+import time
+import random
+import asyncio
+import requests
+
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+
+class TokenBucket(object):
+    """
+    This class represents the token bucket used to rate limit requests: tokens are refilled at a constant rate
+    up to the bucket capacity, and each request consumes one token (waiting for it when the bucket is empty).
+    """
+
+    def __init__(self, rate, capacity=1):
+        """
+        Initialize the bucket (full)
+
+        :param rate: number of tokens refilled per second
+        :param capacity: max number of tokens -- i.e., max burst of requests
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Consume one token, waiting for its refill if required
+        """
+
+        async with self.lock:
+            while True:
+                # refill tokens based on elapsed time
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SearchBackend(object):
+    """
+    This class represents the (abstract) backend providing the popularity (i.e., num of search results) of entities.
+    """
+
+    async def fetch(self, query):
+        """
+        Fetch the popularity of the query
+
+        :param query: the search query (i.e., entity name)
+        :return: the num of search results as string of digits, or None when the backend provides no count -- transient
+        failures (e.g., connection errors, throttling) must be raised as exceptions to be retried
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the backend resources
+        """
+
+        pass
+
+
+class GoogleBackend(SearchBackend):
+    """
+    This class represents the (Google) web search backend -- the num of results is parsed from the result stats of the HTML page.
+    Requests are issued on a pooled (keep-alive) session from worker threads.
+    """
+
+    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.149 Safari/537.36"}
+
+    def __init__(self, url='https://www.google.com/search', poolSize=8, timeout=10):
+        """
+        Initialize the backend and its connection pool
+
+        :param url: the search endpoint -- e.g., point it to a local stub server for testing
+        :param poolSize: max number of pooled connections
+        :param timeout: request timeout (in seconds)
+        """
+
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _get(self, query):
+        """
+        Perform the (blocking) search request and parse the num of results
+
+        :param query: the search query (i.e., entity name)
+        :return: the num of search results as string of digits, or None when not found
+        """
+
+        result = self.session.get(self.url, params={'q': query}, headers=self.headers, timeout=self.timeout)
+        result.raise_for_status()  # throttling and server errors are retried
+        soup = BeautifulSoup(result.content, 'html.parser')
+        result_stats_div = soup.find("div", {"id": "result-stats"})
+        if not result_stats_div:  # not found -- (likely due to) low num of results
+            return None
+        countText = result_stats_div.find(string=True, recursive=False)  # give the full text
+        count = ''.join([num for num in countText if num.isdigit()])  # clean and remove all chars that are not number
+        return count if count else None
+
+    async def fetch(self, query):
+        return await asyncio.to_thread(self._get, query)
+
+    def close(self):
+        self.session.close()
+
+
+class PopularityFetcher(object):
+    """
+    This class represents the concurrent, rate-limited, and resumable fetcher of entity popularity.
+    Fetched counts (and entities w/o counts) are upserted in small batches to the popularity store as they become available --
+    stored entities are skipped unless stale, so interrupted crawls resume where they stopped.
+    """
+
+    def __init__(self, backend, store, concurrency=8, rate=1.0, burst=1, retries=5, backoff=1.0, maxBackoff=60.0, batchSize=32):
+        """
+        Initialize the fetcher
+
+        :param backend: the search backend
+        :param store: the popularity store
+        :param concurrency: max number of in-flight requests
+        :param rate: max number of requests per second
+        :param burst: max number of requests issued at once
+        :param retries: max number of retries per entity
+        :param backoff: base delay (in seconds) of the exponential backoff
+        :param maxBackoff: max delay (in seconds) between retries
+        :param batchSize: number of fetched entities upserted at once
+        """
+
+        self.backend = backend
+        self.store = store
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.batchSize = batchSize
+
+    def pending(self, ents, ttl=None, retryMissed=False):
+        """
+        Get the entities that require (re)fetching
+
+        :param ents: list of (query, entity) pairs
+        :param ttl: max age (in seconds) of stored counts (None to never refresh them)
+        :param retryMissed: whether entities w/o counts are fetched again
+        :return: list of (query, entity) pairs not stored, stale, or (optionally) missed
+        """
+
+        stale = self.store.stale([entity for _, entity in ents], ttl, retryMissed)
+        return [(query, entity) for query, entity in ents if entity in stale]
+
+    async def _fetch(self, bucket, query):
+        """
+        Fetch the popularity of the query, retrying failures w/ exponential backoff and full jitter
+
+        :param bucket: the token bucket used for rate limiting
+        :param query: the search query
+        :return: the num of search results as string of digits, or None when not found
+        """
+
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            try:
+                return await self.backend.fetch(query)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt)))
+
+    async def run(self, ents, ttl=None, retryMissed=False):
+        """
+        Fetch the popularity of the given entities
+
+        :param ents: list of (query, entity) pairs
+        :param ttl: max age (in seconds) of stored counts (None to never refresh them)
+        :param retryMissed: whether entities w/o counts are fetched again
+        :return: fetching statistics as dict w/ num of found, missed, and failed entities (plus the list of failed ones)
+        """
+
+        queue = asyncio.Queue()
+        for ent in self.pending(ents, ttl, retryMissed):
+            queue.put_nowait(ent)
+        bucket = TokenBucket(self.rate, self.burst)
+        stats = {'found': 0, 'missed': 0, 'failed': 0, 'failures': []}
+        fetched = []
+
+        async def worker():
+            while True:
+                try:
+                    query, entity = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    count = await self._fetch(bucket, query)
+                except Exception as e:  # give up -- the entity is fetched again on next run
+                    stats['failed'] += 1
+                    stats['failures'].append((entity, repr(e)))
+                    continue
+                stats['found' if count is not None else 'missed'] += 1
+                # store progress in batches
+                fetched.append((entity, count))
+                if len(fetched) >= self.batchSize:
+                    self.store.upsert(fetched)
+                    fetched.clear()
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+        finally:  # store progress (also when interrupted)
+            self.store.upsert(fetched)
+        return stats
@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import json
+import sqlite3
+
+sys.path.append('../utils')
+from fileHash import hashFile
+
+
+class PopularityStore(object):
+    """
+    This class represents the persistent store of entity popularity (i.e., search counts), backed by an embedded SQLite database.
+    Entities are indexed for fast lookups, counts are upserted in batches w/ their fetch timestamps (to refresh stale ones),
+    and concurrent writers are serialized by SQLite (WAL mode) -- each process/thread should use its own store instance.
+    Entities w/o counts (i.e., missed by the search backend) are stored w/ NULL count.
+    The fingerprints of the TSV files imported into (or exported from) the store are kept, so that changed files can be re-imported.
+    """
+
+    def __init__(self, dbFile='../data/utility/searchCounts.db', timeout=60):
+        """
+        Initialize the store and create its schema if required
+
+        :param dbFile: database file
+        :param timeout: max time (in seconds) waited for locks held by concurrent writers
+        """
+
+        self.dbFile = dbFile
+        self.conn = sqlite3.connect(dbFile, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS counts (entity TEXT NOT NULL UNIQUE, count INTEGER, fetched REAL NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS sources (file TEXT NOT NULL UNIQUE, stat TEXT NOT NULL, sha1 TEXT NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Close the database connection
+        """
+
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM counts').fetchone()[0]
+
+    def get(self, entity):
+        """
+        Get the popularity of an entity
+
+        :param entity: target entity
+        :return: the entity search count (None if missing or missed)
+        """
+
+        row = self.conn.execute('SELECT count FROM counts WHERE entity = ?', (entity,)).fetchone()
+        return row[0] if row else None
+
+    def getMany(self, entities, batchSize=500):
+        """
+        Get the popularity of many entities at once
+
+        :param entities: iterable of target entities
+        :param batchSize: number of entities looked up per query
+        :return: dict associating stored entities w/ their search counts -- entities w/o counts are excluded
+        """
+
+        entities = list(dict.fromkeys(entities))
+        counts = {}
+        for start in range(0, len(entities), batchSize):
+            batch = entities[start:start+batchSize]
+            rows = self.conn.execute('SELECT entity, count FROM counts WHERE count IS NOT NULL AND entity IN ({})'.format(','.join('?' * len(batch))), batch)
+            counts.update(rows)
+        return counts
+
+    def asDict(self):
+        """
+        Get the popularity of all the stored entities
+
+        :return: dict associating entities w/ their search counts -- entities w/o counts are excluded
+        """
+
+        return dict(self.conn.execute('SELECT entity, count FROM counts WHERE count IS NOT NULL ORDER BY rowid'))
+
+    def upsert(self, items, fetched=None):
+        """
+        Insert (or update) the popularity of many entities w/in a single transaction
+
+        :param items: iterable of (entity, count) pairs -- use None count for entities missed by the search backend
+        :param fetched: fetch timestamp (defaults to now)
+        """
+
+        fetched = time.time() if fetched is None else fetched
+        with self.conn:
+            self.conn.executemany('INSERT INTO counts (entity, count, fetched) VALUES (?, ?, ?) '
+                                  'ON CONFLICT(entity) DO UPDATE SET count = excluded.count, fetched = excluded.fetched',
+                                  ((entity, None if count is None else int(count), fetched) for entity, count in items))
+
+    def stale(self, entities, ttl=None, retryMissed=False, batchSize=500):
+        """
+        Get the entities that require (re)fetching
+
+        :param entities: iterable of target entities
+        :param ttl: max age (in seconds) of stored counts (None to never refresh them)
+        :param retryMissed: whether entities missed by the search backend require fetching again
+        :param batchSize: number of entities looked up per query
+        :return: set of entities that are not stored, whose counts are older than ttl, or (optionally) that were missed
+        """
+
+        entities = list(dict.fromkeys(entities))
+        now = time.time()
+        fresh = set()
+        for start in range(0, len(entities), batchSize):
+            batch = entities[start:start+batchSize]
+            rows = self.conn.execute('SELECT entity, count, fetched FROM counts WHERE entity IN ({})'.format(','.join('?' * len(batch))), batch)
+            for entity, count, fetched in rows:
+                if (ttl is None or now - fetched <= ttl) and (count is not None or not retryMissed):
+                    fresh.add(entity)
+        return {entity for entity in entities if entity not in fresh}
+
+    def _recordSource(self, file):
+        """
+        Store the fingerprint -- i.e., (mtime, size) and content hash -- of a TSV file whose content matches the store
+
+        :param file: TSV file
+        """
+
+        stat = os.stat(file)
+        with self.conn:
+            self.conn.execute('INSERT INTO sources (file, stat, sha1) VALUES (?, ?, ?) ON CONFLICT(file) DO UPDATE SET stat = excluded.stat, sha1 = excluded.sha1',
+                              (os.path.abspath(file), json.dumps([stat.st_mtime_ns, stat.st_size]), hashFile(file)))
+
+    def isImported(self, file):
+        """
+        Check whether the current content of a TSV file has been imported into (or exported from) the store
+        Files w/ unchanged (mtime, size) are trusted, otherwise their content hash is compared
+
+        :param file: TSV file
+        :return: True if the file is up to date w/ the store, False otherwise
+        """
+
+        row = self.conn.execute('SELECT stat, sha1 FROM sources WHERE file = ?', (os.path.abspath(file),)).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(file)
+        if [stat.st_mtime_ns, stat.st_size] == json.loads(row[0]):
+            return True
+        if hashFile(file) != row[1]:  # content changed
+            return False
+        # content unchanged -- refresh stat info only
+        self._recordSource(file)
+        return True
+
+    def importTSV(self, file):
+        """
+        Import search counts stored as (entity, count) TSV lines -- counts are timestamped w/ the file modification time
+
+        :param file: input file containing search counts
+        """
+
+        with open(file, 'r') as f:
+            searchCounts = [sC.strip().split('\t') for sC in f if sC.strip()]
+        self.upsert(((sC[0], sC[1]) for sC in searchCounts), fetched=os.path.getmtime(file))
+        self._recordSource(file)
+
+    def exportTSV(self, file):
+        """
+        Export search counts as (entity, count) TSV lines -- in insertion order, excluding entities w/o counts
+
+        :param file: output file
+        """
+
+        tmpFile = file + '.tmp'
+        with open(tmpFile, 'w') as out:
+            for entity, count in self.conn.execute('SELECT entity, count FROM counts WHERE count IS NOT NULL ORDER BY rowid'):
+                out.write(entity+'\t'+str(count)+'\n')
+        os.replace(tmpFile, file)
+        self._recordSource(file)
+
+
+def openStore(dbFile='../data/utility/searchCounts.db', tsvFile='../data/utility/searchCounts.txt'):
+    """
+    open the popularity store -- the search counts stored in TSV format (if any) are (re)imported whenever the file
+    changed since it was last imported into (or exported from) the store, hence the TSV file is the source of truth
+    :param dbFile: database file
+    :param tsvFile: search counts file imported into the store
+    :return: popularity store
+    """
+
+    store = PopularityStore(dbFile)
+    if os.path.exists(tsvFile) and not store.isImported(tsvFile):
+        store.importTSV(tsvFile)
+    return store
@@ -1,6 +1,10 @@
 import random
+import itertools
+import numpy as np
 
 from scipy import stats
+from contextlib import ExitStack, nullcontext
+from annotationOracles import InteractiveOracle
 
 
 class SRSSampler(object):
@@ -9,16 +13,19 @@ class SRSSampler(object):
     The SRS estimator is an unbiased estimator.
     """
 
-    def __init__(self, alpha=0.05):
+    def __init__(self, alpha=0.05, oracle=None):
         """
         Initialize the sampler and set confidence level plus Normal critical value z with right-tail probability αlpha/2
 
         :param alpha: the user defined confidence level
+        :param oracle: the oracle providing fact annotations (defaults to the interactive one)
         """
 
         # confidence level
         self.alpha = alpha
         self.z = stats.norm.isf(self.alpha/2)
+        # annotation oracle
+        self.oracle = oracle if oracle is not None else InteractiveOracle()
 
     @staticmethod
     def estimate(sample):
@@ -55,11 +62,19 @@ class SRSSampler(object):
         :return: the CI as (lowerBound, upperBound)
         """
 
-        # compute mean estimate
-        ae = self.estimate(sample)
+        return self.computeCIFromCounts(len(sample), sum(sample))
 
-        n = len(sample)
-        x = sum(sample)
+    def computeCIFromCounts(self, n, x):
+        """
+        Compute Confidence Interval (CI) from the sample sufficient statistics -- O(1) w.r.t. the sample size
+
+        :param n: sample size
+        :param x: number of successes (i.e., correct triples) in sample
+        :return: the CI as (lowerBound, upperBound)
+        """
+
+        # compute mean estimate
+        ae = x / n
 
         # compute the adjusted sample size
         n_ = n + self.z ** 2
@@ -84,6 +99,71 @@ class SRSSampler(object):
         # return CI as (lowerBound, upperBound)
         return lowerB, upperB
 
+    def computeCIArrays(self, n, x):
+        """
+        Compute Confidence Intervals (CIs) for arrays of sufficient statistics at once -- same CI as computeCIFromCounts
+
+        :param n: array of sample sizes
+        :param x: array of numbers of successes (i.e., correct triples)
+        :return: the CIs as (lowerBounds, upperBounds) arrays
+        """
+
+        n = np.asarray(n, dtype=np.float64)
+        x = np.asarray(x, dtype=np.float64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # compute mean estimates
+            ae = x / n
+            # compute the adjusted sample sizes, numbers of successes, and mean estimates
+            n_ = n + self.z ** 2
+            ae_ = (x + (self.z ** 2) / 2) / n_
+            # compute the margins of error
+            moe = ((self.z * (n ** 0.5)) / n_) * (((ae * (1 - ae)) + ((self.z ** 2) / (4 * n))) ** 0.5)
+
+            # use exact (chi2-based) bounds when few successes (failures) are observed
+            tail = np.where(n <= 50, 2, 3)
+            lowExact = (x >= 1) & (x <= tail)
+            upExact = (n - x >= 1) & (n - x <= tail)
+            # chi2 quantiles are only needed for 1, 2, or 3 successes (failures) -- look them up
+            chi2 = stats.chi2.isf(q=1 - self.alpha, df=2 * np.arange(4))
+            lowerB = np.where(lowExact, 0.5 * chi2[np.where(lowExact, x, 0).astype(np.int64)] / n, np.maximum(0, ae_ - moe))
+            upperB = np.where(upExact, 1 - (0.5 * chi2[np.where(upExact, n - x, 0).astype(np.int64)]) / n, np.minimum(1, ae_ + moe))
+        return lowerB, upperB
+
+    @staticmethod
+    def drawWithoutReplacement(size, rng=random):
+        """
+        Draw population indices uniformly at random w/o replacement w/ a lazy Fisher-Yates shuffle
+        Only the swapped positions are stored, so memory grows w/ the number of draws rather than w/ the population size
+
+        :param size: population size
+        :param rng: random number generator exposing randrange (defaults to the random module)
+        :return: generator of distinct indices in [0, size)
+        """
+
+        swapped = {}
+        for i in range(size):
+            # pick a position among the ones not drawn yet and swap it w/ the current one
+            j = rng.randrange(i, size)
+            drawn = swapped.get(j, j)
+            current = swapped.pop(i, i)
+            if j != i:
+                swapped[j] = current
+            yield drawn
+
+    @staticmethod
+    def getEntity(fact):
+        """
+        Get the (head) entity of a fact
+
+        :param fact: the target fact -- either as (s, p, o) or as 's p o' string
+        :return: the fact subject
+        """
+
+        if isinstance(fact, str):
+            return fact.split(' ', 1)[0]
+        return fact[0]
+
     @staticmethod
     def annotateFact(factID, fact):
         """
@@ -93,15 +173,7 @@ class SRSSampler(object):
         :return: veracity annotation (0/1 label)
         """
 
-        userInput = input("{}\t{}:".format(factID, fact))
-        # validate user input
-        while userInput not in ['0', '1']:
-            print('Invalid input. Please, enter 0 for incorrect and 1 for correct.')
-            userInput = input("{}\t{}:".format(factID, fact))
-
-        # store annotation
-        annotation = int(userInput)
-        return annotation
+        return InteractiveOracle.annotateFact(factID, fact)
 
     @staticmethod
     def costFunction(entities, triples, c1=45, c2=25):
@@ -117,7 +189,7 @@ class SRSSampler(object):
 
         return (entities * c1 + triples * c2) / 3600
 
-    def run(self, kg, stratumID, minSample=30, thrMoE=0.05, c1=45, c2=25):
+    def run(self, kg, stratumID, minSample=30, thrMoE=0.05, c1=45, c2=25, batchSize=1, store=True):
         """
         Run the evaluation procedure on KG w/ SRS and stop when MoE < thr
         :param kg: the target KG
@@ -126,6 +198,8 @@ class SRSSampler(object):
         :param thrMoE: the user defined MoE threshold
         :param c1: average cost for Entity Identification (EI)
         :param c2: average cost for Fact Verification (FV)
+        :param batchSize: the number of facts sent to the oracle at once -- the stopping condition is checked after each batch
+        :param store: whether to store annotations and stats
         :return: evaluation statistics
         """
 
@@ -134,43 +208,354 @@ class SRSSampler(object):
         upperB = 1.0
         entities = {}
         sample = {}
+        # set sufficient statistics -- sample size and number of correct facts
+        n = 0
+        x = 0
 
-        print('Annotate facts w/ 0 for incorrect and 1 for correct.')
+        # draw facts w/o replacement from the KG
+        pool = self.drawWithoutReplacement(len(kg))
 
         # open output file for writing
-        with open('../data/annotations/facts/partition'+str(stratumID)+'.tsv', 'w') as out:
-            # write header to output file
-            out.write("id\tveracity\n")
+        with (open('../data/annotations/facts/partition'+str(stratumID)+'.tsv', 'w') if store else nullcontext()) as out:
+            if store:  # write header to output file
+                out.write("id\tveracity\n")
 
             while (upperB-lowerB)/2 > thrMoE:  # stop when MoE gets lower than threshold
-                # perform SRS over the KG
-                factID, fact = random.choices(population=kg, k=1)[0]
+                # perform SRS over the KG -- stop when the whole KG has been annotated
+                batch = [kg[ix] for ix in itertools.islice(pool, batchSize)]
+                if not batch:
+                    break
 
-                if factID in sample:  # found annotated fact -- skip it
-                    continue
+                # get annotations for triples within batch
+                annotations = self.oracle.annotate([(factID, fact) for factID, fact in batch])
 
-                if fact[0] not in entities:  # found new (head) entity -- add to entities
-                    entities[fact[0]] = 1
+                for (factID, fact), factVeracity in zip(batch, annotations):
+                    entity = self.getEntity(fact)
+                    if entity not in entities:  # found new (head) entity -- add to entities
+                        entities[entity] = 1
 
-                # get annotations for triples within sample
-                factVeracity = self.annotateFact(factID, fact)
-                sample[factID] = factVeracity
+                    sample[factID] = factVeracity
+                    # update sufficient statistics
+                    n += 1
+                    x += factVeracity
 
-                if len(sample) >= minSample:  # compute CI
-                    lowerB, upperB = self.computeCI(list(sample.values()))
+                    if store:  # write fact to output file
+                        out.write("{}\t{}\n".format(factID, factVeracity))
 
-                # write fact to output file
-                out.write("{}\t{}\n".format(factID, factVeracity))
+                if n >= minSample:  # compute CI
+                    lowerB, upperB = self.computeCIFromCounts(n, x)
 
         # compute KG accuracy estimate
-        estimate = self.estimate(list(sample.values()))
+        estimate = x / n
+        # compute cost function
+        cost = self.costFunction(len(entities), n, c1, c2)
+
+        if store:  # store KG accuracy stats (w/o annotation cost)
+            with open('../data/stats/facts/partition'+str(stratumID)+'.tsv', 'w') as out:
+                out.write("estimate\tlowerBound\tupperBound\n")
+                out.write("{}\t{}\t{}\n".format(estimate, lowerB, upperB))
+
+        # return the annotated sample together w/ stats
+        return sample, (estimate, (lowerB, upperB), cost)
+
+
+class TWCSSampler(SRSSampler):
+    """
+    This class represents the Two-stage Weighted Cluster Sampling (TWCS) scheme used to perform KG accuracy evaluation.
+    Entities are the clusters: first, entities are drawn (w/ replacement) w/ probability proportional to their size;
+    then, up to m of their facts are drawn w/ SRS. Facts about the same entity share the Entity Identification cost.
+    The TWCS estimator is an unbiased estimator.
+    """
+
+    @staticmethod
+    def estimate(sample):
+        """
+        Estimate the KG accuracy based on sample
+
+        :param sample: input sample (i.e., list of drawn clusters accuracy)
+        :return: KG accuracy estimate
+        """
+
+        return sum(sample)/len(sample)
+
+    def computeVar(self, sample):
+        """
+        Compute the sample variance
+
+        :param sample: input sample (i.e., list of drawn clusters accuracy)
+        :return: sample variance
+        """
+
+        # estimate mean
+        ae = self.estimate(sample)
+        # count number of clusters in sample
+        n = len(sample)
+
+        if n*(n-1) != 0:  # compute variance
+            var = (1/(n*(n-1))) * sum([(mu - ae) ** 2 for mu in sample])
+        else:  # set variance to inf
+            var = np.inf
+        return var
+
+    def computeCI(self, sample):
+        """
+        Compute Confidence Interval (CI)
+
+        :param sample: input sample (i.e., list of drawn clusters accuracy)
+        :return: the CI as (lowerBound, upperBound)
+        """
+
+        return self.computeCIFromSums(len(sample), sum(sample), sum([mu ** 2 for mu in sample]))
+
+    def computeCIFromSums(self, n, s, s2):
+        """
+        Compute Confidence Interval (CI) from the sample sufficient statistics -- O(1) w.r.t. the sample size
+
+        :param n: number of drawn clusters
+        :param s: sum of drawn clusters accuracy
+        :param s2: sum of squared drawn clusters accuracy
+        :return: the CI as (lowerBound, upperBound)
+        """
+
+        # compute mean estimate
+        ae = s / n
+
+        if n*(n-1) != 0:  # compute variance -- max used to avoid floating points rounding errors
+            var = max(0, (s2 - n * ae ** 2) / (n * (n - 1)))
+        else:  # set variance to inf
+            var = np.inf
+
+        # compute the margin of error
+        moe = self.z * (var ** 0.5)
+
+        # return CI as (lowerBound, upperBound)
+        return max(0, ae - moe), min(1, ae + moe)
+
+    def run(self, kg, stratumID, minSample=30, thrMoE=0.05, c1=45, c2=25, m=3, batchSize=1, store=True):
+        """
+        Run the evaluation procedure on KG w/ TWCS and stop when MoE < thr
+        :param kg: the target KG
+        :param stratumID: the id of the considered partition -- which represents the current KG
+        :param minSample: the min number of annotated facts required to trigger the evaluation procedure
+        :param thrMoE: the user defined MoE threshold
+        :param c1: average cost for Entity Identification (EI)
+        :param c2: average cost for Fact Verification (FV)
+        :param m: the max number of facts drawn per cluster (second stage)
+        :param batchSize: the number of clusters whose facts are sent to the oracle at once
+        :param store: whether to store annotations and stats
+        :return: evaluation statistics
+        """
+
+        # set params
+        lowerB = 0.0
+        upperB = 1.0
+        entities = {}
+        sample = {}
+        # set sufficient statistics -- number of drawn clusters, sum and sum of squares of their accuracy
+        n = 0
+        s = 0.0
+        s2 = 0.0
+
+        # group facts by (head) entity and set cumulative cluster sizes for PPS draws
+        clusters = {}
+        for factID, fact in kg:
+            clusters.setdefault(self.getEntity(fact), []).append((factID, fact))
+        clusters = list(clusters.items())
+        cumSizes = list(itertools.accumulate(len(facts) for _, facts in clusters))
+
+        # open output file for writing
+        with (open('../data/annotations/facts/partition'+str(stratumID)+'.tsv', 'w') if store else nullcontext()) as out:
+            if store:  # write header to output file
+                out.write("id\tveracity\n")
+
+            while (upperB-lowerB)/2 > thrMoE:  # stop when MoE gets lower than threshold
+                if len(sample) == len(kg) and n > 1:  # the whole KG has been annotated
+                    break
+
+                # perform first-stage (PPS) sampling over clusters and second-stage SRS within clusters
+                batch = []
+                for entity, facts in random.choices(clusters, cum_weights=cumSizes, k=batchSize):
+                    batch.append((entity, random.sample(facts, min(m, len(facts)))))
+
+                # get annotations for triples within batch that have not been annotated yet
+                toAnnotate = list({factID: (factID, fact) for _, facts in batch for factID, fact in facts if factID not in sample}.values())
+                annotations = self.oracle.annotate(toAnnotate) if toAnnotate else []
+
+                for (factID, fact), factVeracity in zip(toAnnotate, annotations):
+                    sample[factID] = factVeracity
+
+                    if store:  # write fact to output file
+                        out.write("{}\t{}\n".format(factID, factVeracity))
+
+                for entity, facts in batch:
+                    if entity not in entities:  # found new (head) entity -- add to entities
+                        entities[entity] = 1
+
+                    # update sufficient statistics w/ cluster accuracy
+                    mu = sum(sample[factID] for factID, _ in facts) / len(facts)
+                    n += 1
+                    s += mu
+                    s2 += mu ** 2
+
+                if len(sample) >= minSample:  # compute CI
+                    lowerB, upperB = self.computeCIFromSums(n, s, s2)
+
+        # compute KG accuracy estimate
+        estimate = s / n
         # compute cost function
         cost = self.costFunction(len(entities), len(sample), c1, c2)
 
-        # store KG accuracy stats (w/o annotation cost)
-        with open('../data/stats/facts/partition'+str(stratumID)+'.tsv', 'w') as out:
-            out.write("estimate\tlowerBound\tupperBound\n")
-            out.write("{}\t{}\t{}\n".format(estimate, lowerB, upperB))
+        if store:  # store KG accuracy stats (w/o annotation cost)
+            with open('../data/stats/facts/partition'+str(stratumID)+'.tsv', 'w') as out:
+                out.write("estimate\tlowerBound\tupperBound\n")
+                out.write("{}\t{}\t{}\n".format(estimate, lowerB, upperB))
 
         # return the annotated sample together w/ stats
         return sample, (estimate, (lowerB, upperB), cost)
+
+
+class StratifiedScheduler(object):
+    """
+    This class represents the adaptive cross-stratum scheduler used to perform KG accuracy evaluation w/ stratified sampling.
+    All strata are evaluated together: each annotation is routed to the stratum w/ the largest reduction in the variance
+    of the stratified estimate per unit of expected annotation cost, until the MoE of the stratified estimate gets lower than thr.
+    """
+
+    def __init__(self, alpha=0.05, oracle=None):
+        """
+        Initialize the scheduler and set confidence level plus Normal critical value z with right-tail probability αlpha/2
+
+        :param alpha: the user defined confidence level
+        :param oracle: the oracle providing fact annotations (defaults to the interactive one)
+        """
+
+        # per-stratum SRS (w/ same confidence level and oracle)
+        self.sampler = SRSSampler(alpha, oracle)
+        self.alpha = alpha
+        self.z = self.sampler.z
+
+    def adjustedEstimate(self, n, x):
+        """
+        Compute the adjusted (Agresti-Coull) stratum accuracy estimates -- they never collapse to 0 or 1 on small samples
+
+        :param n: array of stratum sample sizes
+        :param x: array of stratum numbers of successes
+        :return: array of adjusted accuracy estimates
+        """
+
+        return (x + (self.z ** 2) / 2) / (n + self.z ** 2)
+
+    def computeMoE(self, weights, sizes, n, x):
+        """
+        Compute the MoE of the stratified accuracy estimate (w/ finite population correction)
+
+        :param weights: array of stratum weights (i.e., stratum size over KG size)
+        :param sizes: array of stratum sizes
+        :param n: array of stratum sample sizes
+        :param x: array of stratum numbers of successes
+        :return: the MoE value
+        """
+
+        ae = self.adjustedEstimate(n, x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.where(n > 0, weights ** 2 * ae * (1 - ae) * (1 / n - 1 / sizes), np.inf)
+        return self.z * (var[sizes > 0].sum() ** 0.5)
+
+    def run(self, kgs, minSample=30, thrMoE=0.05, c1=45, c2=25, batchSize=1, store=True):
+        """
+        Run the evaluation procedure on all the strata at once and stop when the MoE of the stratified estimate < thr
+        Entities identified within a stratum are not identified again within the others -- hence, strata w/ a large share of
+        facts about unseen entities are (expectedly) more costly to annotate
+
+        :param kgs: the target strata -- each one as a list of (factID, entity, fact) triples
+        :param minSample: the min sample size required per stratum before scheduling annotations adaptively
+        :param thrMoE: the user defined MoE threshold for the stratified estimate
+        :param c1: average cost for Entity Identification (EI)
+        :param c2: average cost for Fact Verification (FV)
+        :param batchSize: the number of facts (of the scheduled stratum) sent to the oracle at once
+        :param store: whether to store annotations and stats
+        :return: evaluation statistics
+        """
+
+        # set stratum weights and params
+        sizes = np.array([len(kg) for kg in kgs], dtype=np.int64)
+        weights = sizes / sizes.sum()
+        n = np.zeros(len(kgs), dtype=np.int64)
+        x = np.zeros(len(kgs), dtype=np.int64)
+        samples = [{} for _ in kgs]
+        entities = {}
+
+        # count facts per entity and stratum -- used to estimate the chance of annotating facts about unseen entities
+        entity2facts = {}
+        for stratumID, kg in enumerate(kgs):
+            for _, entity, _ in kg:
+                entity2facts.setdefault(entity, np.zeros(len(kgs), dtype=np.int64))[stratumID] += 1
+        unseen = sizes.copy()  # facts about unseen entities not annotated yet
+        remaining = sizes.copy()  # facts not annotated yet
+
+        # draw facts w/o replacement from each stratum
+        pools = [self.sampler.drawWithoutReplacement(size) for size in sizes]
+
+        # open output files for writing
+        with ExitStack() as stack:
+            if store:
+                outs = [stack.enter_context(open('../data/annotations/facts/partition'+str(stratumID)+'.tsv', 'w')) for stratumID in range(len(kgs))]
+                for out in outs:  # write header to output files
+                    out.write("id\tveracity\n")
+
+            while True:
+                warmup = n < np.minimum(minSample, sizes)
+                if warmup.any():  # annotate min sample within strata in round robin
+                    stratumID = np.flatnonzero(warmup)[np.argmin(n[warmup])]
+                    size = min(batchSize, min(minSample, sizes[stratumID]) - n[stratumID])
+                else:
+                    open_ = n < sizes
+                    if self.computeMoE(weights, sizes, n, x) <= thrMoE or not open_.any():  # stop when MoE gets lower than threshold
+                        break
+                    # compute the variance reduction of one more annotation within each stratum
+                    ae = self.adjustedEstimate(n, x)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        gain = weights ** 2 * ae * (1 - ae) * (1 / n - 1 / (n + 1))
+                        # compute the expected annotation cost (in seconds) of one more annotation within each stratum
+                        cost = c2 + c1 * unseen / remaining
+                    stratumID = np.argmax(np.where(open_, gain / cost, -np.inf))
+                    size = batchSize
+
+                # perform SRS over the stratum
+                batch = [kgs[stratumID][ix] for ix in itertools.islice(pools[stratumID], size)]
+                remaining[stratumID] -= len(batch)
+
+                # get annotations for triples within batch
+                annotations = self.sampler.oracle.annotate([(factID, fact) for factID, _, fact in batch])
+
+                for (factID, entity, fact), factVeracity in zip(batch, annotations):
+                    if entity not in entities:  # found new (head) entity -- add to entities
+                        entities[entity] = 1
+                        unseen -= entity2facts[entity]
+
+                    samples[stratumID][factID] = factVeracity
+                    n[stratumID] += 1
+                    x[stratumID] += factVeracity
+
+                    if store:  # write fact to output file
+                        outs[stratumID].write("{}\t{}\n".format(factID, factVeracity))
+
+        # compute (stratified) KG accuracy estimate and MoE
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estimates = x / n
+        estimate = (weights * estimates)[sizes > 0].sum()
+        moe = self.computeMoE(weights, sizes, n, x)
+        # compute cost function
+        cost = self.sampler.costFunction(len(entities), n.sum(), c1, c2)
+
+        if store:  # store stratum accuracy stats (w/o annotation cost)
+            for stratumID in range(len(kgs)):
+                lowerB, upperB = 0.0, 1.0
+                if n[stratumID] >= min(minSample, sizes[stratumID]) and n[stratumID] > 0:  # compute CI
+                    lowerB, upperB = self.sampler.computeCIFromCounts(n[stratumID], x[stratumID])
+                with open('../data/stats/facts/partition'+str(stratumID)+'.tsv', 'w') as out:
+                    out.write("estimate\tlowerBound\tupperBound\n")
+                    out.write("{}\t{}\t{}\n".format(estimates[stratumID], lowerB, upperB))
+
+        # return the annotated samples together w/ stats
+        return samples, (estimate, moe, cost)
@@ -0,0 +1,194 @@
+import os
+import random
+import argparse
+import numpy as np
+import pandas as pd
+
+from samplingTechniques import SRSSampler, TWCSSampler
+from annotationOracles import SimulatedOracle
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--strata', default=None, type=int, nargs='+', help='Strata to simulate -- all the annotated strata by default.')
+parser.add_argument('--replications', default=10000, type=int, help='Number of independent evaluations simulated per stratum.')
+parser.add_argument('--minSample', default=30, type=int, help='Min sample size required to trigger the evaluation procedure.')
+parser.add_argument('--thrMoE', default=0.05, type=float, help='MoE threshold used as stopping condition.')
+parser.add_argument('--alpha', default=0.05, type=float, help='Estimator confidence level.')
+parser.add_argument('--c1', default=45, type=float, help='Average cost (in seconds) for Entity Identification (EI).')
+parser.add_argument('--c2', default=25, type=float, help='Average cost (in seconds) for Fact Verification (FV).')
+parser.add_argument('--seed', default=42, type=int, help='Random seed.')
+parser.add_argument('--twcs', default=0, type=int, help='Number of evaluations simulated w/ both TWCS and SRS to compare their annotation cost -- 0 skips the comparison.')
+parser.add_argument('--m', default=3, type=int, help='Max number of facts drawn per entity (cluster) w/ TWCS.')
+
+
+class EvaluationSimulator(object):
+    """
+    This class represents the simulator of repeated (sequential) SRS evaluations over a ground-truth population.
+    Independent evaluations are simulated at once as rows of NumPy arrays: draws are row-wise permutations of the population,
+    sufficient statistics are cumulative sums, and CIs are computed for all sample sizes together to find stopping times.
+    """
+
+    def __init__(self, labels, entities, alpha=0.05):
+        """
+        Initialize the simulator
+
+        :param labels: array of ground-truth veracity labels (0/1) of the population facts
+        :param entities: array of the (head) entities of the population facts
+        :param alpha: the user defined confidence level
+        """
+
+        self.labels = np.asarray(labels, dtype=np.int64)
+        _, self.entities = np.unique(np.asarray(entities), return_inverse=True)
+        self.entities = self.entities.reshape(-1)
+        self.accuracy = self.labels.mean()
+        self.sampler = SRSSampler(alpha)
+
+    def _firstOccurrences(self, draws):
+        """
+        Mark the draws introducing new entities in each simulated evaluation
+
+        :param draws: (replications x population) matrix of drawn fact positions
+        :return: boolean matrix w/ True for the first draw of each entity within each row
+        """
+
+        entities = self.entities[draws]
+        order = np.argsort(entities, axis=1, kind='stable')
+        sortedEntities = np.take_along_axis(entities, order, axis=1)
+        first = np.ones(entities.shape, dtype=bool)
+        first[:, 1:] = sortedEntities[:, 1:] != sortedEntities[:, :-1]
+        isNew = np.empty(entities.shape, dtype=bool)
+        np.put_along_axis(isNew, order, first, axis=1)
+        return isNew
+
+    def run(self, numReplications=10000, minSample=30, thrMoE=0.05, c1=45, c2=25, rng=None, maxCells=1 << 25):
+        """
+        Simulate independent SRS evaluations that stop when MoE < thr (or when the whole population has been annotated)
+
+        :param numReplications: number of simulated evaluations
+        :param minSample: the min sample size required to trigger the evaluation procedure
+        :param thrMoE: the user defined MoE threshold
+        :param c1: average cost for Entity Identification (EI)
+        :param c2: average cost for Fact Verification (FV)
+        :param rng: numpy random generator (defaults to a fresh unseeded one)
+        :param maxCells: max number of (replication, draw) cells processed at once
+        :return: dict w/ per-evaluation sample size, number of entities, cost, estimate, CI bounds, and CI coverage
+        """
+
+        rng = rng if rng is not None else np.random.default_rng()
+        size = self.labels.shape[0]
+        sampleSizes = np.arange(1, size + 1)
+        # the stopping condition is checked from the min sample on (or on the whole population when smaller)
+        checked = sampleSizes >= min(minSample, size)
+
+        stats = {stat: [] for stat in ['sampleSize', 'entities', 'cost', 'estimate', 'lowerBound', 'upperBound']}
+        blockSize = max(1, maxCells // max(1, size))
+        for start in range(0, numReplications, blockSize):
+            rows = min(blockSize, numReplications - start)
+            # draw facts w/o replacement -- one permutation of the population per evaluation
+            draws = rng.permuted(np.tile(np.arange(size), (rows, 1)), axis=1)
+
+            # compute sufficient statistics and CIs for every sample size
+            x = np.cumsum(self.labels[draws], axis=1)
+            lowerB, upperB = self.sampler.computeCIArrays(sampleSizes[None, :], x)
+
+            # find stopping times -- i.e., the first sample size w/ MoE lower than threshold
+            stops = checked[None, :] & ((upperB - lowerB) / 2 <= thrMoE)
+            stopIx = np.where(stops.any(axis=1), stops.argmax(axis=1), size - 1)
+            rowIx = np.arange(rows)
+
+            # count the entities identified up to the stopping times
+            entities = np.cumsum(self._firstOccurrences(draws), axis=1)[rowIx, stopIx]
+
+            stats['sampleSize'].append(stopIx + 1)
+            stats['entities'].append(entities)
+            stats['cost'].append(self.sampler.costFunction(entities, stopIx + 1, c1, c2))
+            stats['estimate'].append(x[rowIx, stopIx] / (stopIx + 1))
+            stats['lowerBound'].append(lowerB[rowIx, stopIx])
+            stats['upperBound'].append(upperB[rowIx, stopIx])
+
+        stats = {stat: np.concatenate(values) for stat, values in stats.items()}
+        stats['covered'] = (stats['lowerBound'] <= self.accuracy) & (self.accuracy <= stats['upperBound'])
+        return stats
+
+
+def compareDesigns(population, numReplications=1000, minSample=30, thrMoE=0.05, alpha=0.05, c1=45, c2=25, m=3):
+    """
+    compare the annotation cost of TWCS (w/ entities as clusters) and SRS over the same ground-truth population
+    Both procedures are run w/ a simulated oracle returning the recorded annotations
+    :param population: population as pandas dataframe w/ columns id, veracity, and subj
+    :param numReplications: number of evaluations simulated per design
+    :param minSample: the min number of annotated facts required to trigger the evaluation procedure
+    :param thrMoE: the user defined MoE threshold
+    :param alpha: the user defined confidence level
+    :param c1: average cost for Entity Identification (EI)
+    :param c2: average cost for Fact Verification (FV)
+    :param m: the max number of facts drawn per cluster w/ TWCS
+    :return: dict associating each design w/ its per-evaluation costs and CI coverage
+    """
+
+    oracle = SimulatedOracle(truth=dict(zip(population['id'].tolist(), population['veracity'].tolist())))
+    accuracy = population['veracity'].mean()
+    kg = [(factID, (subj,)) for factID, subj in zip(population['id'].tolist(), population['subj'].tolist())]
+
+    results = {}
+    for design, sampler, params in [('SRS', SRSSampler(alpha, oracle), {}), ('TWCS', TWCSSampler(alpha, oracle), {'m': m})]:
+        costs = []
+        covered = []
+        for _ in range(numReplications):
+            _, (_, (lowerB, upperB), cost) = sampler.run(kg, None, minSample, thrMoE, c1, c2, store=False, **params)
+            costs.append(cost)
+            covered.append(lowerB <= accuracy <= upperB)
+        results[design] = {'cost': np.array(costs), 'covered': np.array(covered)}
+    return results
+
+
+def readPopulation(stratumID, annotationsPath='../data/annotations/facts/', utilityFile='../data/utility/factUtility.tsv'):
+    """
+    read the recorded annotations of a stratum and associate them w/ their (head) entities
+    :param stratumID: the id of the considered partition
+    :param annotationsPath: path to stored annotations
+    :param utilityFile: fact utility file (providing fact subjects)
+    :return: population as pandas dataframe w/ columns id, veracity, and subj
+    """
+
+    annotations = pd.read_csv(os.path.join(annotationsPath, 'partition'+str(stratumID)+'.tsv'), sep='\t')
+    facts = pd.read_csv(utilityFile, sep='\t', usecols=['id', 'subj'])
+    return annotations.merge(facts, on='id', how='left')
+
+
+def main():
+    # set random generator
+    rng = np.random.default_rng(args.seed)
+
+    # set strata to simulate
+    strata = args.strata
+    if strata is None:
+        strata = sorted(int(file[len('partition'):-len('.tsv')]) for file in os.listdir('../data/annotations/facts/') if file.startswith('partition') and file.endswith('.tsv'))
+
+    for stratumID in strata:
+        # use recorded annotations as ground-truth population
+        population = readPopulation(stratumID)
+        simulator = EvaluationSimulator(population['veracity'], population['subj'].fillna(''), alpha=args.alpha)
+
+        # simulate repeated evaluations
+        stats = simulator.run(args.replications, args.minSample, args.thrMoE, args.c1, args.c2, rng=rng)
+
+        print(f'Stratum {stratumID}: population={population.shape[0]} accuracy={round(simulator.accuracy, 4)}')
+        for stat in ['sampleSize', 'entities', 'cost']:
+            p5, p50, p95 = np.percentile(stats[stat], [5, 50, 95])
+            print(f'{stat}: {round(stats[stat].mean(), 2)} +\\- {round(stats[stat].std(), 2)} (5th={round(p5, 2)}, median={round(p50, 2)}, 95th={round(p95, 2)})')
+        print(f'CI coverage: {round(stats["covered"].mean(), 4)} (nominal={1 - args.alpha})')
+
+        if args.twcs:  # compare entity-clustered sampling w/ SRS
+            random.seed(args.seed)
+            designs = compareDesigns(population.fillna({'subj': ''}), args.twcs, args.minSample, args.thrMoE, args.alpha, args.c1, args.c2, args.m)
+            for design, results in designs.items():
+                print(f'{design} cost: {round(results["cost"].mean(), 2)} +\\- {round(results["cost"].std(), 2)} (CI coverage={round(results["covered"].mean(), 4)})')
+            saving = 1 - designs['TWCS']['cost'].mean() / designs['SRS']['cost'].mean()
+            print(f'TWCS cost saving w.r.t. SRS: {round(saving * 100, 1)}%')
+        print()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
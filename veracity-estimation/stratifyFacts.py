@@ -6,36 +6,37 @@ import numpy as np
 def stratifyCSRF(stratFeature, numStrata):
     """
     Perform stratification w/ Cumulative Square Root of Frequency (CSRF) based on stratification feature
+    Feature values are assigned to strata w/ a binary search over the CSRF boundaries -- O(n log n) overall
 
     :param stratFeature: target stratification feature (must represent the entire population)
     :param numStrata: number of strata
-    :return: feature indices divided into numStrata strata
+    :return: feature indices divided into numStrata strata (as arrays)
     """
 
     # compute CSRF
-    unique, counts = np.unique(stratFeature, return_counts=True)
+    stratFeature = np.asarray(stratFeature)
+    unique, inverse, counts = np.unique(stratFeature, return_inverse=True, return_counts=True)
     sqrt_counts = np.sqrt(counts)
     csrf = np.cumsum(sqrt_counts)
-    csrf2unique = dict(zip(csrf, unique))
 
     # define boundaries for strata (intervals)
     strataSize = csrf[-1] / numStrata
-    boundaries = [-1]
-    boundaries += [strataSize * (i + 1) for i in range(numStrata - 1)]
+    boundaries = np.array([strataSize * (i + 1) for i in range(numStrata - 1)])
 
     # sanity check
-    assert len(boundaries) == numStrata
-
-    # assign features to strata based on CSRF intervals
-    strata = []
-    for b in range(numStrata):
-        if b == numStrata - 1:
-            intervals = [csrf2unique[c] for c in csrf if c > boundaries[b]]
-        else:
-            intervals = [csrf2unique[c] for c in csrf if (c > boundaries[b]) and (c < boundaries[b + 1])]
-        # store feature indices within stratum
-        stratum = [i for i in range(len(stratFeature)) if stratFeature[i] in intervals]
-        strata += [stratum]
+    assert boundaries.shape[0] == numStrata - 1
+
+    # assign unique values to strata based on CSRF intervals -- values whose CSRF falls exactly on a boundary belong to no stratum
+    uStrata = np.searchsorted(boundaries, csrf, side='left')
+    uStrata[np.isin(csrf, boundaries)] = -1
+    if unique.dtype.kind == 'f':  # NaN features never match any interval
+        uStrata[np.isnan(unique)] = -1
+
+    # store feature indices within strata (in ascending order)
+    featStrata = uStrata[inverse.reshape(-1)]
+    order = np.argsort(featStrata, kind='stable')
+    bounds = np.searchsorted(featStrata[order], np.arange(numStrata + 1))
+    strata = [order[bounds[b]:bounds[b + 1]] for b in range(numStrata)]
     return strata
 
 
@@ -1,20 +1,23 @@
 import os
+import sys
 import json
 import argparse
 import itertools
-import pandas as pd
+import numpy as np
 
-from tqdm import tqdm
-from scipy.stats import kendalltau
 from collections import OrderedDict
 
+sys.path.append('../utils')
+from runReader import iterRun
+from corpusStore import loadCorpus
+
 parser = argparse.ArgumentParser()
-parser.add_argument('--size', default=5, choices=[5, 10], help='Considered size for entity cards.')
+parser.add_argument('--size', default=5, type=int, help='Considered size for entity cards.')
 parser.add_argument('--method', default='dynes_utility', choices=['dynes_utility', 'relin'], help='Target method.')
+parser.add_argument('--curve', default=False, action='store_true', help='Whether to report KTU and RBO at every cutoff from 1 to size.')
+parser.add_argument('--persistence', default=0.9, type=float, help='Persistence parameter of Rank-Biased Overlap (RBO).')
 args = parser.parse_args()
 
-formats = {'csv': ',', 'tsv': '\t'}
-
 
 def break_ties(run):  # taken from https://github.com/irgroup/repro_eval/blob/master/repro_eval/util.py
     """
@@ -32,32 +35,116 @@ def break_ties(run):  # taken from https://github.com/irgroup/repro_eval/blob/ma
     return run
 
 
-def _ktau_union(orig_run, rep_run, avoidQ, trim_thresh=10, pbar=False):  # taken and modified from https://github.com/irgroup/repro_eval/blob/master/repro_eval/measure/document_order.py
+def encodeRankings(orig_run, rep_run, avoidQ, trim_thresh=10):
     """
-    Helping function returning a generator to determine Kendall's tau Union (KTU) for all topics.
+    Encode the top documents of each topic as integer matrices -- document codes preserve the sorted order of document IDs.
 
     @param orig_run: The original run.
     @param rep_run: The reproduced/replicated run.
     @param avoidQ: The set of queries to avoid considering
     @param trim_thresh: Threshold values for the number of documents to be compared.
-    @param pbar: Boolean value indicating if progress bar should be printed.
-    @return: Generator with KTU values.
+    @return: Topics (in rep_run order), original and reproduced rankings as (topics x trim_thresh) matrices padded w/ -1,
+    and the number of documents compared per topic.
+    """
+
+    topics = [topic for topic in rep_run if topic not in avoidQ]
+    orig_docs = [list(orig_run.get(topic).keys())[:trim_thresh] for topic in topics]
+    rep_docs = [list(rep_run.get(topic).keys())[:trim_thresh] for topic in topics]
+    lengths = np.array([min(len(o), len(r)) for o, r in zip(orig_docs, rep_docs)], dtype=np.int64)
+
+    # map documents to (order-preserving) integer codes and scatter them into padded matrices
+    sizes = np.array([len(docs) for docs in orig_docs + rep_docs], dtype=np.int64)
+    _, codes = np.unique(np.array([doc for docs in orig_docs + rep_docs for doc in docs]), return_inverse=True)
+    rows = np.repeat(np.arange(sizes.shape[0]), sizes)
+    cols = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    encoded = np.full((sizes.shape[0], trim_thresh), -1, dtype=np.int64)
+    encoded[rows, cols] = codes.reshape(-1)
+    return topics, encoded[:len(topics)], encoded[len(topics):], lengths
+
+
+def _blocks(numTopics, trim_thresh, maxCells=1 << 24):
+    """
+    Helping function splitting topics into blocks whose pairwise (trim_thresh x trim_thresh) comparisons fit maxCells.
+
+    @param numTopics: The number of topics.
+    @param trim_thresh: Threshold values for the number of documents to be compared.
+    @param maxCells: The max number of pairwise comparisons per block.
+    @return: Generator of topic slices.
     """
 
-    generator = tqdm(rep_run.items()) if pbar else rep_run.items()
+    blockSize = max(1, maxCells // max(1, trim_thresh * trim_thresh))
+    for start in range(0, numTopics, blockSize):
+        yield slice(start, start + blockSize)
 
-    for topic, docs in generator:
-        if topic in avoidQ:
-            continue
-        orig_docs = list(orig_run.get(topic).keys())[:trim_thresh]
-        rep_docs = list(rep_run.get(topic).keys())[:trim_thresh]
-        union = list(sorted(set(orig_docs + rep_docs)))
-        orig_idx = [union.index(doc) for doc in orig_docs]
-        rep_idx = [union.index(doc) for doc in rep_docs]
-        yield topic, round(kendalltau(orig_idx, rep_idx).correlation, 14)
 
+def ktuCurve(orig, rep, lengths):
+    """
+    Determine KTU for all topics at every cutoff from 1 to trim_thresh in one pass.
+    As documents are unique within rankings, KTU at cutoff k is the mean of sign(O_i - O_j) * sign(R_i - R_j) over the rank pairs
+    i < j < k, where O and R are the (sorted) union positions -- i.e., the integer codes -- of the original and reproduced documents.
+
+    @param orig: The integer-encoded original rankings (topics x trim_thresh).
+    @param rep: The integer-encoded reproduced rankings (topics x trim_thresh).
+    @param lengths: The number of documents compared per topic -- cutoffs beyond it reuse the KTU at it.
+    @return: Matrix (topics x trim_thresh) w/ the KTU of each topic at each cutoff (NaN when less than two documents are compared).
+    """
+
+    numTopics, trim_thresh = orig.shape
+    ranks = np.arange(trim_thresh)
+    concordances = np.zeros((numTopics, trim_thresh))
+    for block in _blocks(numTopics, trim_thresh):
+        O, R, n = orig[block], rep[block], lengths[block]
+        concordance = np.sign(O[:, :, None] - O[:, None, :]) * np.sign(R[:, :, None] - R[:, None, :])
+        # keep the pairs i < j w/ both documents compared -- j < n implies i < n
+        valid = (ranks[:, None] < ranks[None, :])[None] & (ranks[None, None, :] < n[:, None, None])
+        # sum the concordances of the pairs completed at rank j and accumulate them over cutoffs
+        concordances[block] = np.cumsum((concordance * valid).sum(axis=1), axis=1)
+
+    # normalize by the number of pairs -- as done by scipy.stats.kendalltau (w/o ties)
+    compared = np.minimum(ranks[None, :] + 1, lengths[:, None])
+    pairs = compared * (compared - 1) / 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return concordances / np.sqrt(pairs) / np.sqrt(pairs)
+
+
+def rboCurve(orig, rep, lengths, p=0.9):
+    """
+    Determine the extrapolated Rank-Biased Overlap (RBO) for all topics at every cutoff from 1 to trim_thresh in one pass
+    according to the following paper:
+    William Webber, Alistair Moffat, Justin Zobel.
+    A Similarity Measure for Indefinite Rankings.
+    ACM Transactions on Information Systems, 28(4), pages 1-38, 2010.
+
+    @param orig: The integer-encoded original rankings (topics x trim_thresh).
+    @param rep: The integer-encoded reproduced rankings (topics x trim_thresh).
+    @param lengths: The number of documents compared per topic -- cutoffs beyond it reuse the RBO at it.
+    @param p: The persistence parameter.
+    @return: Matrix (topics x trim_thresh) w/ the RBO of each topic at each cutoff (NaN when no document is compared).
+    """
 
-def ktau_union(orig_run, rep_run, avoidQ, trim_thresh=10, pbar=False):  # taken and modified from https://github.com/irgroup/repro_eval/blob/master/repro_eval/measure/document_order.py
+    numTopics, trim_thresh = orig.shape
+    ranks = np.arange(trim_thresh)
+    overlaps = np.zeros((numTopics, trim_thresh))
+    for block in _blocks(numTopics, trim_thresh):
+        O, R, n = orig[block], rep[block], lengths[block]
+        compared = ranks[None, :] < n[:, None]
+        match = (O[:, :, None] == R[:, None, :]) & compared[:, :, None] & compared[:, None, :]
+        # the depth at which each original document enters the overlap is the largest of its ranks in the two rankings
+        depths = np.where(match, np.maximum(ranks[:, None], ranks[None, :]), trim_thresh).min(axis=2)
+        rows = np.repeat(np.arange(O.shape[0]), trim_thresh)
+        entries = np.bincount(rows * (trim_thresh + 1) + depths.reshape(-1), minlength=O.shape[0] * (trim_thresh + 1))
+        overlaps[block] = np.cumsum(entries.reshape(O.shape[0], trim_thresh + 1)[:, :trim_thresh], axis=1)
+
+    # compute agreements at each depth and sum them (geometrically weighted) up to the compared depth
+    agreements = np.where(ranks[None, :] < lengths[:, None], overlaps / (ranks[None, :] + 1), 0.0)
+    weighted = np.cumsum((1 - p) * p ** ranks[None, :] * agreements, axis=1)
+    compared = np.minimum(ranks[None, :] + 1, lengths[:, None])
+    last = np.take_along_axis(agreements, np.maximum(compared - 1, 0), axis=1)
+    rbo = np.take_along_axis(weighted, np.maximum(compared - 1, 0), axis=1) + p ** compared * last
+    return np.where(compared > 0, rbo, np.nan)
+
+
+def ktau_union(orig_run, rep_run, avoidQ, trim_thresh=10):  # taken and modified from https://github.com/irgroup/repro_eval/blob/master/repro_eval/measure/document_order.py
     """
     Determines the Kendall's tau Union (KTU) between the original and reproduced document orderings
     according to the following paper:
@@ -69,74 +156,63 @@ def ktau_union(orig_run, rep_run, avoidQ, trim_thresh=10, pbar=False):  # taken
     @param rep_run: The reproduced/replicated run.
     @param avoidQ: The set of queries to avoid considering
     @param trim_thresh: Threshold values for the number of documents to be compared.
-    @param pbar: Boolean value indicating if progress bar should be printed.
     @return: Dictionary with KTU values that compare the document orderings of the original and reproduced runs.
     """
 
-    return dict(_ktau_union(orig_run, rep_run, avoidQ, trim_thresh=trim_thresh, pbar=pbar))
+    topics, orig, rep, lengths = encodeRankings(orig_run, rep_run, avoidQ, trim_thresh=trim_thresh)
+    kTaus = ktuCurve(orig, rep, lengths)[:, trim_thresh - 1]
+    return {topic: round(kTau, 14) for topic, kTau in zip(topics, kTaus)}
 
 
-def readRun(file):
+def readTopFacts(file, size):
     """
-    read run and convert into dataframe
+    stream run query by query and keep the top facts of each query
     :param file: input run
-    :return: run as pandas dataframe
-    """
-
-    fformat = file.split('.')[-1]
-    if fformat != 'run':
-        print('Format allowed is: run')
-        raise Exception
-
-    df = pd.read_csv(file, sep='\t', names=['query', 'entity', 'factID', 'rank', 'score', 'model'])
-    return df
-
-
-def readData(file):
+    :param size: number of facts to keep per query
+    :return: dict associating each query (sorted) with the dict of its top facts and their scores (in run order)
     """
-    read dataset and convert into dataframe
-    :param file: input file containing collection
-    :return: dataset as pandas dataframe
-    """
-
-    fformat = file.split('.')[-1]
-    if fformat not in formats:
-        print('Formats allowed are: {}'.format(formats.keys()))
-        raise Exception
 
-    df = pd.read_csv(file, sep=formats[fformat])
-    return df
+    q2run = {}
+    for query, run in iterRun(file):
+        q2run[query] = dict(zip(run['factID'].head(size).tolist(), run['score'].head(size).tolist()))
+    return dict(sorted(q2run.items()))
 
 
 def main():
-    # read data
-    df = readData('../data/corpus/fact_ranking_coll.tsv')
-    # get id and (subj, pred, obj) facts from the collections
-    facts = {}
-    for row in df.iterrows():
-        facts[row[0]] = {'subj': row[1]['en_id'], 'pred': row[1]['pred'], 'obj': row[1]['obj']}
+    # load corpus in binary columnar format -- converted on first use
+    corpus = loadCorpus('../data/corpus/fact_ranking_coll.tsv')
 
-    # read runs
+    # read runs (top facts only)
     if args.method == 'dynes_utility':
-        run = readRun('../data/runs/dynes_utility.run')
-        rrun = readRun('../data/runs/vRankDynes.run')
+        q2run = readTopFacts('../data/runs/dynes_utility.run', args.size)
+        q2rrun = readTopFacts('../data/runs/vRankDynes.run', args.size)
     else:
-        run = readRun('../data/runs/relin.run')
-        rrun = readRun('../data/runs/vRankRELIN.run')
+        q2run = readTopFacts('../data/runs/relin.run', args.size)
+        q2rrun = readTopFacts('../data/runs/vRankRELIN.run', args.size)
+
+    # get (subj, pred, obj) facts from the collection -- only for the top facts of the runs
+    factIDs = sorted({factID for q2facts in [q2run, q2rrun] for qData in q2facts.values() for factID in qData})
+    df = corpus.toFrame(['en_id', 'pred', 'obj'], rows=factIDs)
+    facts = {}
+    for factID, subj, pred, obj in zip(factIDs, df['en_id'].tolist(), df['pred'].tolist(), df['obj'].tolist()):
+        facts[factID] = {'subj': subj, 'pred': pred, 'obj': obj}
 
     # set the list of queries to avoid -- i.e., the queries w/ facts belonging to only one partition
     avoidQ = ['INEX_LD-2009111', 'INEX_LD-2010057', 'INEX_LD-20120122', 'INEX_LD-20120222', 'INEX_LD-2012319',
               'INEX_XER-129', 'INEX_XER-130', 'INEX_XER-81', 'QALD2_te-48', 'QALD2_te-82', 'QALD2_te-98',
               'SemSearch_ES-123', 'SemSearch_ES-66', 'SemSearch_ES-86', 'SemSearch_LS-31', 'SemSearch_LS-43']
 
-    # prepare runs for Kendall's Tau Union (KTU) evaluation
-    q2run = run.groupby('query')[['factID', 'score']].apply(lambda x: dict(x[['factID', 'score']].to_records(index=False)))
-    q2rrun = rrun.groupby('query')[['factID', 'score']].apply(lambda x: dict(x[['factID', 'score']].to_records(index=False)))
-
     # compute KTU
     kTaus = ktau_union(q2run, q2rrun, avoidQ, trim_thresh=args.size)
     print(f'KTU={round(sum(kTaus.values())/len(kTaus), 2)} between {args.method} and its vRank at cutoff={args.size}')
 
+    if args.curve:  # report KTU and RBO at every cutoff up to size
+        topics, orig, rep, lengths = encodeRankings(q2run, q2rrun, avoidQ, trim_thresh=args.size)
+        kTauCurve = ktuCurve(orig, rep, lengths).mean(axis=0)
+        rboCurves = rboCurve(orig, rep, lengths, p=args.persistence).mean(axis=0)
+        for cutoff in range(1, args.size + 1):
+            print(f'cutoff={cutoff}: KTU={round(kTauCurve[cutoff-1], 2)} RBO(p={args.persistence})={round(rboCurves[cutoff-1], 2)}')
+
     # restrict to queries w/ KTU lower than 0.8
     kTausFiltered = {q: score for q, score in kTaus.items() if score < 0.8}
 
@@ -1,86 +1,65 @@
-import pandas as pd
+import sys
+import argparse
 import ir_measures as ireval
 
-from ir_measures import *
+sys.path.append('../utils')
+from runEvaluator import RunEvaluator, evaluateFiles
+from significanceTests import compareRuns
+from qrelsReader import readQrels, query2remove
 
 
-def readRun(file):
-    """
-    read run and convert into dataframe
-    :param file: input run
-    :return: run as pandas dataframe
-    """
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', default=['dynes_utility', 'vRankDynes', 'relin', 'vRankRELIN'], nargs='+', help='Runs (stored in ../data/runs/ w/o .run extension) to evaluate.')
+parser.add_argument('--measures', default=['nDCG@5', 'nDCG@10'], nargs='+', help='Measures to compute (w/ ir_measures syntax) -- nDCG, P, AP, and RR w/ optional cutoffs.')
+parser.add_argument('--perQuery', default=None, help='File storing per-query results (as TSV) -- not stored by default.')
+parser.add_argument('--workers', default=0, type=int, help='Number of worker processes reading and evaluating runs -- 0 evaluates all runs at once.')
+parser.add_argument('--significance', action='store_true', help='Whether to test the significance of the differences between original and vRank runs.')
+parser.add_argument('--allPairs', action='store_true', help='Whether to test all pairs of evaluated runs rather than original vs vRank runs only.')
+parser.add_argument('--samples', default=100000, type=int, help='Number of random permutations (randomization test) and bootstrap samples (bootstrap test).')
+parser.add_argument('--correction', default='holm', choices=['bonferroni', 'holm', 'bh'], help='Multiple comparison correction across run pairs.')
+parser.add_argument('--alpha', default=0.05, type=float, help='Significance level.')
+parser.add_argument('--seed', default=42, type=int, help='Random seed.')
 
-    fformat = file.split('.')[-1]
-    if fformat != 'run':
-        print('Format allowed is: run')
-        raise Exception
 
-    df = pd.read_csv(file, sep='\t', names=['query_id', 'entity', 'doc_id', 'rank', 'score', 'model'])
-    return df
-
-
-def readQrels(file):
-    """
-    read qrels and convert into dataframe
-    :param file: input qrels
-    :return: qrels as pandas dataframe
-    """
-
-    df = pd.read_csv(file, sep='\t', names=['query_id', 'entity', 'doc_id', 'relevance'])
-    return df
-
-
-# list of queries w/ all facts associated w/ the same veracity partition
-query2remove = [
-    'INEX_LD-2009111',
-    'INEX_LD-2010057',
-    'INEX_LD-20120122',
-    'INEX_LD-20120222',
-    'INEX_LD-2012319',
-    'INEX_XER-129',
-    'INEX_XER-130',
-    'INEX_XER-81',
-    'QALD2_te-48',
-    'QALD2_te-82',
-    'QALD2_te-98',
-    'SemSearch_ES-123',
-    'SemSearch_ES-66',
-    'SemSearch_ES-86',
-    'SemSearch_LS-31',
-    'SemSearch_LS-43'
-]
+# labels used to report the original and vRank runs
+run2label = {'dynes_utility': 'DynES (orig)', 'vRankDynes': 'DynES (vRank)', 'relin': 'RELIN (orig)', 'vRankRELIN': 'RELIN (vRank)'}
+# original runs and their vRank versions
+run2vRank = {'dynes_utility': 'vRankDynes', 'relin': 'vRankRELIN'}
 
 
 def main():
-    # read runs
-    dynes = readRun('../data/runs/dynes_utility.run')
-    dynes['doc_id'] = dynes['doc_id'].astype(str)
-    vRankDynes = readRun('../data/runs/vRankDynes.run')
-    vRankDynes['doc_id'] = vRankDynes['doc_id'].astype(str)
-    relin = readRun('../data/runs/relin.run')
-    relin['doc_id'] = relin['doc_id'].astype(str)
-    vRankRELIN = readRun('../data/runs/vRankRELIN.run')
-    vRankRELIN['doc_id'] = vRankRELIN['doc_id'].astype(str)
-
     # read qrels
     qrels = readQrels('../data/corpus/qrels-utility.txt')
-    qrels['doc_id'] = qrels['doc_id'].astype(str)
     # remove rows whose query is in query2remove -- i.e. queries w/ all facts associated w/ same veracity partition
     qrels = qrels[~qrels['query_id'].isin(query2remove)]
+    # set measures
+    measures = [ireval.parse_measure(measure) for measure in args.measures]
 
-    # compute considered measures
-    dynesScores = ireval.calc_aggregate([nDCG @ 5, nDCG @ 10], qrels, dynes)
-    vRankDynesScores = ireval.calc_aggregate([nDCG @ 5, nDCG @ 10], qrels, vRankDynes)
-    relinScores = ireval.calc_aggregate([nDCG @ 5, nDCG @ 10], qrels, relin)
-    vRankRELINScores = ireval.calc_aggregate([nDCG @ 5, nDCG @ 10], qrels, vRankRELIN)
+    # index qrels once and evaluate all runs (and queries) in one pass
+    evaluator = RunEvaluator(qrels)
+    results = evaluateFiles(evaluator, {run: '../data/runs/'+run+'.run' for run in args.runs}, measures, workers=args.workers)
+    if args.perQuery:  # store per-query results
+        results.to_csv(args.perQuery, sep='\t', index=False)
 
     # print performance
-    print(f'DynES (orig): nDCG@5={round(dynesScores[nDCG @ 5], 2)}\tnDCG@10={round(dynesScores[nDCG @ 10], 2)}')
-    print(f'DynES (vRank): nDCG@5={round(vRankDynesScores[nDCG @ 5], 2)}\tnDCG@10={round(vRankDynesScores[nDCG @ 10], 2)}')
-    print(f'RELIN (orig): nDCG@5={round(relinScores[nDCG @ 5], 2)}\tnDCG@10={round(relinScores[nDCG @ 10], 2)}')
-    print(f'RELIN (vRank): nDCG@5={round(vRankRELINScores[nDCG @ 5], 2)}\tnDCG@10={round(vRankRELINScores[nDCG @ 10], 2)}')
+    scores = RunEvaluator.aggregate(results)
+    for run in args.runs:
+        print(f'{run2label.get(run, run)}: ' + '\t'.join([f'{measure}={round(scores.loc[run, str(measure)], 2)}' for measure in measures]))
+
+    if args.significance:  # paired randomization and bootstrap tests, w/ p-values corrected across run pairs
+        pairs = None if args.allPairs else [(run, vRank) for run, vRank in run2vRank.items() if run in args.runs and vRank in args.runs]
+        if pairs == []:
+            print('No original and vRank runs to compare -- use --allPairs to compare the evaluated runs')
+            raise Exception
+        comparisons = compareRuns(results, pairs, numSamples=args.samples, alpha=args.alpha, correction=args.correction, seed=args.seed)
+        print()
+        for _, comparison in comparisons.iterrows():
+            significant = '*' if max(comparison['pRandomizationAdj'], comparison['pBootstrapAdj']) < args.alpha else ''
+            print(f'{run2label.get(comparison["runB"], comparison["runB"])} vs {run2label.get(comparison["runA"], comparison["runA"])}: '
+                  f'{comparison["measure"]} diff={round(comparison["diff"], 3)} {int((1 - args.alpha) * 100)}% CI=[{round(comparison["ciLow"], 3)}, {round(comparison["ciHigh"], 3)}]\t'
+                  f'randomization p={round(comparison["pRandomizationAdj"], 4)}\tbootstrap p={round(comparison["pBootstrapAdj"], 4)} ({args.correction}){significant}')
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main()
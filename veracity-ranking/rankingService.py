@@ -0,0 +1,157 @@
+import sys
+import json
+import argparse
+import numpy as np
+
+from reRank import reRank
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append('../utils')
+from factIndex import FactIndex
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default='127.0.0.1', help='Host address the service listens on.')
+parser.add_argument('--port', default=8000, type=int, help='Port the service listens on.')
+parser.add_argument('--topk', default=None, type=int, help='Default number of facts returned per query -- all facts are returned by default.')
+
+
+class VeracityRanker(object):
+    """
+    This class represents the in-process veracity-aware ranking service.
+    Stratum accuracy estimates are kept resident in memory, so that candidate facts of (batches of) queries
+    are re-ranked w/o any I/O, consistently w/ the offline re-ranking performed by reRank.py.
+    """
+
+    def __init__(self, strataFile='../data/utility/stratifiedFacts.csv', statsPath='../data/stats/facts/', topk=None):
+        """
+        Initialize the service and load stratum accuracy estimates in memory
+
+        :param strataFile: stored strata IDs
+        :param statsPath: path to estimate stats
+        :param topk: default number of facts returned per query (None to return all)
+        """
+
+        # keep a resident (in-memory) copy of the fact accuracy estimates
+        self.estimates = np.array(FactIndex(strataFile, statsPath).index['estimate'])
+        self.topk = topk
+
+    def _lookup(self, factIDs):
+        """
+        Get the accuracy estimates of the given facts -- facts not belonging to any stratum get NaN
+
+        :param factIDs: array of fact IDs
+        :return: array of accuracy estimates
+        """
+
+        known = (factIDs >= 0) & (factIDs < self.estimates.shape[0])
+        return np.where(known, self.estimates[np.where(known, factIDs, 0)], np.nan)
+
+    def rank(self, factIDs, scores, topk=None):
+        """
+        Re-rank the candidate facts of a query based on veracity-fused scores
+
+        :param factIDs: candidate fact IDs
+        :param scores: candidate retrieval scores
+        :param topk: number of facts to return (None to use the service default)
+        :return: re-ranked fact IDs and their fused scores
+        """
+
+        factIDs = np.asarray(factIDs, dtype=np.int64)
+        order, fused, _ = reRank(np.zeros(factIDs.shape[0], dtype=np.int64), factIDs, scores, self._lookup(factIDs), topk=topk or self.topk)
+        return factIDs[order], fused
+
+    def rankBatch(self, candidates, topk=None):
+        """
+        Re-rank the candidate facts of many queries at once -- the whole batch is ordered w/ a single sort
+
+        :param candidates: dict associating each query with its (candidate fact IDs, candidate retrieval scores)
+        :param topk: number of facts to return per query (None to use the service default)
+        :return: dict associating each query with its re-ranked fact IDs and their fused scores
+        """
+
+        queries = list(candidates.keys())
+        sizes = [len(candidates[query][0]) for query in queries]
+        if not sum(sizes):
+            return {query: (np.array([], dtype=np.int64), np.array([])) for query in queries}
+
+        # flatten the batch into aligned arrays
+        codes = np.repeat(np.arange(len(queries)), sizes)
+        factIDs = np.concatenate([np.asarray(candidates[query][0], dtype=np.int64) for query in queries])
+        scores = np.concatenate([np.asarray(candidates[query][1], dtype=np.float64) for query in queries])
+        order, fused, _ = reRank(codes, factIDs, scores, self._lookup(factIDs), topk=topk or self.topk)
+
+        # split the re-ranked batch back into queries
+        bounds = np.searchsorted(codes[order], np.arange(len(queries) + 1))
+        return {query: (factIDs[order[bounds[i]:bounds[i+1]]], fused[bounds[i]:bounds[i+1]]) for i, query in enumerate(queries)}
+
+
+def _encode(factIDs, fused):
+    """
+    encode a re-ranked query as JSON-serializable dict -- NaN fused scores are encoded as null
+    :param factIDs: re-ranked fact IDs
+    :param fused: fused scores
+    :return: dict w/ facts and scores lists
+    """
+
+    return {'facts': factIDs.tolist(), 'scores': [None if np.isnan(score) else score for score in fused.tolist()]}
+
+
+def makeHandler(ranker):
+    """
+    build the HTTP request handler bound to the ranker
+    :param ranker: the in-process veracity ranker
+    :return: request handler class
+    """
+
+    class RankingHandler(BaseHTTPRequestHandler):
+        """
+        This class represents the (local) HTTP interface of the ranking service. Two POST endpoints are exposed:
+        - /rank: {"facts": [...], "scores": [...], "topk": k} -> {"facts": [...], "scores": [...]}
+        - /rankBatch: {"queries": {query: {"facts": [...], "scores": [...]}}, "topk": k} -> {"queries": {query: {...}}}
+        """
+
+        protocol_version = 'HTTP/1.1'  # keep connections alive across requests
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if self.path == '/rank':
+                    self._reply(200, _encode(*ranker.rank(request['facts'], request['scores'], request.get('topk'))))
+                elif self.path == '/rankBatch':
+                    candidates = {query: (qData['facts'], qData['scores']) for query, qData in request['queries'].items()}
+                    ranked = ranker.rankBatch(candidates, request.get('topk'))
+                    self._reply(200, {'queries': {query: _encode(*qRanked) for query, qRanked in ranked.items()}})
+                else:
+                    self._reply(404, {'error': 'unknown endpoint {}'.format(self.path)})
+            except (ValueError, KeyError, TypeError) as e:  # malformed request
+                self._reply(400, {'error': str(e)})
+
+        def log_message(self, format, *args):  # silence per-request logging
+            pass
+
+    return RankingHandler
+
+
+def main():
+    # load stratum estimates once and serve re-ranking requests
+    ranker = VeracityRanker(topk=args.topk)
+    server = ThreadingHTTPServer((args.host, args.port), makeHandler(ranker))
+    print('Serving veracity-aware ranking on http://{}:{} (endpoints: /rank, /rankBatch)'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
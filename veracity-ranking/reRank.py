@@ -1,96 +1,261 @@
+import os
+import sys
+import json
+import hashlib
 import argparse
+import itertools
+import numpy as np
 import pandas as pd
+import ir_measures as ireval
+
+sys.path.append('../utils')
+from factIndex import FactIndex
+from fileHash import hashFile
+from runReader import iterRun, readRun
+from runEvaluator import RunEvaluator
+from qrelsReader import readQrels, query2remove
 
-from glob import glob
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--method', default='dynes_utility', choices=['dynes_utility', 'relin'], help='Target method.')
-args = parser.parse_args()
+parser.add_argument('--topk', default=None, type=int, help='Number of facts to keep per query -- all facts are kept by default.')
+parser.add_argument('--sweep', action='store_true', help='Whether to evaluate a grid of fusion weights and estimate variants rather than storing the re-ranked run -- --topk is ignored.')
+parser.add_argument('--weights', default=[0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0], nargs='+', type=float, help='Interpolation weights of the accuracy estimates (sweep only) -- 0.5 ranks as the default fusion.')
+parser.add_argument('--estimates', default=['estimate', 'lowerBound', 'upperBound'], nargs='+', choices=['estimate', 'lowerBound', 'upperBound'], help='Accuracy estimate variants (sweep only) -- point estimate, CI lower bound, and CI upper bound.')
+parser.add_argument('--measures', default=['nDCG@5', 'nDCG@10'], nargs='+', help='Measures to compute (sweep only) w/ ir_measures syntax.')
+
+
+def normalizeScores(queries, scores):
+    """
+    min-max normalize retrieval scores within each query
+    :param queries: array of (integer) query codes
+    :param scores: array of retrieval scores
+    :return: array of normalized scores
+    """
+
+    queries = np.asarray(queries, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    numQueries = queries.max() + 1 if queries.shape[0] else 0
+
+    # perform (segment-wise) min-max normalization over score
+    mins = np.full(numQueries, np.inf)
+    maxs = np.full(numQueries, -np.inf)
+    np.fmin.at(mins, queries, scores)
+    np.fmax.at(maxs, queries, scores)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (scores - mins[queries]) / (maxs[queries] - mins[queries])
+
+
+def fuseScores(normalized, estimates, weight=None):
+    """
+    fuse normalized retrieval scores w/ accuracy estimates
+    :param normalized: array of (min-max) normalized scores
+    :param estimates: array of accuracy estimates
+    :param weight: interpolation weight of the estimates -- i.e., (1-weight)*score+weight*estimate (None to sum scores and estimates)
+    :return: array of fused scores
+    """
+
+    estimates = np.asarray(estimates, dtype=np.float64)
+    if weight is None:
+        return normalized + estimates
+    return (1 - weight) * normalized + weight * estimates
+
+
+def reRank(queries, factIDs, scores, estimates, topk=None, weight=None):
+    """
+    re-rank facts by summing their min-max normalized scores (within query) w/ the accuracy estimates
+    Facts are ordered by (query, fused score desc, fact ID) w/ a single lexsort -- facts w/ NaN fused scores go last
+
+    :param queries: array of (integer) query codes -- output queries follow the order of codes
+    :param factIDs: array of fact IDs
+    :param scores: array of retrieval scores
+    :param estimates: array of accuracy estimates
+    :param topk: number of facts to keep per query (None to keep all)
+    :param weight: interpolation weight of the estimates (None to sum scores and estimates)
+    :return: positions of the input rows in re-ranked order, their fused scores, and their ranks
+    """
+
+    queries = np.asarray(queries, dtype=np.int64)
+    factIDs = np.asarray(factIDs)
+    # fuse (min-max normalized) scores w/ accuracy estimates to perform re-ranking
+    fused = fuseScores(normalizeScores(queries, scores), estimates, weight)
+
+    # restrict to the candidates that can enter the top-k of their query
+    rows = np.arange(queries.shape[0]) if topk is None else _topkCandidates(queries, fused, topk)
 
+    # re-rank based on the updated score and set the ranking order
+    order = rows[np.lexsort((factIDs[rows], -fused[rows], queries[rows]))]
+    sortedQ = queries[order]
+    starts = np.flatnonzero(np.r_[True, sortedQ[1:] != sortedQ[:-1]]) if order.shape[0] else np.array([], dtype=np.int64)
+    ranks = np.arange(order.shape[0]) - np.repeat(starts, np.diff(np.r_[starts, order.shape[0]])) + 1
+    if topk is not None:  # cut candidates tied at the top-k boundary
+        order, ranks = order[ranks <= topk], ranks[ranks <= topk]
+    return order, fused[order], ranks
 
-def readRun(file):
+
+def _topkCandidates(queries, fused, topk, maxPadding=4):
+    """
+    select the facts whose fused scores reach the topk-th highest score of their query w/ partial sorting
+    Queries are laid out as rows of a padded matrix and partitioned at once -- when padding would exceed
+    maxPadding times the run size, all facts are returned as candidates
+
+    :param queries: array of (integer) query codes
+    :param fused: array of fused scores
+    :param topk: number of facts to keep per query
+    :param maxPadding: max ratio between padded matrix size and run size
+    :return: positions of candidate rows
+    """
+
+    # group rows by query and compute their positions within each query
+    grouped = np.argsort(queries, kind='stable')
+    sortedQ = queries[grouped]
+    starts = np.flatnonzero(np.r_[True, sortedQ[1:] != sortedQ[:-1]])
+    lengths = np.diff(np.r_[starts, sortedQ.shape[0]])
+    if lengths.max() <= topk or starts.shape[0] * lengths.max() > maxPadding * queries.shape[0]:
+        return np.arange(queries.shape[0])
+    segments = np.repeat(np.arange(starts.shape[0]), lengths)
+    positions = np.arange(sortedQ.shape[0]) - starts[segments]
+
+    # partition (negated) fused scores per query -- NaN scores and padding go last
+    keys = np.where(np.isnan(fused[grouped]), np.inf, -fused[grouped])
+    padded = np.full((starts.shape[0], lengths.max()), np.inf)
+    padded[segments, positions] = keys
+    thresholds = np.partition(padded, topk - 1, axis=1)[:, topk - 1]
+    return np.sort(grouped[keys <= thresholds[segments]])
+
+
+def readBatches(file, batchSize=1000000):
     """
-    read run and convert into dataframe
+    stream run as batches of whole queries -- queries are sorted within each batch by the caller, hence batches must cover
+    increasing query ranges for the output to be sorted by query (as done when sorting the whole run)
     :param file: input run
-    :return: run as pandas dataframe
+    :param batchSize: min number of rows per batch (but the last one)
+    :return: generator of run batches as pandas dataframes
     """
 
-    fformat = file.split('.')[-1]
-    if fformat != 'run':
-        print('Format allowed is: run')
-        raise Exception
+    blocks = []
+    queries = []
+    rows = 0
+    last = None  # largest query of the previous batches
+    for query, run in iterRun(file, scoreDtype=np.float64):
+        blocks.append(run)
+        queries.append(str(query))
+        rows += run.shape[0]
+        if rows >= batchSize:
+            last = _checkOrder(queries, last, file)
+            yield pd.concat(blocks, ignore_index=True)
+            blocks = []
+            queries = []
+            rows = 0
+    if blocks:
+        _checkOrder(queries, last, file)
+        yield pd.concat(blocks, ignore_index=True)
 
-    df = pd.read_csv(file, sep='\t', names=['query', 'entity', 'factID', 'rank', 'score', 'model'])
-    return df
+
+def _checkOrder(queries, last, file):
+    """
+    check that the queries of a batch follow the queries of the previous batches
+    :param queries: list of (string) queries within the batch
+    :param last: largest query of the previous batches (None for the first batch)
+    :param file: input run
+    :return: largest query seen so far
+    """
+
+    if last is not None and min(queries) <= last:
+        print('Queries of {} must be sorted to be re-ranked in batches -- sort the run by query or increase the batch size'.format(file))
+        raise Exception
+    return max(queries)
 
 
-def fact2estimate(strataFile, annotPath):
+def sweep(run, f2e, evaluator, weights, estimates, measures, fingerprint, cacheDir):
     """
-    associate each fact to the (estimated) partition accuracy
-    :param strataFile: stored strata IDs
-    :param annotPath: path to estimate stats
-    :return: dict associating each fact ID with the corresponding partition estimate
+    evaluate the re-ranking of a run for every (estimate variant, fusion weight) configuration -- scores are normalized once and
+    all the configurations are ranked and evaluated in one pass, w/ results cached per configuration
+    :param run: run as pandas dataframe
+    :param f2e: fact index storing the accuracy estimates
+    :param evaluator: run evaluator (w/ qrels indexed)
+    :param weights: list of interpolation weights of the accuracy estimates
+    :param estimates: list of estimate variants -- estimate, lowerBound, or upperBound
+    :param measures: list of (ir_measures) measures
+    :param fingerprint: hash of the inputs (run, strata/stats, and qrels) shared by all configurations
+    :param cacheDir: folder storing the cached results (one file per configuration)
+    :return: results as pandas dataframe w/ columns estimate, weight, and one column per measure
     """
 
-    # read strata file and store fact IDs within strata
-    with open(strataFile, 'r') as f:
-        strata = f.readlines()
-    strata = [stratum.strip().split(',') for stratum in strata]
-    strata = [[int(_id) for _id in stratum] for stratum in strata]
+    os.makedirs(cacheDir, exist_ok=True)
+    configs = list(itertools.product(estimates, weights))
+    # key configurations by inputs fingerprint, estimate variant, fusion weight, and measures
+    keys = [hashlib.sha1(json.dumps([fingerprint, estimate, weight, sorted(map(str, measures))]).encode('utf-8')).hexdigest() for estimate, weight in configs]
+    cached = {}
+    for key in keys:
+        if os.path.exists(os.path.join(cacheDir, key + '.json')):
+            with open(os.path.join(cacheDir, key + '.json'), 'r') as f:
+                cached[key] = json.load(f)
 
-    # set vars
-    strata2stats = {}
-    fact2est = {}
+    missing = [(config, key) for config, key in zip(configs, keys) if key not in cached]
+    if missing:
+        # normalize scores and look up estimate variants once -- shared by all missing configurations
+        queries, _ = pd.factorize(run['query'], sort=True)
+        normalized = normalizeScores(queries, run['score'].to_numpy())
+        variants = {estimate: f2e.lookup(run['factID'], estimate) for estimate in set(estimate for (estimate, _), _ in missing)}
+        fused = {key: fuseScores(normalized, variants[estimate], weight) for (estimate, weight), key in missing}
+        scores = RunEvaluator.aggregate(evaluator.evaluateVariants(run, fused, measures))
+        for (estimate, weight), key in missing:
+            cached[key] = {'estimate': estimate, 'weight': weight, **{str(measure): scores.loc[key, str(measure)] for measure in measures}}
+            # store results atomically -- temporary files are per process
+            tmpFile = os.path.join(cacheDir, key + '.' + str(os.getpid()) + '.tmp')
+            with open(tmpFile, 'w') as out:
+                json.dump(cached[key], out)
+            os.replace(tmpFile, os.path.join(cacheDir, key + '.json'))
+    return pd.DataFrame([cached[key] for key in keys])
 
-    # read stats files
-    statsPaths = glob(annotPath+'partition*')
-    # iterate over files and store stats info:
-    for statPath in statsPaths:
-        # get partition id
-        _id = int(statPath.split('.tsv')[0][-1])
-        df = pd.read_csv(statPath, sep='\t')
-        strata2stats[_id] = df.values.tolist()
 
-    # iterate over strata and associate to each fact ID the corresponding accuracy estimate (point estimate + CI)
-    for i, facts in enumerate(strata):
-        for fact in facts:
-            fact2est[fact] = strata2stats[i]
+def runSweep():
+    # read fact accuracy estimates, qrels (w/o queries w/ all facts associated w/ the same veracity partition), and run
+    f2e = FactIndex('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
+    qrels = readQrels('../data/corpus/qrels-utility.txt')
+    qrels = qrels[~qrels['query_id'].isin(query2remove)]
+    runFile = '../data/runs/'+args.method+'.run'
+    run = readRun(runFile, scoreDtype=np.float64)
+    measures = [ireval.parse_measure(measure) for measure in args.measures]
 
-    # return dict
-    return fact2est
+    # evaluate all the configurations -- cached results are reused as long as run, strata/stats, qrels, and the code fusing
+    # and evaluating scores (i.e., this script and the utils it relies on) are unchanged
+    code = [os.path.abspath(__file__)] + ['../utils/'+module+'.py' for module in ['factIndex', 'fileHash', 'runReader', 'runEvaluator', 'qrelsReader']]
+    fingerprint = hashlib.sha1(json.dumps([hashFile(runFile), f2e.fingerprint(), hashFile('../data/corpus/qrels-utility.txt'), query2remove] + [hashFile(file) for file in code]).encode('utf-8')).hexdigest()
+    results = sweep(run, f2e, RunEvaluator(qrels), args.weights, args.estimates, measures, fingerprint, '../data/runs/sweep/'+args.method+'/')
+
+    # print performance and the best configuration (w.r.t. the first measure)
+    for _, result in results.iterrows():
+        print(f'{args.method} ({result["estimate"]}, weight={result["weight"]:g}): ' + '\t'.join([f'{measure}={round(result[str(measure)], 4)}' for measure in measures]))
+    best = results.loc[results[str(measures[0])].idxmax()]
+    print(f'best {measures[0]}: {best["estimate"]}, weight={best["weight"]:g}')
 
 
 def main():
-    # read run
-    run = readRun('../data/runs/'+args.method+'.run')
+    if args.sweep:
+        runSweep()
+        return
+
     # read fact accuracy estimates
-    f2e = fact2estimate('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
-    # create new column for run
-    run['accEstimate'] = run['factID'].map(lambda x: f2e.get(x, [None])[0][0])
-
-    # perform min-max normalization over score
-    run['score'] = run.groupby('query')['score'].transform(lambda x: (x - x.min()) / (x.max() - x.min()))
-    # sum scores w/ accuracy estimates to perform re-ranking
-    run['score'] += run['accEstimate']
-
-    # re-rank based on the updated score
-    run = run.groupby('query').apply(lambda group: group.sort_values(by='score', ascending=False))
-    # reset the index after sorting
-    run.reset_index(drop=True, inplace=True)
-    # reset the ranking order
-    run.loc[:, 'rank'] = run.groupby('query').cumcount() + 1
-
-    # drop accEstimate column
-    run = run.drop(['accEstimate'], axis=1)
-
-    # store re-ranked run
+    f2e = FactIndex('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
+
+    # set re-ranked run name
     if args.method == "dynes_utility":
-        run['model'] = 'vRankDynes'
-        run.to_csv('../data/runs/vRankDynes.run', sep='\t', header=False, index=False)
+        model = 'vRankDynes'
     else:
-        run['model'] = 'vRankRELIN'
-        run.to_csv('../data/runs/vRankRELIN.run', sep='\t', header=False, index=False)
+        model = 'vRankRELIN'
+
+    # stream run in batches of queries and store re-ranked run
+    with open('../data/runs/'+model+'.run', 'w') as out:
+        for run in readBatches('../data/runs/'+args.method+'.run'):
+            # encode queries (sorted) and re-rank facts based on the updated score
+            queries, _ = pd.factorize(run['query'], sort=True)
+            order, fused, ranks = reRank(queries, run['factID'].to_numpy(), run['score'].to_numpy(), f2e.lookup(run['factID'], 'estimate'), topk=args.topk)
+            run = run.iloc[order].assign(score=fused, rank=ranks, model=model)
+            run.to_csv(out, sep='\t', header=False, index=False)
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     main()
@@ -0,0 +1,215 @@
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+from scipy import stats
+
+sys.path.append('../utils')
+from factIndex import FactIndex
+from runReader import readRun
+from qrelsReader import query2remove
+from reRank import normalizeScores
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--method', default='dynes_utility', choices=['dynes_utility', 'relin'], help='Target method -- its run is re-ranked w/ the sampled accuracy estimates.')
+parser.add_argument('--draws', default=10000, type=int, help='Number of accuracy vectors drawn.')
+parser.add_argument('--distribution', default='beta', choices=['beta', 'normal'], help='Distribution of stratum accuracy -- Beta posterior (moment-matched to the CI) or split Normal (fit to the CI bounds).')
+parser.add_argument('--size', default=10, type=int, help='Cutoff used for rank stability and KTU.')
+parser.add_argument('--alpha', default=0.05, type=float, help='The confidence level of the stratum CIs.')
+parser.add_argument('--blockSize', default=500, type=int, help='Max number of draws re-ranked at once.')
+parser.add_argument('--seed', default=42, type=int, help='Random seed.')
+
+
+class RobustnessAnalyzer(object):
+    """
+    This class represents the Monte Carlo analysis of the robustness of vRank orderings w.r.t. the uncertainty of stratum accuracy.
+    The run is laid out once as a padded (query x fact) matrix of normalized scores and stratum IDs, so that each block of
+    accuracy draws is fused and re-ranked as a single (draws x query x fact) array and compared w/ the point-estimate ranking.
+    Only the facts that can enter the top facts of their query under some draw are laid out -- i.e., the top facts of each (query, stratum) pair.
+    """
+
+    def __init__(self, run, f2e, size=10, alpha=0.05):
+        """
+        Initialize the analyzer by normalizing scores and laying out the (candidate) facts of the run as padded matrices
+
+        :param run: run as pandas dataframe w/ (at least) columns query, factID, and score
+        :param f2e: fact index storing strata and their accuracy estimates
+        :param size: cutoff used for rank stability and KTU
+        :param alpha: the user defined confidence level (of the stratum CIs)
+        """
+
+        self.size = size
+        self.z = stats.norm.isf(alpha/2)
+
+        # encode queries (sorted) and normalize scores once, as done by reRank
+        qCodes, self.queries = pd.factorize(run['query'], sort=True)
+        factIDs = run['factID'].to_numpy(dtype=np.int64)
+        normalized = normalizeScores(qCodes, run['score'].to_numpy(dtype=np.float64))
+
+        # encode strata w/ stats as columns of the drawn accuracy vectors -- the trailing column (NaN) is picked by facts w/o stats and padding
+        strata = f2e.strata()
+        self.stats = strata.dropna()
+        codes = np.full(strata.index.max() + 2 if strata.shape[0] else 1, self.stats.shape[0])
+        codes[self.stats.index.to_numpy()] = np.arange(self.stats.shape[0])
+        rowStrata = codes[f2e.lookup(factIDs, 'stratum')]
+
+        # accuracy is constant within a stratum, hence the order of the facts of a (query, stratum) pair is the same in every draw --
+        # only the top facts of each pair can enter the top facts of the query, and they are the only candidates re-ranked
+        # facts w/ NaN fused scores (i.e., w/ NaN normalized scores or w/o stats) are ordered by fact ID, as done by reRank
+        keys = np.where(np.isnan(normalized) | (rowStrata == self.stats.shape[0]), np.inf, -normalized)
+        order = np.lexsort((factIDs, keys, rowStrata, qCodes))
+        groups = np.flatnonzero(np.r_[True, (qCodes[order][1:] != qCodes[order][:-1]) | (rowStrata[order][1:] != rowStrata[order][:-1])]) if order.shape[0] else np.zeros(0, dtype=np.int64)
+        groupRanks = np.arange(order.shape[0]) - np.repeat(groups, np.diff(np.r_[groups, order.shape[0]]))
+        candidates = np.sort(order[groupRanks < size])
+        self.lengths = np.bincount(qCodes, minlength=self.queries.shape[0])
+
+        # lay out candidates by (query, fact ID) -- a stable sort on fused scores then breaks ties by fact ID, as done by reRank
+        order = candidates[np.lexsort((factIDs[candidates], qCodes[candidates]))]
+        sortedQ = qCodes[order]
+        starts = np.flatnonzero(np.r_[True, sortedQ[1:] != sortedQ[:-1]]) if order.shape[0] else np.zeros(0, dtype=np.int64)
+        numCandidates = np.diff(np.r_[starts, order.shape[0]])
+        positions = np.arange(order.shape[0]) - np.repeat(starts, numCandidates)
+        shape = (starts.shape[0], numCandidates.max() if order.shape[0] else 0)
+
+        # padded matrices -- padding has no fact (-1) and no stats
+        self.factIDs = np.full(shape, -1, dtype=np.int64)
+        self.factIDs[sortedQ, positions] = factIDs[order]
+        self.normalized = np.zeros(shape)
+        self.normalized[sortedQ, positions] = normalized[order]
+        self.strata = np.full(shape, self.stats.shape[0])
+        self.strata[sortedQ, positions] = rowStrata[order]
+
+    def draw(self, numDraws, distribution='beta', rng=None):
+        """
+        Draw accuracy vectors from the stratum CIs
+        The Beta posterior matches the point estimate (mean) and the CI half-width (std dev via the Normal critical value z),
+        while the split Normal uses the distance of each bound from the point estimate as std dev on the corresponding side
+
+        :param numDraws: number of accuracy vectors
+        :param distribution: 'beta' or 'normal'
+        :param rng: numpy random generator (defaults to a fresh unseeded one)
+        :return: (draws x strata) matrix of accuracy values, w/ a trailing column of NaN for facts w/o stats
+        """
+
+        rng = rng if rng is not None else np.random.default_rng()
+        estimate = self.stats['estimate'].to_numpy(dtype=np.float64)
+        lowerB = self.stats['lowerBound'].to_numpy(dtype=np.float64)
+        upperB = self.stats['upperBound'].to_numpy(dtype=np.float64)
+
+        if distribution == 'beta':
+            # method of moments -- strata w/ (nearly) degenerate estimates or CIs keep their point estimate
+            var = ((upperB - lowerB) / (2 * self.z)) ** 2
+            valid = (var > 0) & (var < estimate * (1 - estimate))
+            common = np.where(valid, estimate * (1 - estimate) / np.where(valid, var, 1) - 1, 1)
+            a, b = np.where(valid, estimate * common, 1), np.where(valid, (1 - estimate) * common, 1)
+            accuracies = np.where(valid[None, :], rng.beta(a, b, size=(numDraws, estimate.shape[0])), estimate[None, :])
+        elif distribution == 'normal':
+            deviates = rng.standard_normal(size=(numDraws, estimate.shape[0]))
+            spread = np.where(deviates < 0, estimate - lowerB, upperB - estimate) / self.z
+            accuracies = np.clip(estimate[None, :] + deviates * spread, 0, 1)
+        else:
+            print('Distributions allowed are: beta, normal')
+            raise Exception
+        return np.concatenate([accuracies, np.full((numDraws, 1), np.nan)], axis=1)
+
+    def rank(self, accuracies):
+        """
+        Re-rank all queries for each accuracy vector at once
+
+        :param accuracies: (draws x strata) matrix of accuracy values (as returned by draw)
+        :return: (draws x query x fact) array of positions within the padded matrices in re-ranked order
+        """
+
+        # fuse normalized scores w/ accuracy estimates -- facts w/ NaN fused scores go last, followed by padding
+        fused = self.normalized[None, :, :] + accuracies[:, self.strata]
+        keys = np.where(np.isnan(fused), np.inf, -fused)
+        return np.argsort(keys, axis=2, kind='stable')
+
+    def _compare(self, point, orders):
+        """
+        Compare the (top) rankings of many draws w/ the point-estimate ranking
+
+        :param point: (query x fact) positions in point-estimate order
+        :param orders: (draws x query x fact) positions in re-ranked order
+        :return: dict of (draws x query) matrices -- KTU, fraction of the point top facts kept within the top facts,
+        whether the top ranking is unchanged, and mean absolute rank shift of the point top facts (w/ ranks beyond the cutoff counted as the cutoff)
+        """
+
+        numDraws, numQueries, numFacts = orders.shape
+        size = min(self.size, numFacts)
+        n = np.minimum(self.lengths, size)
+        valid = np.arange(size)[None, :] < n[:, None]
+
+        # top fact IDs -- KTU compares fact IDs, which preserve the (sorted) order of the union of the two rankings
+        pointTop = np.take_along_axis(self.factIDs, point[:, :size], axis=1)
+        drawTop = np.take_along_axis(self.factIDs[None, :, :], orders[:, :, :size], axis=2)
+        pairs = (np.arange(size)[:, None] < np.arange(size)[None, :])[None, :, :] & valid[:, :, None] & valid[:, None, :]
+        concordance = np.sign(pointTop[None, :, :, None] - pointTop[None, :, None, :]) * np.sign(drawTop[:, :, :, None] - drawTop[:, :, None, :])
+        numPairs = (n * (n - 1) / 2)[None, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ktu = np.where(numPairs > 0, (concordance * pairs[None]).sum(axis=(2, 3)) / numPairs, np.nan)
+
+        # ranks of all candidates within each draw
+        ranks = np.empty_like(orders)
+        np.put_along_axis(ranks, orders, np.arange(numFacts)[None, None, :], axis=2)
+        pointRanks = np.take_along_axis(ranks, np.broadcast_to(point[None, :, :size], (numDraws, numQueries, size)), axis=2)
+        kept = ((pointRanks < size) & valid[None]).sum(axis=2) / np.maximum(n, 1)[None, :]
+        unchanged = ((drawTop == pointTop[None]) | ~valid[None]).all(axis=2)
+        shifts = np.where(valid[None], np.abs(np.minimum(pointRanks, size) - np.arange(size)[None, None, :]), 0).sum(axis=2) / np.maximum(n, 1)[None, :]
+        return {'ktu': ktu, 'kept': kept, 'unchanged': unchanged, 'shift': shifts}
+
+    def analyze(self, numDraws, distribution='beta', blockSize=500, seed=42):
+        """
+        Re-rank the run for many accuracy draws (in blocks) and summarize the rank stability of each query
+
+        :param numDraws: number of accuracy vectors
+        :param distribution: 'beta' or 'normal'
+        :param blockSize: max number of draws re-ranked at once
+        :param seed: random seed
+        :return: per-query results as pandas dataframe w/ columns query, facts, mean and 5th percentile KTU, mean kept fraction,
+        fraction of draws w/ unchanged top ranking, and mean rank shift
+        """
+
+        rng = np.random.default_rng(seed)
+        # point-estimate ranking -- i.e., the vRank ordering
+        pointAccuracies = np.append(self.stats['estimate'].to_numpy(dtype=np.float64), np.nan)[None, :]
+        point = self.rank(pointAccuracies)[0]
+
+        blocks = {'ktu': [], 'kept': [], 'unchanged': [], 'shift': []}
+        for start in range(0, numDraws, blockSize):
+            orders = self.rank(self.draw(min(blockSize, numDraws - start), distribution, rng))
+            for name, values in self._compare(point, orders).items():
+                blocks[name].append(values)
+        results = {name: np.concatenate(values) for name, values in blocks.items()}
+
+        # queries w/ less than two facts have NaN KTU in every draw
+        return pd.DataFrame({'query': np.asarray(self.queries, dtype=object), 'facts': self.lengths,
+                             'ktu': results['ktu'].mean(axis=0), 'ktuLow': np.percentile(results['ktu'], 5, axis=0),
+                             'kept': results['kept'].mean(axis=0), 'unchanged': results['unchanged'].mean(axis=0), 'shift': results['shift'].mean(axis=0)})
+
+
+def main():
+    # read fact accuracy estimates and run
+    f2e = FactIndex('../data/utility/stratifiedFacts.csv', '../data/stats/facts/')
+    run = readRun('../data/runs/'+args.method+'.run', scoreDtype=np.float64)
+
+    # re-rank the run for each accuracy draw and compare w/ the point-estimate (vRank) ranking
+    analyzer = RobustnessAnalyzer(run, f2e, size=args.size, alpha=args.alpha)
+    results = analyzer.analyze(args.draws, args.distribution, args.blockSize, args.seed)
+
+    # store per-query results
+    os.makedirs('../data/robustness/', exist_ok=True)
+    results.to_csv('../data/robustness/'+args.method+'_'+args.distribution+'.tsv', sep='\t', index=False)
+
+    # print performance -- excluding queries w/ all facts associated w/ the same veracity partition
+    results = results[~results['query'].isin(query2remove)]
+    print(f'{args.method} ({args.draws} {args.distribution} draws, cutoff={args.size}): KTU={round(results["ktu"].mean(), 2)} (5th percentile={round(results["ktuLow"].mean(), 2)})\t'
+          f'kept={round(results["kept"].mean(), 2)}\tunchanged={round(results["unchanged"].mean(), 2)}\tshift={round(results["shift"].mean(), 2)}')
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()